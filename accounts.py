@@ -0,0 +1,78 @@
+import base64, hashlib, threading
+from collections import OrderedDict
+from meta_client import MetaClient
+
+# =====================
+# Cuentas Meta por chat
+# =====================
+# Cada chat puede tener su propia cuenta (token, ad account, página, número de
+# WhatsApp); si no, usa la de las variables FB_*. El token se guarda cifrado en
+# el estado con Fernet (paquete cryptography) usando STATE_KEY. Los clientes
+# Graph viven en un pool LRU acotado por ad account y token: cada uno con su
+# sesión keep-alive y su propio presupuesto de rate limit (headers de uso de Meta).
+
+FIELDS = ("token", "account_id", "page_id", "waba_phone")
+
+class Sealer:
+    """Cifra/descifra secretos del estado. key: STATE_KEY (cualquier texto)."""
+    def __init__(self, key):
+        self._fernet = None
+        if not key:
+            return
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            print("⚠️ Falta el paquete cryptography: no se pueden guardar cuentas Meta por chat")
+            return
+        # cualquier STATE_KEY sirve: se deriva una clave Fernet de 32 bytes
+        self._fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(key.encode()).digest()))
+
+    @property
+    def enabled(self):
+        return self._fernet is not None
+
+    def seal(self, text):
+        if not self.enabled:
+            raise RuntimeError("Cuentas por chat desactivadas: configura STATE_KEY e instala cryptography.")
+        return self._fernet.encrypt(text.encode()).decode()
+
+    def unseal(self, token):
+        if not self.enabled:
+            raise RuntimeError("Hay un token cifrado pero falta STATE_KEY o cryptography.")
+        from cryptography.fernet import InvalidToken
+        try:
+            return self._fernet.decrypt(token.encode()).decode()
+        except InvalidToken:
+            raise RuntimeError("No se pudo descifrar el token guardado (¿cambió STATE_KEY?).")
+
+class ClientPool:
+    """MetaClient por (ad account, token), LRU con a lo sumo maxsize clientes vivos.
+    Dos chats con la misma cuenta y distinto token (el de FB_* y uno propio)
+    tienen cada uno su cliente en vez de pisarse el de la otra en cada llamada.
+    Un cliente que sale del pool no se cierra: otro hilo puede estar usándolo;
+    su sesión se libera cuando nadie más lo referencia."""
+    def __init__(self, version, maxsize=32):
+        self.version = version
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()   # (account_id, token) -> MetaClient
+
+    def get(self, account_id, token):
+        key = (account_id, token)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            client = self._clients[key] = MetaClient(token, self.version)
+            while len(self._clients) > self.maxsize:
+                self._clients.popitem(last=False)
+            return client
+
+    def usage(self):
+        """% de uso reportado por Meta para cada cuenta con cliente vivo."""
+        out = {}
+        with self._lock:
+            for (acc, _), c in self._clients.items():
+                out[(acc,)] = max(out.get((acc,), 0.0), c.usage)
+        return out
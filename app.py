@@ -1,9 +1,26 @@
-import os, json, time, threading, traceback
+import os, re, csv, gzip, json, time, uuid, tempfile, itertools, threading, traceback, contextlib
+from collections import deque
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request
 import telebot
 from telebot import types
-import requests
+from meta_client import MetaError, batch_op
+from accounts import Sealer, ClientPool, FIELDS as FB_FIELDS
+import insights
+import bulk
+from storage import JsonStore, SqliteStore
+from workers import ChatPool
+from jobs import JobQueue
+from router import Router
+from media import MediaPipeline
+from sender import SendQueue
+import scheduler as sched
+from cluster import LeaderLock, Shards, chat_key, read_updates
+from telemetry import Counter, Histogram, Gauge, track
+from cache import SingleFlight
+import telemetry
 
 # =====================
 # Carga de configuración
@@ -13,6 +30,20 @@ TG_TOKEN         = os.getenv("TG_TOKEN")
 DATA_FILE        = os.getenv("DATA_FILE", "data.json")
 PORT             = int(os.getenv("PORT", 10000))
 
+# Ingreso de updates: "polling" (por defecto) o "webhook"
+BOT_MODE         = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL      = os.getenv("WEBHOOK_URL")       # ej: https://mi-bot.onrender.com
+WEBHOOK_SECRET   = os.getenv("WEBHOOK_SECRET", "")
+WORKERS          = int(os.getenv("WORKERS", (os.cpu_count() or 2) * 4))
+MAX_PENDING      = int(os.getenv("MAX_PENDING", 1000))
+
+# Multi-proceso: con PROCS>1 este proceso es el líder (ingreso de updates) y
+# lanza PROCS workers; cada chat lo atiende siempre el worker cid % PROCS.
+PROCS            = int(os.getenv("PROCS", 1))
+ROLE             = os.getenv("CLUSTER_ROLE", "leader" if PROCS > 1 else "single")
+SHARD            = int(os.getenv("CLUSTER_SHARD", 0))
+LEADER_LOCK      = os.getenv("LEADER_LOCK", "bot.leader.lock")
+
 # Meta / Facebook Marketing API
 FB_ACCESS_TOKEN  = os.getenv("FB_ACCESS_TOKEN")
 FB_AD_ACCOUNT_ID = os.getenv("FB_AD_ACCOUNT_ID")  # ej: act_1234567890
@@ -23,194 +54,922 @@ FB_API_VERSION   = os.getenv("FB_API_VERSION", "20.0")
 if not TG_TOKEN:
     raise RuntimeError("Falta TG_TOKEN")
 
-bot = telebot.TeleBot(TG_TOKEN, parse_mode=None)
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise RuntimeError("Falta WEBHOOK_URL para BOT_MODE=webhook")
+
+if PROCS > 1 and os.getenv("STATE_BACKEND", "json").lower() != "sqlite":
+    raise RuntimeError("PROCS>1 requiere STATE_BACKEND=sqlite (estado compartido entre procesos)")
+
+def owns(cid):
+    """¿Este proceso atiende el chat? Siempre, salvo en un worker de otro shard."""
+    return ROLE != "worker" or int(cid) % PROCS == SHARD
+
+# En webhook y en los workers los handlers corren en nuestro pool (orden por chat)
+bot = telebot.TeleBot(TG_TOKEN, parse_mode=None, threaded=(BOT_MODE != "webhook" and ROLE != "worker"))
 DEFAULT_BUDGET = 80_000
 
+# =====================
+# Métricas internas (/metrics)
+# =====================
+UPDATES      = Counter("bot_updates_total", "Updates de Telegram recibidos", ("type",))
+TG_CALLS     = Histogram("bot_telegram_api_seconds", "Latencia de llamadas a la Bot API", ("method",))
+TG_ERRORS    = Counter("bot_telegram_api_errors_total", "Errores de llamadas a la Bot API", ("method",))
+META_CALLS   = Histogram("bot_meta_call_seconds", "Latencia de llamadas a Meta", ("op",))
+META_ERRORS  = Counter("bot_meta_call_errors_total", "Errores de llamadas a Meta", ("op",))
+CB_SECONDS   = Histogram("bot_callback_seconds", "Latencia de handlers de callback", ("action",))
+SAVE_SECONDS = Histogram("bot_save_seconds", "Duración de cada flush de estado")
+SAVE_BYTES   = Counter("bot_save_bytes_total", "Bytes escritos por los flushes de estado")
+TG_THROTTLED = Counter("bot_telegram_throttled_total", "Respuestas 429 de la Bot API", ("method",))
+
+_process_updates = bot.process_new_updates
+def _counted_updates(updates):
+    for u in updates:
+        UPDATES.inc("callback_query" if u.callback_query else "message" if u.message else "other")
+    return _process_updates(updates)
+bot.process_new_updates = _counted_updates
+
 # =====================
 # Estado & Persistencia
 # =====================
-S = {}  # S[cid] = {'step', 'line', 'title','desc','media','budget','store','outbox'}
+OUTBOX_MAX    = int(os.getenv("OUTBOX_MAX", 500))
+DELETE_WINDOW = 48*3600 - 300  # Telegram solo deja borrar mensajes de < 48h (con margen)
+
+def new_outbox():
+    # (message_id, enviado_en) de los mensajes del bot, acotado por chat
+    return deque(maxlen=OUTBOX_MAX)
+
+S = {}        # chats en memoria: S[cid] = {'step', 'line', 'title','desc','media','budget','store','outbox'}
+S_LOCK = threading.Lock()
+OUTBOX = {}   # cid -> outbox; sobrevive al desalojo del chat mientras haya algo borrable
+CHAT_IDLE_TTL = int(os.getenv("CHAT_IDLE_TTL", 1800))  # s sin actividad antes de desalojar
+
 def st(cid):
-    if cid not in S:
-        S[cid] = {"step":"idle", "budget":DEFAULT_BUDGET, "store":{}, "outbox":[]}
-    S[cid].setdefault("store", {})
-    return S[cid]
+    s = S.get(cid)
+    if s is None:
+        with S_LOCK:
+            s = S.get(cid)
+            if s is None:
+                # carga perezosa desde el backend
+                v = DB.get(cid) or {}
+                s = S[cid] = {"step":"idle", "budget":v.get("budget", DEFAULT_BUDGET),
+                              "store":v.get("store", {}), "jobs":v.get("jobs", {}),
+                              "line_ids":v.get("line_ids", {}), "next_lid":v.get("next_lid", 1),
+                              "next_aid":v.get("next_aid", 1),
+                              "fb":v.get("fb"), "schedules":v.get("schedules", {}),
+                              "outbox":OUTBOX.setdefault(cid, new_outbox()),
+                              "_ids":threading.Lock()}
+                s["_ad_line"] = _ad_lines(s["store"])
+    s.setdefault("store", {})
+    s["_seen"] = time.monotonic()
+    return s
+
+def _persisted(cid):
+    s = S.get(cid)
+    if s is None:
+        return None
+    return {"budget": s.get("budget", DEFAULT_BUDGET), "store": s.get("store", {}),
+            "jobs": s.get("jobs", {}), "line_ids": s.get("line_ids", {}),
+            "next_lid": s.get("next_lid", 1), "next_aid": s.get("next_aid", 1), "fb": s.get("fb"), "schedules": s.get("schedules", {})}
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json").lower()   # json | sqlite
+SAVE_DELAY    = float(os.getenv("SAVE_DELAY", "0.5"))
+_on_flush     = lambda dt, n: (SAVE_SECONDS.observe(dt), SAVE_BYTES.inc(n=n))
+if STATE_BACKEND == "sqlite":
+    # la primera vez migra DATA_FILE (si existe) a la base
+    DB = SqliteStore(os.getenv("STATE_DB", "state.db"), _persisted, delay=SAVE_DELAY,
+                     legacy_json=DATA_FILE, on_flush=_on_flush)
+else:
+    DB = JsonStore(DATA_FILE, _persisted, delay=SAVE_DELAY,
+                   compact_every=int(os.getenv("COMPACT_EVERY", "1000")), on_flush=_on_flush)
+
+Gauge("bot_chats_loaded", "Chats en memoria", lambda: len(S))
+Gauge("bot_state_bytes", "Tamaño serializado del estado persistido", lambda: sum(DB.sizes().values()))
+Gauge("bot_chat_state_bytes_max", "Tamaño serializado del chat más grande",
+      lambda: max(DB.sizes().values(), default=0))
 
 def load_all():
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        for k,v in data.items():
-            cid = int(k)
-            S[cid] = {"step":"idle", "budget":v.get("budget", DEFAULT_BUDGET),
-                      "store":v.get("store", {}), "outbox":[]}
-    except Exception:
-        pass
-
-def save_all():
-    data = {str(cid): {"budget": s.get("budget", DEFAULT_BUDGET),
-                       "store": s.get("store", {})}
-            for cid,s in S.items()}
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # los chats se cargan bajo demanda en st()
+    DB.load()
+
+def save_all(cid=None):
+    # Solo marca sucio: el backend coalesce y escribe en segundo plano
+    for k in ([cid] if cid is not None else list(S)):
+        DB.mark(k)
+
+def _evictable(s, limit):
+    # el paso de la conversación no se persiste: un chat abandonado a mitad de
+    # un flujo se desaloja igual y su próximo update arranca desde idle (los
+    # botones de un resumen viejo ya responden "no está vigente")
+    return (s.get("_seen", 0) < limit and not s.get("_busy")
+            and not any(j["status"] in ("queued", "running") for j in s.get("jobs", {}).values()))
+
+def evict_idle():
+    """Saca de memoria los chats inactivos (ya persistidos) y outboxes vencidos."""
+    while True:
+        time.sleep(60)
+        limit = time.monotonic() - CHAT_IDLE_TTL
+        idle = [cid for cid, s in list(S.items()) if _evictable(s, limit)]
+        if idle:
+            DB.flush()
+            with S_LOCK:
+                for cid in idle:
+                    if cid in S and _evictable(S[cid], limit):
+                        del S[cid]
+                        DB.forget(cid)
+        old = time.time() - DELETE_WINDOW
+        for cid, ob in list(OUTBOX.items()):
+            if cid not in S and (not ob or ob[-1][1] < old):
+                OUTBOX.pop(cid, None)
 
 load_all()
+threading.Thread(target=evict_idle, name="evict-idle", daemon=True).start()
+
+def track_sent(cid, mid):
+    ob = st(cid)["outbox"]
+    ob.append((mid, time.time()))
+    # descarta por la cabeza lo que ya no se puede borrar
+    limit = time.time() - DELETE_WINDOW
+    while ob and ob[0][1] < limit:
+        ob.popleft()
+
+def _bulk_delete(cid, ids):
+    deleted = 0
+    for i in range(0, len(ids), 100):
+        chunk = ids[i:i+100]
+        try:
+            with track(TG_CALLS, TG_ERRORS, "deleteMessages"):
+                bot.delete_messages(cid, chunk)
+            deleted += len(chunk)
+        except Exception as e:
+            print("delete_messages() error:", repr(e))
+    send(cid, f"🧹 Listo, limpié {deleted} mensajes del bot. Usa /start.")
+
+def reset_chat(cid):
+    """Vacía el outbox y borra en segundo plano con deleteMessages (lotes de 100)."""
+    ob = st(cid)["outbox"]
+    limit = time.time() - DELETE_WINDOW
+    ids = [mid for mid, ts in ob if ts >= limit]
+    ob.clear()
+    threading.Thread(target=_bulk_delete, args=(cid, ids), daemon=True).start()
+
+# Las líneas viajan en callback_data como ids cortos internados en el estado
+# del chat (line_ids: id -> nombre); nunca se reutiliza un id.
+def _line_rev(state):
+    ids = state.setdefault("line_ids", {})
+    rev = state.get("_line_rev")
+    if rev is None or len(rev) != len(ids):
+        rev = state["_line_rev"] = {v: k for k, v in ids.items()}
+    return rev
+
+def line_id(cid, line):
+    state = st(cid)
+    with state["_ids"]:
+        rev = _line_rev(state)
+        lid = rev.get(line)
+        if lid is None:
+            n = state.get("next_lid", 1)
+            lid = format(n, "x")
+            state["next_lid"] = n + 1
+            state["line_ids"][lid] = line
+            rev[line] = lid
+            save_all(cid)
+    return lid
+
+def line_name(cid, lid):
+    state = st(cid)
+    line = state.get("line_ids", {}).get(lid)
+    return line if line in state["store"] else None
+
+def forget_line(cid, line):
+    """Borra la línea del store junto con sus ids (de línea y de anuncios)."""
+    state = st(cid)
+    with state["_ids"]:
+        lid = _line_rev(state).pop(line, None)
+        state["line_ids"].pop(lid, None)
+        index = state["_ad_line"]
+        for aid in state["store"].pop(line, {}).get("ads", {}):
+            index.pop(aid, None)
+
+# Cada anuncio tiene un id local estable (hex, único en el chat y nunca
+# reutilizado): store[línea]["ads"] es {id: anuncio} en orden de alta y
+# _ad_line (derivado, no se persiste; se arma al cargar el chat) da la línea
+# de cada id. Altas y bajas van bajo el lock _ids del chat: la importación y
+# los jobs de publicación agregan anuncios al mismo chat desde varios hilos.
+def _ad_lines(store):
+    return {aid: line for line, entry in store.items() for aid in entry.get("ads", {})}
+
+def add_ad(cid, line, ad):
+    state = st(cid)
+    with state["_ids"]:
+        n = state.get("next_aid", 1)
+        aid = format(n, "x")
+        state["next_aid"] = n + 1
+        state["store"].setdefault(line, {"ads": {}})["ads"][aid] = ad
+        state["_ad_line"][aid] = line
+    return aid
+
+def find_ad(state, aid):
+    """(línea, anuncio) o (None, None) si el id ya no existe."""
+    line = state["_ad_line"].get(aid)
+    ad = state["store"].get(line, {}).get("ads", {}).get(aid)
+    return (line, ad) if ad is not None else (None, None)
+
+def remove_ad(state, aid):
+    with state["_ids"]:
+        line = state["_ad_line"].pop(aid, None)
+        return state["store"].get(line, {}).get("ads", {}).pop(aid, None)
+
+# Envíos y ediciones salen por una cola con límites de Telegram (~30/s global,
+# ~1/s por chat); los errores se registran allá.
+OUT = SendQueue(bot, on_sent=lambda cid, m: track_sent(cid, m.message_id),
+                timer=lambda method: track(TG_CALLS, TG_ERRORS, method),
+                on_throttle=TG_THROTTLED.inc,
+                # el límite global de Telegram se reparte entre los workers
+                global_rate=float(os.getenv("TG_GLOBAL_RATE", 30)) / (PROCS if ROLE == "worker" else 1),
+                chat_rate=float(os.getenv("TG_CHAT_RATE", 1)),
+                chat_burst=int(os.getenv("TG_CHAT_BURST", 3)))
+Gauge("bot_telegram_send_queue", "Mensajes en cola de salida", OUT.pending)
 
 def send(cid, text, **kw):
-    try:
-        m = bot.send_message(cid, text, **kw)
-        st(cid)["outbox"].append(m.message_id)
-        return m
-    except Exception as e:
-        print("send() error:", repr(e))
-        print(traceback.format_exc())
+    """Encola el mensaje; devuelve un Future con el Message enviado."""
+    return OUT.send(cid, text, **kw)
 
 def send_md(cid, text, **kw):
     kw.setdefault("parse_mode", "Markdown")
     return send(cid, text, **kw)
 
+_MD_SPECIAL = re.compile(r"([_*`\[])")
+
+def md(text):
+    """Escapa texto libre (del usuario o de Meta) para parse_mode="Markdown".
+    Solo sirve fuera de entidades: dentro de *…* o `…` no hay escape posible."""
+    return _MD_SPECIAL.sub(r"\\\1", str(text))
+
+EDIT_TIMEOUT = 30
+
+def edit(cid, mid, text, wait=True, **kw):
+    """wait=False: solo encola (ediciones de progreso; se pisan entre sí si no salieron)."""
+    fut = OUT.edit(cid, mid, text, **kw)
+    if not wait:
+        return fut
+    try:
+        return fut.result(timeout=EDIT_TIMEOUT)
+    except Exception as e:
+        if "message is not modified" in str(e):
+            return True
+        print("edit() error:", repr(e))
+
+def show(c, text, **kw):
+    """Reemplaza el mensaje del botón pulsado; si no se puede editar, envía uno nuevo."""
+    cid = c.message.chat.id
+    if edit(cid, c.message.message_id, text, **kw) is None:
+        return send(cid, text, **kw)
+
 # =====================
 # Menús
 # =====================
+def answer_cb(c, text=None):
+    with track(TG_CALLS, TG_ERRORS, "answerCallbackQuery"):
+        bot.answer_callback_query(c.id, text)
+
+router = Router(answer_cb, observe=CB_SECONDS.observe)
+cb = Router.cb
+
 def home_menu():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
-        types.InlineKeyboardButton("➕ Nueva campaña", callback_data="new_line"),
-        types.InlineKeyboardButton("🗂️ Mis líneas", callback_data="lines"),
+        types.InlineKeyboardButton("➕ Nueva campaña", callback_data=cb("n")),
+        types.InlineKeyboardButton("🗂️ Mis líneas", callback_data=cb("ls")),
     )
     kb.add(
-        types.InlineKeyboardButton("📊 Métricas", callback_data="metrics"),
-        types.InlineKeyboardButton("💰 Presupuesto", callback_data="budget"),
+        types.InlineKeyboardButton("📊 Métricas", callback_data=cb("m")),
+        types.InlineKeyboardButton("💰 Presupuesto", callback_data=cb("b")),
     )
     kb.add(
-        types.InlineKeyboardButton("⚙️ Configuración", callback_data="settings"),
-        types.InlineKeyboardButton("🧹 Reset", callback_data="reset_confirm"),
+        types.InlineKeyboardButton("⚙️ Configuración", callback_data=cb("s")),
+        types.InlineKeyboardButton("🧹 Reset", callback_data=cb("rc")),
     )
-    kb.add(types.InlineKeyboardButton("❓Ayuda", callback_data="help"))
+    kb.add(types.InlineKeyboardButton("❓Ayuda", callback_data=cb("?")))
+    return kb
+
+def back_kb(action, *args):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb(action, *args)))
     return kb
 
 def lines_kb(cid):
     store = st(cid)["store"]
     kb = types.InlineKeyboardMarkup(row_width=1)
     if not store:
-        kb.add(types.InlineKeyboardButton("— No hay líneas —", callback_data="noop"))
+        kb.add(types.InlineKeyboardButton("— No hay líneas —", callback_data=cb("x")))
     else:
         for ln in sorted(store.keys()):
-            count = len(store[ln].get("ads", []))
-            kb.add(types.InlineKeyboardButton(f"🗂️ {ln} ({count})", callback_data=f"open_line::{ln}"))
-    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data="home"))
+            count = len(store[ln].get("ads", {}))
+            kb.add(types.InlineKeyboardButton(f"🗂️ {ln} ({count})", callback_data=cb("ol", line_id(cid, ln))))
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("h")))
     return kb
 
-def line_detail_kb(line):
+def line_detail_kb(cid, line):
+    lid = line_id(cid, line)
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
-        types.InlineKeyboardButton("📋 Ver anuncios", callback_data=f"view_ads::{line}"),
-        types.InlineKeyboardButton("🗑️ Eliminar línea", callback_data=f"del_line::{line}"),
+        types.InlineKeyboardButton("📋 Ver anuncios", callback_data=cb("va", lid)),
+        types.InlineKeyboardButton("🗑️ Eliminar línea", callback_data=cb("dl", lid)),
+    )
+    kb.add(
+        types.InlineKeyboardButton("▶️ Activar todo", callback_data=cb("lst", lid, "ACTIVE")),
+        types.InlineKeyboardButton("⏸ Pausar todo", callback_data=cb("lst", lid, "PAUSED")),
     )
-    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data="lines"))
+    kb.add(types.InlineKeyboardButton("🕒 Horario", callback_data=cb("hl", lid)))
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("ls")))
     return kb
 
-def ads_kb(line, store):
-    kb = types.InlineKeyboardMarkup(row_width=1)
-    ads = store.get(line,{}).get("ads",[])
+ADS_PAGE = 8
+
+def ads_page(ads, page):
+    """(página, páginas, [(n, id, anuncio)]) de la página pedida."""
+    pages = max(1, -(-len(ads) // ADS_PAGE))
+    page = min(max(0, page), pages - 1)
+    start = page * ADS_PAGE
+    items = itertools.islice(ads.items(), start, start + ADS_PAGE)
+    return page, pages, [(start + n + 1, aid, ad) for n, (aid, ad) in enumerate(items)]
+
+def ads_kb(cid, line, page=0):
+    lid = line_id(cid, line)
+    kb = types.InlineKeyboardMarkup(row_width=3)
+    ads = st(cid)["store"].get(line,{}).get("ads",{})
     if not ads:
-        kb.add(types.InlineKeyboardButton("— Sin anuncios —", callback_data="noop"))
+        kb.add(types.InlineKeyboardButton("— Sin anuncios —", callback_data=cb("x")))
     else:
-        for i, ad in enumerate(ads, 1):
+        page, pages, items = ads_page(ads, page)
+        for n, aid, ad in items:
             title = ad.get("title","(sin título)")
-            kb.add(types.InlineKeyboardButton(f"{i}. {title[:42]}  ⏯ / 🗑", callback_data=f"ad_menu::{line}::{i-1}"))
-    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=f"open_line::{line}"))
+            kb.row(types.InlineKeyboardButton(f"{n}. {title[:42]}  ⏯ / 🗑", callback_data=cb("ao", aid, page)))
+        if pages > 1:
+            kb.row(
+                types.InlineKeyboardButton("◀️", callback_data=cb("va", lid, page-1) if page else cb("x")),
+                types.InlineKeyboardButton(f"{page+1}/{pages}", callback_data=cb("x")),
+                types.InlineKeyboardButton("▶️", callback_data=cb("va", lid, page+1) if page < pages-1 else cb("x")),
+            )
+    kb.row(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("ol", lid)))
     return kb
 
-def ad_item_kb(line, idx):
+def ads_text(cid, line, page=0):
+    ads = st(cid)["store"].get(line,{}).get("ads",{})
+    if not ads:
+        return "— Sin anuncios —"
+    page, pages, items = ads_page(ads, page)
+    # títulos y estados (WITH_ISSUES, CAMPAIGN_PAUSED…) van escapados y fuera
+    # de *…*: un "_" o "*" suelto haría que Telegram rechace la lista entera
+    out = [f"📋 Anuncios de {md(line)} ({len(ads)})"]
+    for n, aid, ad in items:
+        meta = ad.get("meta", {})
+        out.append(f"{n}. {md(ad.get('title','(sin título)'))} — {md(status_label(meta))}"
+                   f" · {md(meta.get('cpm_msg', '—'))}")
+    return "\n".join(out)
+
+def status_label(meta):
+    """Estado configurado y, si Meta reporta otro efectivo, también ese."""
+    status, eff = meta.get("status", "—"), meta.get("effective_status")
+    return f"{status} (⚠️ {eff})" if eff and eff != status else status
+
+def ad_text(ad):
+    meta = ad.get("meta", {})
+    return (f"*{ad.get('title','(sin título)')}*\n{ad.get('desc','')}\n"
+            f"Ad ID: `{meta.get('ad_id','—')}`\n"
+            f"Estado: {status_label(meta)}\n"
+            f"Costo por mensaje: {meta.get('cpm_msg', '—')}")
+
+def ad_item_kb(cid, line, aid, page=0):
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
-        types.InlineKeyboardButton("⏯ Activar/Pausar", callback_data=f"ad_toggle::{line}::{idx}"),
-        types.InlineKeyboardButton("🗑 Eliminar anuncio", callback_data=f"del_ad::{line}::{idx}"),
+        types.InlineKeyboardButton("⏯ Activar/Pausar", callback_data=cb("ap", aid, page)),
+        types.InlineKeyboardButton("🗑 Eliminar anuncio", callback_data=cb("ax", aid, page)),
     )
-    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=f"view_ads::{line}"))
+    kb.add(types.InlineKeyboardButton("🕒 Horario", callback_data=cb("ah", aid, page)))
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("va", line_id(cid, line), page)))
+    return kb
+
+def metrics_kb():
+    kb = types.InlineKeyboardMarkup(row_width=3)
+    kb.add(*[types.InlineKeyboardButton(w, callback_data=cb("mw", w)) for w in insights.WINDOWS])
+    kb.add(types.InlineKeyboardButton("📤 Exportar CSV", callback_data=cb("ex")))
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("h")))
     return kb
 
 # =====================
 # Meta helpers
 # =====================
-def fb_init():
-    if not (FB_ACCESS_TOKEN and FB_AD_ACCOUNT_ID and FB_PAGE_ID and FB_WABA_PHONE):
-        raise RuntimeError("Faltan variables FB_* para Meta.")
-    from facebook_business.api import FacebookAdsApi
-    FacebookAdsApi.init(access_token=FB_ACCESS_TOKEN, api_version=FB_API_VERSION)
-    from facebook_business.adobjects.adaccount import AdAccount
-    return AdAccount(FB_AD_ACCOUNT_ID)
-
-def publish_to_meta(line, title, desc, budget_cop, activate_now):
-    from facebook_business.adobjects.campaign import Campaign
-    from facebook_business.adobjects.adset import AdSet
-    from facebook_business.adobjects.adcreative import AdCreative
-    from facebook_business.adobjects.ad import Ad
-
-    account = fb_init()
+MEDIA = MediaPipeline(bot, TG_TOKEN, os.getenv("MEDIA_CACHE", "media_cache.json"))
+
+# Cuenta por chat (⚙️ Configuración) o, si no hay, la de las variables FB_*.
+# El token del chat se guarda cifrado; los clientes Graph se comparten por
+# ad account en un pool LRU, cada uno con su propio presupuesto de uso.
+SEALER  = Sealer(os.getenv("STATE_KEY"))
+CLIENTS = ClientPool(FB_API_VERSION, maxsize=int(os.getenv("META_POOL", 32)))
+ENV_ACCOUNT = {"token": FB_ACCESS_TOKEN, "account_id": FB_AD_ACCOUNT_ID,
+               "page_id": FB_PAGE_ID, "waba_phone": FB_WABA_PHONE}
+Gauge("bot_meta_usage_pct", "Último % de uso reportado por Meta", CLIENTS.usage, ("account",))
+
+def account_from(fb):
+    """Cuenta a partir del campo fb del estado (token cifrado) o la de FB_*."""
+    if not fb:
+        return ENV_ACCOUNT
+    return {**fb, "token": SEALER.unseal(fb["token"])}
+
+def chat_account(cid):
+    return account_from(st(cid).get("fb"))
+
+def fb_require(acc):
+    """Cliente Graph de la cuenta; falla si la cuenta está incompleta."""
+    if not all(acc.get(k) for k in FB_FIELDS):
+        raise RuntimeError("Falta configurar la cuenta Meta (⚙️ Configuración o variables FB_*).")
+    return CLIENTS.get(acc["account_id"], acc["token"])
+
+PUBLISH_STEPS = {"media": "Media", "campaign": "Campaña", "adset": "Ad Set", "creative": "Creativo", "ad": "Anuncio"}
+
+class PublishError(RuntimeError):
+    def __init__(self, step, message):
+        super().__init__(f"{PUBLISH_STEPS.get(step, step)}: {message}")
+        self.step = step
+
+def story_spec(acc, title, desc, asset=None):
+    """object_story_spec del creativo: video_data si hay video, si no link_data (con imagen si hay)."""
+    cta = {"type": "WHATSAPP_MESSAGE"}
+    if asset and asset.get("video_id"):
+        video = {"video_id": asset["video_id"], "title": title, "message": desc, "call_to_action": cta}
+        if asset.get("image_hash"):
+            video["image_hash"] = asset["image_hash"]
+        return {"page_id": acc["page_id"], "video_data": video}
+    link = {"message": desc, "name": title, "call_to_action": cta, "link": "https://www.facebook.com"}
+    if asset and asset.get("image_hash"):
+        link["image_hash"] = asset["image_hash"]
+    return {"page_id": acc["page_id"], "link_data": link}
+
+def publish_ops(account, line, title, desc, budget_cop, status, dest="destination_type",
+                campaign_id=None, adset_id=None, creative_id=None, asset=None):
+    acc = account["account_id"]
+    ops = []
+    if campaign_id is None:
+        ops.append(batch_op("campaign", "POST", f"{acc}/campaigns", {
+            "name": f"Línea - {line}",
+            "objective": "MESSAGES",
+            "configured_status": status,
+            "special_ad_categories": [],
+        }))
+        campaign_id = "{result=campaign:$.id}"
+    if adset_id is None:
+        ops.append(batch_op("adset", "POST", f"{acc}/adsets", {
+            "name": f"AdSet - {line}",
+            "campaign_id": campaign_id,
+            "daily_budget": max(1000, int(budget_cop)),
+            "billing_event": "IMPRESSIONS",
+            "optimization_goal": "LEAD_GENERATION",
+            "promoted_object": {"page_id": account["page_id"], "whatsapp_phone_number": account["waba_phone"]},
+            "targeting": {"geo_locations": {"countries": ["CO"]}, "age_min": 18, "age_max": 65},
+            "configured_status": status,
+            dest: "WHATSAPP",
+        }))
+        adset_id = "{result=adset:$.id}"
+    if creative_id is None:
+        # Creativo (CTA WhatsApp)
+        ops.append(batch_op("creative", "POST", f"{acc}/adcreatives", {
+            "name": f"Creative - {line}",
+            "object_story_spec": story_spec(account, title, desc, asset),
+        }))
+        creative_id = "{result=creative:$.id}"
+    ops.append(batch_op("ad", "POST", f"{acc}/ads", {
+        "name": f"Ad - {line}",
+        "adset_id": adset_id,
+        "creative": {"creative_id": creative_id},
+        "configured_status": status,
+    }))
+    return ops
+
+def _run_publish(client, ops):
+    created, failed = {}, None
+    with track(META_CALLS, META_ERRORS, "publish_batch"):
+        results = client.batch(ops)
+    for op, (code, body) in zip(ops, results):
+        if code == 200 and isinstance(body, dict) and body.get("id"):
+            created[op["name"]] = body["id"]
+        elif failed is None:
+            err = body.get("error", {}) if isinstance(body, dict) else {}
+            failed = (op["name"], err.get("error_user_msg") or err.get("message") or "no se ejecutó")
+    return created, failed
+
+def delete_objects(client, ids):
+    if not ids:
+        return
+    try:
+        with track(META_CALLS, META_ERRORS, "cleanup"):
+            client.batch([batch_op(f"del{i}", "DELETE", oid) for i, oid in enumerate(ids)])
+    except Exception as e:
+        print("delete_objects() error:", repr(e), ids)
+
+def _stages(ops, created, failed):
+    return {op["name"]: "ok" if op["name"] in created else
+            "fail" if failed and failed[0] == op["name"] else "skip" for op in ops}
+
+DEAD_STATUSES = {"DELETED", "ARCHIVED"}
+
+def reusable_parents(client, campaign_id, adset_id, activate_now):
+    """Comprueba en un solo GET multi-id que la campaña y el ad set guardados de la
+    línea siguen vivos. Devuelve (campaign_id, adset_id) con None en lo que hay que
+    crear de nuevo. Si se publica activo, reactiva los padres que estén en pausa."""
+    ids = [i for i in (campaign_id, adset_id) if i]
+    if not ids:
+        return None, None
+    with track(META_CALLS, META_ERRORS, "line_parents"):
+        found = client.get_many(ids, fields="id,effective_status,configured_status")
+    alive = {i for i, o in (found or {}).items()
+             if isinstance(o, dict) and o.get("effective_status") not in DEAD_STATUSES}
+    if campaign_id not in alive:
+        # sin campaña no sirve el ad set que colgaba de ella
+        return None, None
+    if adset_id not in alive:
+        adset_id = None
+    if activate_now:
+        for oid in (campaign_id, adset_id):
+            if oid and found[oid].get("configured_status") != "ACTIVE":
+                with track(META_CALLS, META_ERRORS, "toggle_status"):
+                    client.post(oid, status="ACTIVE")
+    return campaign_id, adset_id
+
+def publish_to_meta(acc, line, title, desc, budget_cop, activate_now, media=None, on_progress=None,
+                    campaign_id=None, adset_id=None):
+    """acc: cuenta Meta (chat_account). on_progress(stages) recibe {paso: 'run'|'ok'|'fail'|'skip'}
+    tras cada round-trip. campaign_id/adset_id: los de la línea, si ya tiene; se reutilizan si siguen vivos."""
+    client = fb_require(acc)
     status = 'ACTIVE' if activate_now else 'PAUSED'
+    report = on_progress or (lambda stages: None)
+    campaign_id, adset_id = reusable_parents(client, campaign_id, adset_id, activate_now)
+    reused = {k: v for k, v in (("campaign", campaign_id), ("adset", adset_id)) if v}
+    if reused:
+        report({k: "ok" for k in reused})
+
+    asset = None
+    if media:
+        report({"media": "run"})
+        try:
+            with track(META_CALLS, META_ERRORS, "media_upload"):
+                asset = MEDIA.resolve(client, acc["account_id"], media)
+        except Exception as e:
+            report({"media": "fail"})
+            raise PublishError("media", str(e))
+        report({"media": "ok"})
+
+    # campaña -> adset -> creativo -> ad en un solo round-trip (solo lo que falte)
+    ops = publish_ops(acc, line, title, desc, budget_cop, status, campaign_id=campaign_id,
+                      adset_id=adset_id, asset=asset)
+    report({op["name"]: "run" for op in ops})
+    created, failed = _run_publish(client, ops)
+    report(_stages(ops, created, failed))
+    if failed and failed[0] == "adset" and (campaign_id or "campaign" in created):
+        # algunas versiones no aceptan destination_type: reintenta el tramo restante
+        ops = publish_ops(acc, line, title, desc, budget_cop, status,
+                          dest="message_destination", campaign_id=campaign_id or created["campaign"],
+                          creative_id=created.get("creative"), asset=asset)
+        report({op["name"]: "run" for op in ops})
+        created_retry, failed = _run_publish(client, ops)
+        created.update(created_retry)
+        report(_stages(ops, created, failed))
+    if failed:
+        # limpia lo creado a medias, del hijo al padre (lo reutilizado de la línea no se toca)
+        delete_objects(client, [created[k] for k in ("ad", "creative", "adset", "campaign") if k in created])
+        raise PublishError(*failed)
+    return {"campaign_id": campaign_id or created["campaign"], "adset_id": adset_id or created["adset"],
+            "status": status, "ad_id": created["ad"]}
+
+def toggle_ad_status(client, ad_id, new_status):
+    # new_status: 'ACTIVE' or 'PAUSED'
+    with track(META_CALLS, META_ERRORS, "toggle_status"):
+        return client.post(ad_id, status=new_status)
+
+def fmt_cop(v):
+    return "—" if v is None else f"{v:,.0f} COP"
 
-    # 1) Campaña
-    campaign = account.create_campaign(params={
-        Campaign.Field.name: f"Línea - {line}",
-        Campaign.Field.objective: 'MESSAGES',
-        Campaign.Field.configured_status: status
-    })
-    campaign_id = campaign[Campaign.Field.id]
-
-    # 2) AdSet
-    params = {
-        AdSet.Field.name: f"AdSet - {line}",
-        AdSet.Field.campaign_id: campaign_id,
-        AdSet.Field.daily_budget: max(1000, int(budget_cop)),
-        AdSet.Field.billing_event: 'IMPRESSIONS',
-        AdSet.Field.optimization_goal: 'LEAD_GENERATION',
-        AdSet.Field.promoted_object: {'page_id': FB_PAGE_ID, 'whatsapp_phone_number': FB_WABA_PHONE},
-        AdSet.Field.targeting: {'geo_locations': {'countries': ['CO']}, 'age_min': 18, 'age_max': 65},
-        AdSet.Field.configured_status: status,
-    }
+def metrics_report(cid, window):
+    """Resumen por línea y rellena meta['cpm_msg'] de cada anuncio del chat."""
+    acc = chat_account(cid)
+    client = fb_require(acc)
+    store = st(cid)["store"]
+    n_ads = sum(len(v.get("ads", {})) for v in store.values())
+    with track(META_CALLS, META_ERRORS, "insights"):
+        rows = insights.get(client, acc["account_id"], window, n_ads)
+    out = [f"📊 *Métricas {window}*"]
+    for ln in sorted(store):
+        line_rows = []
+        for ad in store[ln].get("ads", {}).values():
+            m = ad.get("meta", {})
+            r = rows.get(m.get("ad_id"))
+            if r:
+                line_rows.append(r)
+                m["cpm_msg"] = f"{fmt_cop(r['cost_per_msg'])} ({window})"
+        tot = insights.summarize(line_rows)
+        out.append(f"\n*{ln}*\nGasto: {fmt_cop(tot['spend'])} · Mensajes: {tot['messages']}"
+                   f"\nCosto por mensaje: {fmt_cop(tot['cost_per_msg'])}")
+    if len(out) == 1:
+        out.append("No hay líneas aún.")
+    save_all(cid)
+    return "\n".join(out)
+
+def set_ads_status(client, ad_ids, new_status, chunk=50, concurrency=4):
+    """Cambia el estado de muchos anuncios con batches de Graph en paralelo acotado.
+    Devuelve {ad_id: None si OK | mensaje de error}."""
+    def run(ids):
+        try:
+            with track(META_CALLS, META_ERRORS, "bulk_status"):
+                res = client.batch([batch_op(f"ad{n}", "POST", ad_id, {"status": new_status})
+                                  for n, ad_id in enumerate(ids)])
+        except MetaError as e:
+            return {ad_id: str(e) for ad_id in ids}
+        out = {}
+        for ad_id, (code, body) in zip(ids, res):
+            err = body.get("error", {}) if isinstance(body, dict) else {}
+            out[ad_id] = None if code == 200 and not err else (err.get("message") or f"HTTP {code}")
+        return out
+
+    chunks = [ad_ids[i:i+chunk] for i in range(0, len(ad_ids), chunk)]
+    results = {}
+    if not chunks:
+        return results
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as ex:
+        for part in ex.map(run, chunks):
+            results.update(part)
+    return results
+
+# =====================
+# Presupuestos por línea
+# =====================
+# Cada línea guarda su presupuesto diario (store[línea]["budget"]; si no tiene,
+# vale el del chat). Al editarlo se espera BUDGET_DEBOUNCE segundos: si llegan
+# más ediciones de la misma línea solo sale la última, en un único batch a
+# todos los ad sets de la línea.
+BUDGET_DEBOUNCE = float(os.getenv("BUDGET_DEBOUNCE", 5))
+_budget_timers = {}            # (cid, línea) -> Timer pendiente
+_budget_lock = threading.Lock()
+
+def line_budget(state, line):
+    return state["store"].get(line, {}).get("budget") or state.get("budget", DEFAULT_BUDGET)
+
+def line_adsets(entry):
+    """Ad sets de la línea: el actual y los que quedaron en anuncios anteriores."""
+    ids = dict.fromkeys(a["meta"]["adset_id"] for a in entry.get("ads", {}).values() if a.get("meta", {}).get("adset_id"))
+    if entry.get("adset_id"):
+        ids[entry["adset_id"]] = None
+    return list(ids)
+
+def set_adsets_budget(client, adset_ids, budget_cop, chunk=50):
+    """daily_budget en todos los ad sets, un batch por cada 50. {adset_id: None | error}."""
+    out = {}
+    for i in range(0, len(adset_ids), chunk):
+        ids = adset_ids[i:i+chunk]
+        with track(META_CALLS, META_ERRORS, "adset_budget"):
+            res = client.batch([batch_op(f"as{n}", "POST", oid, {"daily_budget": max(1000, int(budget_cop))})
+                                for n, oid in enumerate(ids)])
+        for oid, (code, body) in zip(ids, res):
+            err = body.get("error", {}) if isinstance(body, dict) else {}
+            out[oid] = None if code == 200 and not err else (err.get("message") or f"HTTP {code}")
+    return out
+
+def push_line_budget(cid, line):
+    with _budget_lock:
+        _budget_timers.pop((cid, line), None)
+    state = st(cid)
+    entry = state["store"].get(line)
+    ids = line_adsets(entry) if entry else []
+    if not ids:
+        return   # aún no hay nada en Meta: la próxima publicación ya usa el valor nuevo
+    budget = line_budget(state, line)
     try:
-        params['destination_type'] = 'WHATSAPP'
-        adset = account.create_ad_set(params=params)
-    except Exception:
-        params.pop('destination_type', None)
-        params['message_destination'] = 'WHATSAPP'
-        adset = account.create_ad_set(params=params)
-    adset_id = adset[AdSet.Field.id]
-
-    # 3) Creativo (CTA WhatsApp)
-    creative = account.create_ad_creative(params={
-        AdCreative.Field.name: f"Creative - {line}",
-        AdCreative.Field.object_story_spec: {
-            'page_id': FB_PAGE_ID,
-            'link_data': {
-                'message': desc,
-                'name': title,
-                'call_to_action': {'type': 'WHATSAPP_MESSAGE'},
-                'link': 'https://www.facebook.com'
-            }
-        }
-    })
-    creative_id = creative[AdCreative.Field.id]
-
-    # 4) Ad
-    ad = account.create_ad(params={
-        Ad.Field.name: f"Ad - {line}",
-        Ad.Field.adset_id: adset_id,
-        Ad.Field.creative: {'creative_id': creative_id},
-        Ad.Field.configured_status: status,
-    })
-    ad_id = ad[Ad.Field.id]
-    return {"campaign_id": campaign_id, "adset_id": adset_id, "status": status, "ad_id": ad_id}
-
-def toggle_ad_status(ad_id, new_status):
-    # new_status: 'ACTIVE' or 'PAUSED'
-    from facebook_business.api import FacebookAdsApi
-    from facebook_business.adobjects.ad import Ad
-    FacebookAdsApi.init(access_token=FB_ACCESS_TOKEN, api_version=FB_API_VERSION)
-    ad = Ad(ad_id)
-    return ad.api_update(params={"status": new_status, "configured_status": new_status})
+        results = set_adsets_budget(fb_require(chat_account(cid)), ids, budget)
+    except Exception as e:
+        print("push_line_budget() error:", repr(e))
+        send(cid, f"❌ No se pudo aplicar el presupuesto de {line} en Meta: {e}")
+        return
+    errors = [f"❌ {oid}: {err}" for oid, err in results.items() if err]
+    ok = len(results) - len(errors)
+    send(cid, "\n".join([f"💰 {line}: {budget:,} COP aplicado en {ok}/{len(results)} ad sets"] + errors))
+
+def schedule_budget_push(cid, line):
+    """Programa (o reprograma) el envío del presupuesto de la línea a Meta."""
+    key = (cid, line)
+    t = threading.Timer(BUDGET_DEBOUNCE, push_line_budget, args=key)
+    t.daemon = True
+    with _budget_lock:
+        old = _budget_timers.get(key)
+        if old:
+            old.cancel()
+        _budget_timers[key] = t
+    t.start()
+
+def live_budgets(cid):
+    """{línea: daily_budget en Meta} leyendo el ad set actual de cada línea en un GET multi-id."""
+    store = st(cid)["store"]
+    by_adset = {e["adset_id"]: ln for ln, e in store.items() if e.get("adset_id")}
+    if not by_adset:
+        return {}
+    with track(META_CALLS, META_ERRORS, "adset_budget_read"):
+        found = fb_require(chat_account(cid)).get_many(list(by_adset), fields="daily_budget")
+    # sin daily_budget el ad set usa presupuesto de campaña: se muestra el local
+    return {by_adset[oid]: int(o["daily_budget"]) for oid, o in found.items()
+            if oid in by_adset and isinstance(o, dict) and o.get("daily_budget")}
+
+# =====================
+# Horarios (dayparting)
+# =====================
+# state["schedules"] = {"lines": {línea: franjas}, "ads": {ad_id: franjas}}
+# (hora de Bogotá). El horario de un anuncio pisa el de su línea. El
+# Scheduler solo tiene el próximo cambio de cada horario; cuando vence, los
+# anuncios que deben cambiar se agrupan por cuenta y estado y salen con
+# set_ads_status (batches). Al arrancar cada horario vence de inmediato, así
+# se corrige lo que haya cambiado con el bot apagado.
+def schedule_key(cid, line=None, ad_id=None):
+    return ("a", cid, str(ad_id)) if ad_id else ("l", cid, line)
+
+def _schedule_of(state, key):
+    kind, _, ref = key
+    return state.get("schedules", {}).get("ads" if kind == "a" else "lines", {}).get(ref)
+
+def _schedule_targets(state, key):
+    """meta de los anuncios que gobierna el horario (con ad_id en Meta)."""
+    kind, _, ref = key
+    own = state.get("schedules", {}).get("ads", {})
+    for line, entry in state["store"].items():
+        if kind == "l" and line != ref:
+            continue
+        for ad in entry.get("ads", {}).values():
+            m = ad.get("meta", {})
+            ad_id = str(m.get("ad_id") or "")
+            if ad_id and (ad_id == ref if kind == "a" else ad_id not in own):
+                yield m
+
+def arm_schedule(key, windows, ts=None):
+    nxt = sched.next_change(windows, ts or time.time()) if windows else None
+    if nxt is None:
+        SCHED.remove(key)
+    else:
+        SCHED.set(key, nxt[0])
+
+def run_schedules(due):
+    """Callback del Scheduler: aplica los cambios vencidos y reprograma."""
+    want = {}                           # (cuenta, token, estado) -> {ad_id: (cid, meta)}
+    for key, ts in due:
+        cid = key[1]
+        state = st(cid)
+        windows = _schedule_of(state, key)
+        if not windows:
+            continue                    # se quitó el horario o se borró la línea/anuncio
+        at = max(ts, time.time())
+        arm_schedule(key, windows, at)
+        status = "ACTIVE" if sched.is_open(windows, at) else "PAUSED"
+        try:
+            acc = chat_account(cid)
+        except RuntimeError as e:
+            print(f"horarios: chat {cid} sin cuenta utilizable:", e)
+            continue
+        for m in _schedule_targets(state, key):
+            if m.get("status") != status:
+                want.setdefault((acc["account_id"], acc["token"], status), {})[str(m["ad_id"])] = (cid, m)
+    for (account_id, token, status), ads in want.items():
+        results = set_ads_status(CLIENTS.get(account_id, token), list(ads), status)
+        failed = {}
+        for ad_id, err in results.items():
+            cid, m = ads[ad_id]
+            if err is None:
+                m["status"] = status
+                save_all(cid)
+            else:
+                failed.setdefault(cid, []).append(f"❌ {ad_id}: {err}")
+        for cid, errs in failed.items():
+            send(cid, "\n".join([f"🕒 Horario: no se pudo pasar a {status}"] + errs[:10]))
+        print(f"🕒 Horarios: {len(ads) - sum(map(len, failed.values()))}/{len(ads)} anuncios en {status}")
+
+SCHED = sched.Scheduler(run_schedules)
+
+def set_schedule(cid, key, windows):
+    """Guarda (o quita, con windows=None) un horario y lo aplica ya mismo."""
+    kind, _, ref = key
+    group = st(cid).setdefault("schedules", {}).setdefault("ads" if kind == "a" else "lines", {})
+    if windows:
+        group[ref] = windows
+        SCHED.set(key, time.time())
+    else:
+        group.pop(ref, None)
+        SCHED.remove(key)
+    save_all(cid)
+
+def load_schedules():
+    """Programa los horarios guardados (chats de este proceso), sin cargar los chats."""
+    n = 0
+    for cid in filter(owns, DB.cids(contains='"schedules":{"')):
+        s = S.get(cid)
+        rec = s if s is not None else (DB.get(cid) or {})
+        for kind, group in (("l", "lines"), ("a", "ads")):
+            for ref in rec.get("schedules", {}).get(group, {}):
+                SCHED.set((kind, cid, ref), time.time())
+                n += 1
+    if n:
+        print(f"🕒 {n} horarios programados")
+
+# =====================
+# Reconciliador de estados con Meta
+# =====================
+# Cada RECONCILE_EVERY segundos junta los ad_id de todos los chats (memoria y
+# backend), pide effective_status/configured_status con GET multi-id en tramos
+# de 50 repartidos en la primera mitad del ciclo, y escribe solo lo que cambió:
+# en memoria para chats cargados (un flush diferido) y con un único
+# patch_ads() para el resto.
+RECONCILE_EVERY = int(os.getenv("RECONCILE_EVERY", 900))   # 0 = apagado
+RECONCILE_CHUNK = 50
+
+def local_ads():
+    """{ad_id: (cid, meta)}; para chats cargados meta es el dict vivo."""
+    loaded = dict(S)
+    out = {ad_id: (cid, m) for cid, ad_id, m in DB.ad_metas() if cid not in loaded and owns(cid)}
+    for cid, s in loaded.items():
+        for entry in list(s.get("store", {}).values()):
+            for ad in list(entry.get("ads", {}).values()):
+                m = ad.get("meta", {})
+                if m.get("ad_id"):
+                    out[str(m["ad_id"])] = (cid, m)
+    return out
+
+def _accounts_by_chat(cids):
+    """cid -> cuenta; solo se lee del backend el campo fb de chats no cargados que tienen uno."""
+    custom = set(DB.cids(contains='"fb":{'))
+    out = {}
+    for cid in cids:
+        s = S.get(cid)
+        if s is not None:
+            fb = s.get("fb")
+        else:
+            fb = (DB.get(cid) or {}).get("fb") if cid in custom else None
+        try:
+            out[cid] = account_from(fb)
+        except RuntimeError as e:
+            print(f"reconcile: chat {cid} sin cuenta utilizable:", e)
+    return out
+
+def reconcile_once(spread=0.0):
+    """Sincroniza estados; devuelve cuántos anuncios cambiaron."""
+    local = local_ads()
+    accounts = _accounts_by_chat({cid for cid, _ in local.values()})
+    # tramos por cuenta: cada ad account va con su cliente (y su cupo de uso)
+    chunks = []
+    by_acc = {}
+    for ad_id, (cid, _) in local.items():
+        acc = accounts.get(cid)
+        if acc and all(acc.get(k) for k in FB_FIELDS):
+            by_acc.setdefault((acc["account_id"], acc["token"]), []).append(ad_id)
+    for (account_id, token), ids in by_acc.items():
+        chunks += [((account_id, token), ids[i:i+RECONCILE_CHUNK]) for i in range(0, len(ids), RECONCILE_CHUNK)]
+    changes = {}
+    for n, ((account_id, token), part) in enumerate(chunks):
+        if n and spread:
+            time.sleep(spread / len(chunks))
+        try:
+            with track(META_CALLS, META_ERRORS, "reconcile"):
+                remote = CLIENTS.get(account_id, token).get_many(
+                    part, chunk=RECONCILE_CHUNK, fields="effective_status,configured_status")
+        except MetaError as e:
+            print("reconcile_once() error:", repr(e))
+            continue
+        for ad_id, r in remote.items():
+            m = local[ad_id][1]
+            ch = {k: r[f] for k, f in (("status", "configured_status"), ("effective_status", "effective_status"))
+                  if r.get(f) and m.get(k) != r[f]}
+            if ch:
+                changes[ad_id] = ch
+    cold, dirty = {}, set()
+    for ad_id, ch in changes.items():
+        cid, m = local[ad_id]
+        if cid in S:
+            m.update(ch)
+            dirty.add(cid)
+        else:
+            cold[ad_id] = ch
+    for cid in dirty:
+        save_all(cid)
+    if cold:
+        DB.patch_ads(cold)
+    return len(changes)
+
+def reconcile_loop():
+    while True:
+        time.sleep(RECONCILE_EVERY)
+        try:
+            n = reconcile_once(spread=RECONCILE_EVERY / 2)
+            if n:
+                print(f"🔄 Reconciliador: {n} anuncios actualizados desde Meta")
+        except Exception as e:
+            print("reconcile_loop() error:", repr(e))
+            print(traceback.format_exc())
+
+if RECONCILE_EVERY > 0 and ROLE != "leader":
+    # en multi-proceso cada worker reconcilia solo sus chats
+    threading.Thread(target=reconcile_loop, name="reconcile", daemon=True).start()
 
 # =====================
 # Comandos
@@ -223,29 +982,20 @@ def start(m):
 
 @bot.message_handler(commands=['reset'])
 def reset_cmd(m):
-    cid = m.chat.id
-    deleted = 0
-    for mid in st(cid)["outbox"]:
-        try:
-            bot.delete_message(cid, mid); deleted += 1
-        except: pass
-    st(cid)["outbox"].clear()
-    send(cid, f"🧹 Listo, limpié {deleted} mensajes del bot. Usa /start.")
+    reset_chat(m.chat.id)
 
 @bot.message_handler(commands=['check_meta'])
 def cmd_check_meta(m):
     cid = m.chat.id
-    if not FB_ACCESS_TOKEN:
-        send(cid, "⚠️ Falta FB_ACCESS_TOKEN en las variables de entorno.")
-        return
     try:
-        url = f"https://graph.facebook.com/v{FB_API_VERSION}/me/adaccounts?access_token={FB_ACCESS_TOKEN}"
-        r = requests.get(url, timeout=20)
-        data = r.json()
-        if "error" in data:
-            err = data["error"]
-            send(cid, f"❌ Error Meta: {err.get('message','')}
-Código: {err.get('code','')}")
+        acc = chat_account(cid)
+        if not acc.get("token"):
+            send(cid, "⚠️ Falta el token de Meta: configúralo en ⚙️ Configuración o en FB_ACCESS_TOKEN.")
+            return
+        try:
+            data = CLIENTS.get(acc["account_id"], acc["token"]).get("me/adaccounts")
+        except MetaError as err:
+            send(cid, f"❌ Error Meta: {err}\nCódigo: {err.code or ''}")
             return
 
         cuentas = data.get("data", [])
@@ -253,13 +1003,11 @@ Código: {err.get('code','')}")
             send(cid, "ℹ️ Token válido pero no veo cuentas publicitarias. Revisa permisos o acceso del usuario/system user a la ad account.")
             return
 
-        msg = "✅ *Cuentas publicitarias vinculadas:*
-"
+        msg = "✅ *Cuentas publicitarias vinculadas:*\n"
         for c in cuentas:
             nombre = c.get("name", "Sin nombre")
             acc_id = c.get("id", "—")
-            msg += f"- {acc_id} ({nombre})
-"
+            msg += f"- {acc_id} ({nombre})\n"
         send_md(cid, msg)
 
     except Exception as e:
@@ -269,213 +1017,324 @@ Código: {err.get('code','')}")
 def whoami(m):
     cid = m.chat.id
     try:
-        r = requests.get(f"https://graph.facebook.com/v{FB_API_VERSION}/me?fields=id,name&access_token={FB_ACCESS_TOKEN}", timeout=20).json()
+        acc = chat_account(cid)
+        # las tres consultas en un solo round-trip
+        (_, r), (_, r2), (_, test) = CLIENTS.get(acc["account_id"], acc["token"]).batch([
+            batch_op("me", "GET", "me?fields=id,name"),
+            batch_op("page", "GET", "me?fields=id,name,category"),
+            batch_op("accounts", "GET", "me/adaccounts?limit=1"),
+        ])
+        r, r2, test = r or {}, r2 or {}, test or {}
         if "error" in r:
             send(cid, f"❌ Error: {r['error'].get('message','')}")
             return
-        r2 = requests.get(f"https://graph.facebook.com/v{FB_API_VERSION}/me?fields=id,name,category&access_token={FB_ACCESS_TOKEN}", timeout=20).json()
         node_hint = "Desconocido"
         if 'category' in r2:
             node_hint = "PAGE (token de página)"
-        else:
-            test = requests.get(f"https://graph.facebook.com/v{FB_API_VERSION}/me/adaccounts?limit=1&access_token={FB_ACCESS_TOKEN}", timeout=20).json()
-            if 'data' in test:
-                node_hint = "USER o SYSTEM_USER (válido para Ads)"
-        send(cid, f"👤 ID: {r.get('id')} | Nombre: {r.get('name')}
-🔎 Tipo inferido: {node_hint}")
+        elif 'data' in test:
+            node_hint = "USER o SYSTEM_USER (válido para Ads)"
+        send(cid, f"👤 ID: {r.get('id')} | Nombre: {r.get('name')}\n🔎 Tipo inferido: {node_hint}")
     except Exception as e:
         send(cid, f"❌ Error whoami: {e}")
 
 # =====================
 # Callback menu
 # =====================
+# Botones sin argumentos de mensajes enviados antes del router
+LEGACY = {"home": "h", "new_line": "n", "lines": "ls", "metrics": "m", "budget": "b",
+          "settings": "s", "reset_confirm": "rc", "reset_go": "rg", "help": "?", "noop": "x"}
+
 @bot.callback_query_handler(func=lambda c: True)
 def on_cb(c):
     try:
         cid = c.message.chat.id
-        data = c.data
-        state = st(cid)
-
-        if data == "home":
-            bot.answer_callback_query(c.id)
-            send(cid, "🏠 Menú principal", reply_markup=home_menu())
-
-        elif data == "new_line":
-            bot.answer_callback_query(c.id)
-            send_md(cid, "🧩 Escribe la *Línea de producto* (ej: short, conjunto):")
-            state["step"] = "new_line"
-
-        elif data == "lines":
-            bot.answer_callback_query(c.id)
-            send(cid, "🗂️ Tus líneas:", reply_markup=lines_kb(cid))
-
-        elif data.startswith("open_line::"):
-            _, line = data.split("::",1)
-            bot.answer_callback_query(c.id)
-            send_md(cid, f"📁 Línea: *{line}*", reply_markup=line_detail_kb(line))
-
-        elif data.startswith("view_ads::"):
-            _, line = data.split("::",1)
-            bot.answer_callback_query(c.id)
-            store = state["store"]
-            ads = store.get(line,{}).get("ads",[])
-            if not ads:
-                send(cid, "— Sin anuncios —", reply_markup=ads_kb(line, store))
-            else:
-                for i, ad in enumerate(ads, 1):
-                    meta = ad.get("meta", {})
-                    cost = meta.get("cpm_msg", "—")
-                    msg = (f"{i}. *{ad.get('title','(sin título)')}*
-"
-                           f"{ad.get('desc','')}
-"
-                           f"Ad ID: `{meta.get('ad_id','—')}`
-"
-                           f"Estado: {meta.get('status','—')}
-"
-                           f"Costo por mensaje: {cost}")
-                    send(cid, msg, parse_mode="Markdown", reply_markup=ad_item_kb(line, i-1))
-
-        elif data.startswith("ad_menu::"):
-            _, line, i = data.split("::",2)
-            bot.answer_callback_query(c.id)
-            i = int(i)
-            store = state["store"]
-            ad = store.get(line,{}).get("ads",[])[i]
-            meta = ad.get("meta", {})
-            cost = meta.get("cpm_msg", "—")
-            msg = (f"*{ad.get('title')}*
-{ad.get('desc')}
-"
-                   f"Ad ID: `{meta.get('ad_id','—')}`
-"
-                   f"Estado: {meta.get('status','—')}
-"
-                   f"Costo por mensaje: {cost}")
-            send(cid, msg, parse_mode="Markdown", reply_markup=ad_item_kb(line, i))
-
-        elif data.startswith("del_line::"):
-            _, line = data.split("::",1)
-            bot.answer_callback_query(c.id, "Eliminado")
-            store = state["store"]
-            if line in store: del store[line]; save_all()
-            send(cid, f"🗑️ Línea *{line}* eliminada.", parse_mode="Markdown", reply_markup=lines_kb(cid))
-
-        elif data.startswith("del_ad::"):
-            _, line, i = data.split("::",2)
-            bot.answer_callback_query(c.id, "Eliminado")
-            i = int(i)
-            store = state["store"]
-            ads = store.get(line,{}).get("ads",[])
-            if 0 <= i < len(ads):
-                ads.pop(i); save_all()
-            if not ads and line in store:
-                # si ya no hay anuncios, borra la línea entera
-                store.pop(line, None); save_all()
-            send(cid, "✅ Eliminado.", reply_markup=ads_kb(line, store))
-
-        elif data.startswith("ad_toggle::"):
-            _, line, i = data.split("::",2)
-            bot.answer_callback_query(c.id, "Procesando…")
-            i = int(i)
-            store = state["store"]
-            ad = store.get(line,{}).get("ads",[])[i]
-            meta = ad.get("meta", {})
-            ad_id = meta.get("ad_id")
-            current = meta.get("status", "PAUSED")
-            new_status = "ACTIVE" if current != "ACTIVE" else "PAUSED"
-            try:
-                toggle_ad_status(ad_id, new_status)
-                meta["status"] = new_status
-                save_all()
-                send(cid, f"⏯ Estado actualizado a **{new_status}** para `{ad_id}`", parse_mode="Markdown")
-            except Exception as e:
-                send(cid, f"❌ Error alternando estado: {e}")
-
-        elif data == "metrics":
-            bot.answer_callback_query(c.id)
-            send(cid, "📊 Métricas próximamente (24h / 7d / 28d).")
-
-        elif data == "budget":
-            bot.answer_callback_query(c.id)
-            store = state["store"]
-            if not store:
-                send(cid, "No hay líneas aún.")
-            else:
-                kb = types.InlineKeyboardMarkup(row_width=1)
-                for ln in sorted(store.keys()):
-                    kb.add(types.InlineKeyboardButton(f"{ln} — {state['budget']:,} COP", callback_data=f"budget_edit::{ln}"))
-                kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data="home"))
-                send(cid, "Selecciona la línea para editar presupuesto:", reply_markup=kb)
-
-        elif data.startswith("budget_edit::"):
-            _, line = data.split("::",1)
-            bot.answer_callback_query(c.id)
-            state["editing_line"] = line
-            send_md(cid, f"💰 Nuevo presupuesto (COP) para *{line}*:")
-            state["step"] = "edit_budget"
-
-        elif data == "settings":
-            bot.answer_callback_query(c.id)
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("🧾 Check Meta", callback_data="cfg_check_meta"))
-            send(cid,
-                "⚙️ Configuración
-"
-                f"• Cuenta: {FB_AD_ACCOUNT_ID}
-"
-                f"• Página: {FB_PAGE_ID}
-"
-                f"• WA: {FB_WABA_PHONE}
-"
-                f"• API: v{FB_API_VERSION}",
-                reply_markup=kb)
-
-        elif data == "cfg_check_meta":
-            bot.answer_callback_query(c.id, "Verificando Meta…")
-            class Dummy:  # reutiliza el handler
-                def __init__(self, chat_id): self.chat = type("C", (), {"id": chat_id})
-            cmd_check_meta(Dummy(cid))
-
-        elif data == "reset_confirm":
-            bot.answer_callback_query(c.id)
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("✅ Sí, limpiar", callback_data="reset_go"),
-                types.InlineKeyboardButton("❌ Cancelar", callback_data="home"))
-            send(cid, "¿Deseas limpiar los mensajes del bot en este chat?", reply_markup=kb)
-
-        elif data == "reset_go":
-            bot.answer_callback_query(c.id, "Limpiando...")
-            deleted = 0
-            for mid in st(cid)["outbox"]:
-                try: bot.delete_message(cid, mid); deleted += 1
-                except: pass
-            st(cid)["outbox"].clear()
-            send(cid, f"🧹 Listo, limpié {deleted} mensajes del bot. Usa /start.")
-
-        elif data == "help":
-            bot.answer_callback_query(c.id)
-            send(cid, "❓Ayuda
-1) ➕ Nueva campaña
-2) Completa línea, media, título y descripción
-3) Publica: 🟢 Activar o ⏸️ Pausada
-4) Gestiona desde 🗂️ Mis líneas")
-
-        elif data == "noop":
-            bot.answer_callback_query(c.id)
-
-        elif data.startswith("go_live_"):
-            # Fallback por si el handler específico no capturó
-            do_publish(c)
-
+        c.data = LEGACY.get(c.data, c.data)
+        if not router.dispatch(c, st(cid)):
+            answer_cb(c, "Menú desactualizado")
+            show(c, "🏠 Menú principal", reply_markup=home_menu())
     except Exception as e:
         print("on_cb() error:", repr(e))
         print(traceback.format_exc())
         try:
-            bot.answer_callback_query(c.id, "Error")
+            answer_cb(c, "Error")
         except: pass
         send(cid, f"❌ Error en callback: {e}")
 
+def _line(c, lid):
+    """Nombre de la línea del botón o None (y avisa) si ya no existe."""
+    cid = c.message.chat.id
+    line = line_name(cid, lid)
+    if line is None:
+        show(c, "Esa línea ya no existe.", reply_markup=lines_kb(cid))
+    return line
+
+def _ad(c, state, aid):
+    """(línea, anuncio) del botón o (None, None) (y avisa) si ya no existe."""
+    line, ad = find_ad(state, aid)
+    if ad is None:
+        show(c, "Ese anuncio ya no existe.", reply_markup=lines_kb(c.message.chat.id))
+    return line, ad
+
+@router.route("h")
+def cb_home(c, state):
+    show(c, "🏠 Menú principal", reply_markup=home_menu())
+
+@router.route("n")
+def cb_new_line(c, state):
+    show(c, "🧩 Escribe la *Línea de producto* (ej: short, conjunto):", parse_mode="Markdown")
+    state["step"] = "new_line"
+
+@router.route("ls")
+def cb_lines(c, state):
+    show(c, "🗂️ Tus líneas:", reply_markup=lines_kb(c.message.chat.id))
+
+@router.route("ol")
+def cb_open_line(c, state, lid):
+    line = _line(c, lid)
+    if line is not None:
+        windows = state.get("schedules", {}).get("lines", {}).get(line)
+        extra = f"\n🕒 {sched.format_windows(windows)}" if windows else ""
+        show(c, f"📁 Línea: *{line}*{extra}", parse_mode="Markdown",
+             reply_markup=line_detail_kb(c.message.chat.id, line))
+
+@router.route("va")
+def cb_view_ads(c, state, lid, page="0"):
+    cid = c.message.chat.id
+    line = _line(c, lid)
+    if line is not None:
+        show(c, ads_text(cid, line, int(page)), parse_mode="Markdown",
+             reply_markup=ads_kb(cid, line, int(page)))
+
+@router.route("ao")
+def cb_ad_menu(c, state, aid, page="0"):
+    line, ad = _ad(c, state, aid)
+    if ad is not None:
+        show(c, ad_text(ad), parse_mode="Markdown",
+             reply_markup=ad_item_kb(c.message.chat.id, line, aid, int(page)))
+
+@router.route("dl", answer="Eliminado")
+def cb_del_line(c, state, lid):
+    cid = c.message.chat.id
+    line = _line(c, lid)
+    if line is None:
+        return
+    for ad in state["store"][line].get("ads", {}).values():
+        if ad.get("meta", {}).get("ad_id"):
+            set_schedule(cid, schedule_key(cid, ad_id=ad["meta"]["ad_id"]), None)
+    set_schedule(cid, schedule_key(cid, line), None)
+    forget_line(cid, line)
+    save_all(cid)
+    show(c, f"🗑️ Línea *{line}* eliminada.", parse_mode="Markdown", reply_markup=lines_kb(cid))
+
+@router.route("ax", answer="Eliminado")
+def cb_del_ad(c, state, aid, page="0"):
+    cid = c.message.chat.id
+    line, ad = _ad(c, state, aid)
+    if ad is None:
+        return
+    store = state["store"]
+    remove_ad(state, aid)
+    ads = store[line]["ads"]
+    if ad.get("meta", {}).get("ad_id"):
+        set_schedule(cid, schedule_key(cid, ad_id=ad["meta"]["ad_id"]), None)
+    if not ads:
+        # si ya no hay anuncios, borra la línea entera
+        set_schedule(cid, schedule_key(cid, line), None)
+        forget_line(cid, line)
+        save_all(cid)
+        show(c, "✅ Eliminado.", reply_markup=lines_kb(cid))
+        return
+    save_all(cid)
+    page = int(page)
+    show(c, "✅ Eliminado.\n" + ads_text(cid, line, page), parse_mode="Markdown",
+         reply_markup=ads_kb(cid, line, page))
+
+@router.route("ap", answer="Procesando…")
+def cb_ad_toggle(c, state, aid, page="0"):
+    cid = c.message.chat.id
+    line, ad = _ad(c, state, aid)
+    if ad is None:
+        return
+    meta = ad.get("meta", {})
+    ad_id = meta.get("ad_id")
+    current = meta.get("status", "PAUSED")
+    new_status = "ACTIVE" if current != "ACTIVE" else "PAUSED"
+    try:
+        toggle_ad_status(fb_require(chat_account(cid)), ad_id, new_status)
+        meta["status"] = new_status
+        save_all(cid)
+        show(c, f"⏯ Estado actualizado a *{new_status}*\n\n" + ad_text(ad),
+             parse_mode="Markdown", reply_markup=ad_item_kb(cid, line, aid, int(page)))
+    except Exception as e:
+        show(c, f"❌ Error alternando estado: {e}", reply_markup=ad_item_kb(cid, line, aid, int(page)))
+
+@router.route("lst", answer="Procesando…")
+def cb_line_status(c, state, lid, new_status):
+    cid = c.message.chat.id
+    line = _line(c, lid)
+    if line is None:
+        return
+    try:
+        client = fb_require(chat_account(cid))
+    except RuntimeError as e:
+        show(c, f"❌ {e}", reply_markup=line_detail_kb(cid, line))
+        return
+    ads = [ad for ad in state["store"][line].get("ads",{}).values() if ad.get("meta",{}).get("ad_id")]
+    results = set_ads_status(client, [ad["meta"]["ad_id"] for ad in ads], new_status)
+    ok, lines_out = 0, []
+    for ad in ads:
+        err = results.get(ad["meta"]["ad_id"])
+        if err is None:
+            ad["meta"]["status"] = new_status; ok += 1
+        else:
+            lines_out.append(f"❌ {ad.get('title','(sin título)')[:30]}: {err}")
+    if ok:
+        save_all(cid)
+    show(c, "\n".join([f"⏯ {line}: {ok}/{len(ads)} anuncios en {new_status}"] + lines_out),
+         reply_markup=line_detail_kb(cid, line))
+
+SCHEDULE_HELP = ("Envía las franjas en que debe estar *activo* (hora Colombia), ej:\n"
+                 "`L-V 8-18, S 9-13`\nDías: L M X J V S D (o `*` todos). Fuera de las franjas "
+                 "se pausa. `off` quita el horario.")
+
+def ask_schedule(c, state, key, label):
+    windows = _schedule_of(state, key)
+    state["editing_schedule"] = key
+    state["step"] = "edit_schedule"
+    now = f"Actual: {sched.format_windows(windows)}" if windows else "Sin horario."
+    show(c, f"🕒 Horario de *{label}*\n{now}\n\n{SCHEDULE_HELP}", parse_mode="Markdown")
+
+@router.route("hl")
+def cb_line_schedule(c, state, lid):
+    line = _line(c, lid)
+    if line is not None:
+        ask_schedule(c, state, schedule_key(c.message.chat.id, line), line)
+
+@router.route("ah")
+def cb_ad_schedule(c, state, aid, page="0"):
+    cid = c.message.chat.id
+    line, ad = _ad(c, state, aid)
+    if ad is None:
+        return
+    ad_id = ad.get("meta", {}).get("ad_id")
+    if not ad_id:
+        show(c, "Ese anuncio no está publicado en Meta.", reply_markup=ad_item_kb(cid, line, aid, int(page)))
+        return
+    ask_schedule(c, state, schedule_key(cid, ad_id=ad_id), ad.get("title", ad_id))
+
+@router.route("m")
+def cb_metrics(c, state):
+    show(c, "📊 Elige la ventana de métricas:", reply_markup=metrics_kb())
+
+@router.route("mw", answer="Consultando Meta…")
+def cb_metrics_window(c, state, window):
+    try:
+        show(c, metrics_report(c.message.chat.id, window), parse_mode="Markdown", reply_markup=metrics_kb())
+    except Exception as e:
+        show(c, f"❌ Error consultando métricas: {e}", reply_markup=metrics_kb())
+
+@router.route("b")
+def cb_budget(c, state):
+    cid = c.message.chat.id
+    store = state["store"]
+    if not store:
+        show(c, "No hay líneas aún.", reply_markup=home_menu())
+        return
+    try:
+        live = live_budgets(cid)
+        note = ""
+    except Exception as e:
+        print("live_budgets() error:", repr(e))
+        live, note = {}, "\n⚠️ No se pudo leer Meta; se muestran los valores guardados."
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for ln in sorted(store.keys()):
+        if (cid, ln) in _budget_timers:
+            label = f"{line_budget(state, ln):,} COP ⏳"
+        elif ln in live:
+            label = f"{live[ln]:,} COP"
+        else:
+            label = f"{line_budget(state, ln):,} COP" + (" (sin publicar)" if not store[ln].get("adset_id") else "")
+        kb.add(types.InlineKeyboardButton(f"{ln} — {label}", callback_data=cb("be", line_id(cid, ln))))
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("h")))
+    show(c, "Selecciona la línea para editar presupuesto diario:" + note, reply_markup=kb)
+
+@router.route("be")
+def cb_budget_edit(c, state, lid):
+    line = _line(c, lid)
+    if line is None:
+        return
+    state["editing_line"] = line
+    show(c, f"💰 Nuevo presupuesto (COP) para *{line}*:", parse_mode="Markdown")
+    state["step"] = "edit_budget"
+
+@router.route("s")
+def cb_settings(c, state):
+    fb = state.get("fb")
+    acc = fb or ENV_ACCOUNT
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔑 Usar mi cuenta Meta", callback_data=cb("fa")))
+    if fb:
+        kb.add(types.InlineKeyboardButton("↩️ Volver a la cuenta por defecto", callback_data=cb("fd")))
+    kb.add(types.InlineKeyboardButton("🧾 Check Meta", callback_data=cb("cm")))
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("h")))
+    show(c,
+        "⚙️ Configuración\n"
+        f"• Origen: {'cuenta propia del chat' if fb else 'por defecto (FB_*)'}\n"
+        f"• Cuenta: {acc.get('account_id') or '—'}\n"
+        f"• Página: {acc.get('page_id') or '—'}\n"
+        f"• WA: {acc.get('waba_phone') or '—'}\n"
+        f"• API: v{FB_API_VERSION}",
+        reply_markup=kb)
+
+FB_PROMPTS = {
+    "fb_token":   "🔑 Envía el *token de acceso* de Meta (system user). Borro tu mensaje apenas lo lea.",
+    "fb_account": "🏷️ Envía el *ID de la cuenta publicitaria* (act_123… o solo los números):",
+    "fb_page":    "📄 Envía el *ID de la página* de Facebook:",
+    "fb_waba":    "📱 Envía el *número de WhatsApp* (ej: 57XXXXXXXXXX):",
+}
+
+@router.route("fa")
+def cb_fb_account(c, state):
+    if not SEALER.enabled:
+        show(c, "⚠️ Las cuentas por chat están desactivadas: falta STATE_KEY o el paquete cryptography.",
+             reply_markup=back_kb("s"))
+        return
+    state["fb_draft"] = {}
+    state["step"] = "fb_token"
+    show(c, FB_PROMPTS["fb_token"], parse_mode="Markdown")
+
+@router.route("fd", answer="Listo")
+def cb_fb_default(c, state):
+    state["fb"] = None
+    save_all(c.message.chat.id)
+    cb_settings(c, state)
+
+@router.route("cm", answer="Verificando Meta…")
+def cb_check_meta(c, state):
+    class Dummy:  # reutiliza el handler
+        def __init__(self, chat_id): self.chat = type("C", (), {"id": chat_id})
+    cmd_check_meta(Dummy(c.message.chat.id))
+
+@router.route("rc")
+def cb_reset_confirm(c, state):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✅ Sí, limpiar", callback_data=cb("rg")),
+        types.InlineKeyboardButton("❌ Cancelar", callback_data=cb("h")))
+    show(c, "¿Deseas limpiar los mensajes del bot en este chat?", reply_markup=kb)
+
+@router.route("rg", answer="Limpiando...")
+def cb_reset_go(c, state):
+    reset_chat(c.message.chat.id)
+
+@router.route("?")
+def cb_help(c, state):
+    show(c, "❓Ayuda\n1) ➕ Nueva campaña\n2) Completa línea, media, título y descripción\n3) Publica: 🟢 Activar o ⏸️ Pausada\n4) Gestiona desde 🗂️ Mis líneas\n5) Muchos anuncios a la vez: envía un CSV/XLSX (/importar)\n6) 📊 Métricas por anuncio y día en CSV: /export 7d",
+         reply_markup=back_kb("h"))
+
+@router.route("x")
+def cb_noop(c, state):
+    pass
+
 # =====================
 # Flujo de texto
 # =====================
@@ -485,9 +1344,12 @@ def media_handler(m):
     state = st(cid)
     if state.get("step") == "ask_media":
         if m.photo:
-            state["media"] = f"photo:{m.photo[-1].file_id}"
+            p = m.photo[-1]
+            state["media"] = {"kind": "photo", "file_id": p.file_id, "unique_id": p.file_unique_id}
         elif m.video:
-            state["media"] = f"video:{m.video.file_id}"
+            v, th = m.video, m.video.thumbnail
+            state["media"] = {"kind": "video", "file_id": v.file_id, "unique_id": v.file_unique_id,
+                              "thumb": th and th.file_id, "thumb_uid": th and th.file_unique_id}
         send_md(cid, "✏️ Escribe el *Título* del anuncio:")
         state["step"] = "ask_title"
 
@@ -501,7 +1363,7 @@ def text_handler(m):
     if step == "new_line":
         state["line"] = txt
         store = state["store"]
-        if txt not in store: store[txt] = {"ads":[]}; save_all()
+        if txt not in store: store[txt] = {"ads":{}}; save_all(cid)
         send_md(cid, "📸 Sube *imagen o video* del producto:")
         state["step"] = "ask_media"
 
@@ -514,76 +1376,509 @@ def text_handler(m):
         state["desc"] = txt
         # Resumen + publicar
         line, title, desc = state["line"], state["title"], state["desc"]
-        budget = state.get("budget", DEFAULT_BUDGET)
+        budget = line_budget(state, line)
+        state["draft"] = draft = uuid.uuid4().hex[:10]
         kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🟢 Activar ahora", callback_data="go_live_ACTIVE"),
-               types.InlineKeyboardButton("⏸️ Dejar pausada", callback_data="go_live_PAUSED"))
-        send(cid, (f"Resumen:
-• Línea: {line}
-• Título: {title}
-• Desc: {desc}
-"
-                   f"• Presupuesto: {budget:,} COP
-
-¿Publicar activada o pausada?"),
+        kb.add(types.InlineKeyboardButton("🟢 Activar ahora", callback_data=cb("gl", "ACTIVE", draft)),
+               types.InlineKeyboardButton("⏸️ Dejar pausada", callback_data=cb("gl", "PAUSED", draft)))
+        send(cid, (f"Resumen:\n• Línea: {line}\n• Título: {title}\n• Desc: {desc}\n"
+                   f"• Presupuesto: {budget:,} COP\n\n¿Publicar activada o pausada?"),
              reply_markup=kb)
         state["step"] = "confirm_publish"
 
+    elif step in FB_PROMPTS:
+        fb_setup_step(m, state, step, txt)
+
+    elif step == "edit_schedule":
+        key = tuple(state.get("editing_schedule") or ())
+        if txt.lower() in ("off", "no", "quitar"):
+            windows = None
+        else:
+            try:
+                windows = sched.parse_windows(txt)
+            except ValueError as e:
+                send(cid, f"{e}\n\nIntenta de nuevo o escribe `off`.", parse_mode="Markdown")
+                return
+        state["step"] = "idle"
+        if len(key) != 3:
+            send(cid, "Ese horario ya no está vigente.", reply_markup=home_menu())
+            return
+        set_schedule(cid, key, windows)
+        if windows:
+            now = time.time()
+            send(cid, f"✅ Horario: {sched.format_windows(windows)}\n"
+                      f"Ahora: {'activo' if sched.is_open(windows, now) else 'en pausa'} · "
+                      f"{sched.describe_next(windows, now)}", reply_markup=home_menu())
+        else:
+            send(cid, "✅ Horario quitado. Los anuncios quedan en su estado actual.", reply_markup=home_menu())
+
     elif step == "edit_budget":
         try:
-            val = int(txt.replace(".","").replace(",",""))
-            state["budget"] = max(1000, val); save_all()
-            send(cid, f"✅ Presupuesto actualizado: {state['budget']:,} COP", reply_markup=home_menu())
-            state["step"] = "idle"
-        except:
+            val = max(1000, int(txt.replace(".","").replace(",","")))
+        except ValueError:
             send(cid, "Formato inválido. Escribe solo números.")
+            return
+        line = state.get("editing_line")
+        entry = state["store"].get(line)
+        if entry is None:
+            # la línea se borró mientras tanto: queda como presupuesto por defecto del chat
+            state["budget"] = val; save_all(cid)
+            send(cid, f"✅ Presupuesto por defecto: {val:,} COP", reply_markup=home_menu())
+        else:
+            entry["budget"] = val; save_all(cid)
+            if line_adsets(entry):
+                schedule_budget_push(cid, line)
+                note = "Se aplica en Meta en unos segundos."
+            else:
+                note = "Se usará al publicar."
+            send(cid, f"✅ Presupuesto de {line}: {val:,} COP. {note}", reply_markup=home_menu())
+        state["step"] = "idle"
+
+def fb_setup_step(m, state, step, txt):
+    cid = m.chat.id
+    draft = state.setdefault("fb_draft", {})
+    if step == "fb_token":
+        draft["token"] = SEALER.seal(txt)
+        try:
+            with track(TG_CALLS, TG_ERRORS, "deleteMessage"):
+                bot.delete_message(cid, m.message_id)
+        except Exception as e:
+            print("delete_message() error:", repr(e))
+        nxt = "fb_account"
+    elif step == "fb_account":
+        draft["account_id"] = txt if txt.startswith("act_") else "act_" + txt
+        nxt = "fb_page"
+    elif step == "fb_page":
+        draft["page_id"] = txt
+        nxt = "fb_waba"
+    else:
+        draft["waba_phone"] = txt.lstrip("+").replace(" ", "")
+        state["step"] = "idle"
+        state.pop("fb_draft", None)
+        acc = account_from(draft)
+        try:
+            with track(META_CALLS, META_ERRORS, "check_account"):
+                info = fb_require(acc).get(acc["account_id"], fields="name,account_status")
+        except Exception as e:
+            send(cid, f"❌ Meta rechazó la cuenta: {e}\nNo se guardó nada.", reply_markup=home_menu())
+            return
+        state["fb"] = draft
+        save_all(cid)
+        send(cid, f"✅ Cuenta *{info.get('name', acc['account_id'])}* configurada para este chat.",
+             parse_mode="Markdown", reply_markup=home_menu())
+        return
+    state["step"] = nxt
+    send_md(cid, FB_PROMPTS[nxt])
 
 # =====================
 # Publicación (confirm)
 # =====================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("go_live_"))
-def do_publish(c):
+STAGE_ICONS = {"wait": "▫️", "run": "⏳", "ok": "✅", "fail": "❌", "skip": "▫️"}
+MAX_DONE_JOBS = 20
+
+def render_job(job):
+    head = {"queued": "🕒 En cola", "running": "📤 Publicando", "done": "✅ Publicado en Meta",
+            "failed": "❌ Error publicando", "interrupted": "⚠️ Publicación interrumpida"}[job["status"]]
+    # línea, título y errores de Meta (promoted_object, daily_budget…) van
+    # escapados: un "_" suelto hace que Telegram rechace toda la edición
+    out = [f"{head}: {md(job['line'])} — {md(job['title'])}"]
+    out += [f"{STAGE_ICONS[job['stages'].get(k, 'wait')]} {label}" for k, label in PUBLISH_STEPS.items()]
+    res = job.get("result")
+    if res:
+        out += ["", f"Campaña: `{res['campaign_id']}`", f"Ad Set: `{res['adset_id']}`",
+                f"Ad: `{res['ad_id']}`", f"Estado: *{res['status']}*"]
+    if job.get("error"):
+        out += ["", md(job["error"])]
+    return "\n".join(out)
+
+def show_job(cid, job, **kw):
+    edit(cid, job["msg_id"], render_job(job), wait=False, parse_mode="Markdown", **kw)
+
+def prune_jobs(state):
+    jobs = state.get("jobs", {})
+    done = sorted((j for j in jobs.values() if j["status"] not in ("queued", "running")),
+                  key=lambda j: j["ts"])
+    for j in done[:-MAX_DONE_JOBS]:
+        jobs.pop(j["id"], None)
+
+_line_locks = {}
+_line_locks_lock = threading.Lock()
+
+def line_lock(cid, line):
+    """Serializa las publicaciones de una misma línea: la primera crea campaña y
+    ad set, las siguientes ya los encuentran guardados."""
+    with _line_locks_lock:
+        return _line_locks.setdefault((cid, line), threading.Lock())
+
+def publish_ad(cid, line, title, desc, budget_cop, activate_now, media=None, on_progress=None):
+    """Publica un anuncio en la línea y lo guarda en el estado. Solo mientras la
+    línea no tiene campaña y ad set se pasa por line_lock; después las
+    publicaciones de una misma línea corren en paralelo."""
+    state = st(cid)
+    entry = state["store"].get(line, {})
+    ready = entry.get("campaign_id") and entry.get("adset_id")
+    with contextlib.nullcontext() if ready else line_lock(cid, line):
+        entry = state["store"].get(line, {})
+        res = publish_to_meta(chat_account(cid), line=line, title=title, desc=desc,
+                              budget_cop=budget_cop, activate_now=activate_now,
+                              media=media, on_progress=on_progress,
+                              campaign_id=entry.get("campaign_id"), adset_id=entry.get("adset_id"))
+        # guardar anuncio mínimo local (la línea pudo borrarse mientras tanto)
+        entry = state["store"].setdefault(line, {"ads":{}})
+        entry["campaign_id"], entry["adset_id"] = res["campaign_id"], res["adset_id"]
+        add_ad(cid, line, {"title": title, "desc": desc, "meta": res})
+    return res
+
+def run_publish_job(cid, job_id):
+    state = st(cid)
+    job = state.get("jobs", {}).get(job_id)
+    if not job or job["status"] != "queued":
+        return
+    job["status"] = "running"; save_all(cid)
+
+    def progress(stages):
+        job["stages"].update(stages)
+        show_job(cid, job)
+
     try:
-        cid = c.message.chat.id
+        res = publish_ad(cid, job["line"], job["title"], job["desc"], job["budget"], job["activate"],
+                         media=job.get("media"), on_progress=progress)
+    except Exception as e:
+        print("run_publish_job() error:", repr(e))
+        print(traceback.format_exc())
+        job["status"], job["error"] = "failed", str(e)
+        save_all(cid)
+        show_job(cid, job, reply_markup=home_menu())
+        return
+    job["status"], job["result"] = "done", res
+    prune_jobs(state)
+    save_all(cid)
+    show_job(cid, job, reply_markup=home_menu())
+
+publisher = JobQueue(run_publish_job, workers=int(os.getenv("PUBLISH_WORKERS", 4)))
+
+def resume_jobs():
+    """Tras un reinicio: re-encola lo que no arrancó y avisa de lo que quedó a medias."""
+    cids = set(DB.cids(contains='"status":"queued"')) | set(DB.cids(contains='"status":"running"'))
+    for cid in filter(owns, cids):
         state = st(cid)
-        status = c.data.split("_", 2)[2]  # ACTIVE | PAUSED
-        activate = (status == "ACTIVE")
-        bot.answer_callback_query(c.id, "Publicando…")
-        res = publish_to_meta(
-            line = state.get("line"),
-            title = state.get("title"),
-            desc = state.get("desc"),
-            budget_cop = state.get("budget", DEFAULT_BUDGET),
-            activate_now = activate
-        )
-        # guardar anuncio mínimo local
-        store = state["store"]
-        store[state["line"]]["ads"].append({
-            "title": state["title"],
-            "desc": state["desc"],
-            "meta": res
-        })
-        save_all()
-        send_md(cid, (f"✅ Publicado en Meta
-"
-                   f"Campaña: `{res['campaign_id']}`
-"
-                   f"Ad Set: `{res['adset_id']}`
-"
-                   f"Ad: `{res['ad_id']}`
-"
-                   f"Estado: **{res['status']}**"), reply_markup=home_menu())
+        for job in list(state.get("jobs", {}).values()):
+            if job["status"] == "queued":
+                publisher.submit(cid, job["id"])
+            elif job["status"] == "running":
+                # pudo crear objetos en Meta: no se reintenta a ciegas
+                job["status"] = "interrupted"
+                job["error"] = "Se reinició el bot durante la publicación. Revisa Ads Manager antes de reintentar."
+                save_all(cid)
+                show_job(cid, job, reply_markup=home_menu())
+
+@router.route("gl", answer=False)
+def do_publish(c, state, status, draft):
+    try:
+        cid = c.message.chat.id  # status: ACTIVE | PAUSED
+        jobs = state.setdefault("jobs", {})
+        if draft in jobs:
+            # doble tap o botón viejo: el borrador ya tiene su trabajo
+            answer_cb(c, "Ya está en proceso.")
+            return
+        if not draft or draft != state.get("draft") or state.get("step") != "confirm_publish":
+            answer_cb(c, "Este resumen ya no está vigente.")
+            return
+        answer_cb(c, "Publicando…")
+        job = jobs[draft] = {
+            "id": draft, "status": "queued", "ts": time.time(), "msg_id": c.message.message_id,
+            "line": state.get("line"), "title": state.get("title"), "desc": state.get("desc"),
+            "budget": line_budget(state, state.get("line")), "activate": status == "ACTIVE",
+            "media": state.get("media"), "stages": {},
+        }
         state["step"] = "idle"
+        save_all(cid)
+        show_job(cid, job)
+        publisher.submit(cid, draft)
     except Exception as e:
         print("do_publish() error:", repr(e))
         print(traceback.format_exc())
         try:
-            bot.answer_callback_query(c.id, "Error")
+            answer_cb(c, "Error")
         except: pass
         send(cid, f"❌ Error publicando: {e}", reply_markup=home_menu())
 
 # =====================
-# Polling + Flask (mantiene vivo en Render)
+# Importación masiva (CSV / XLSX)
+# =====================
+# La planilla se valida en una sola pasada al leerla; se muestra un resumen
+# y, al confirmar, las filas válidas se publican con publish_ad en un pool de
+# IMPORT_CONCURRENCY hilos. Un único mensaje de progreso se edita en el lugar
+# y al final se devuelve un CSV con el resultado de cada fila.
+IMPORT_MAX_ROWS    = int(os.getenv("IMPORT_MAX_ROWS", 500))
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", 4))
+IMPORT_MAX_BYTES   = 20 * 1024 * 1024       # límite de descarga de la Bot API
+IMPORT_EDIT_EVERY  = 2.0                     # s entre ediciones del progreso
+IMPORT_TTL         = 3600                    # s que un resumen espera confirmación
+IMPORTS = {}       # import_id -> planilla validada pendiente de confirmar (en memoria)
+
+IMPORT_HELP = ("📥 *Importación masiva*\nEnvía un archivo .csv o .xlsx con estas columnas "
+               "(la primera fila son los encabezados):\n"
+               "`linea, titulo, descripcion, media, presupuesto, estado`\n\n"
+               "• *media*: URL de la imagen o video (opcional)\n"
+               "• *presupuesto*: diario en COP, el mismo en todas las filas de una línea (opcional)\n"
+               f"• *estado*: activa | pausada (por defecto pausada)\nMáximo {IMPORT_MAX_ROWS} filas.")
+
+def import_kb(imp_id, n):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton(f"🚀 Publicar {n}", callback_data=cb("ig", imp_id)),
+           types.InlineKeyboardButton("❌ Cancelar", callback_data=cb("ic", imp_id)))
+    return kb
+
+def read_import(fobj, name):
+    """Una pasada por la planilla: (filas válidas, filas con error, presupuesto por línea)."""
+    rows, errors, budgets = [], [], {}
+    for n, raw in bulk.read_rows(fobj, name):
+        if len(rows) + len(errors) >= IMPORT_MAX_ROWS:
+            errors.append({"fila": n, "resultado": "omitida", "error": f"más de {IMPORT_MAX_ROWS} filas"})
+            break
+        try:
+            row = bulk.validate(raw)
+            if row["budget"] is not None and budgets.setdefault(row["line"], row["budget"]) != row["budget"]:
+                raise ValueError("presupuesto distinto al de otra fila de la misma línea")
+        except ValueError as e:
+            errors.append({"fila": n, "linea": raw.get("line", ""), "titulo": raw.get("title", ""),
+                           "resultado": "inválida", "error": str(e)})
+            continue
+        row["n"] = n
+        rows.append(row)
+    return rows, errors, budgets
+
+def send_results(cid, results, caption):
+    path = bulk.write_results(sorted(results, key=lambda r: r["fila"]))
+    try:
+        with open(path, "rb") as f, track(TG_CALLS, TG_ERRORS, "sendDocument"):
+            bot.send_document(cid, f, caption=caption, visible_file_name="resultado_importacion.csv")
+    except Exception as e:
+        print("send_results() error:", repr(e))
+        send(cid, f"❌ No se pudo enviar el archivo de resultados: {e}")
+    finally:
+        os.remove(path)
+
+@bot.message_handler(commands=['importar', 'import'])
+def import_cmd(m):
+    send_md(m.chat.id, IMPORT_HELP)
+
+@bot.message_handler(content_types=['document'])
+def document_handler(m):
+    cid = m.chat.id
+    doc = m.document
+    name = doc.file_name or ""
+    if not name.lower().endswith((".csv", ".xlsx", ".xlsm")):
+        send(cid, "📎 Para importar anuncios envía un .csv o .xlsx (/importar muestra el formato).")
+        return
+    if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+        send(cid, "❌ El archivo pasa de 20 MB.")
+        return
+    try:
+        fobj, _, _ = MEDIA.download(doc.file_id)
+        with fobj:
+            rows, errors, budgets = read_import(fobj, name)
+    except Exception as e:
+        send(cid, f"❌ No se pudo leer la planilla: {e}")
+        return
+    if not rows:
+        send_results(cid, errors, "❌ Ninguna fila válida. Revisa el detalle en el archivo.")
+        return
+    imp_id = uuid.uuid4().hex[:10]
+    for k in [k for k, v in list(IMPORTS.items()) if v["ts"] < time.time() - IMPORT_TTL]:
+        IMPORTS.pop(k, None)     # resúmenes que nadie confirmó
+    IMPORTS[imp_id] = {"cid": cid, "rows": rows, "errors": errors, "budgets": budgets, "ts": time.time()}
+    lines = len({r["line"] for r in rows})
+    out = [f"📥 {name}: {len(rows)} filas válidas en {lines} líneas"]
+    if errors:
+        out.append(f"⚠️ {len(errors)} con errores (no se publican):")
+        out += [f"• Fila {e['fila']}: {e['error']}" for e in errors[:5]]
+        if len(errors) > 5:
+            out.append(f"… y {len(errors) - 5} más (van en el archivo de resultados)")
+    send(cid, "\n".join(out), reply_markup=import_kb(imp_id, len(rows)))
+
+def import_progress(stats, total, final=False):
+    head = "✅ Importación terminada" if final else "📤 Importando"
+    return (f"{head}: {stats['ok'] + stats['fail']}/{total}\n"
+            f"✅ Publicadas: {stats['ok']} · ❌ Con error: {stats['fail']}")
+
+def run_import(cid, mid, imp):
+    state = st(cid)
+    state["_busy"] = state.get("_busy", 0) + 1      # que no se desaloje el chat a mitad
+    try:
+        # el presupuesto de la planilla pasa a ser el de la línea
+        pushed = []
+        for line, budget in imp["budgets"].items():
+            entry = state["store"].setdefault(line, {"ads": {}})
+            if entry.get("budget") != budget:
+                entry["budget"] = budget
+                if line_adsets(entry):
+                    pushed.append(line)
+        save_all(cid)
+
+        rows, results = imp["rows"], list(imp["errors"])
+        stats, lock, last = {"ok": 0, "fail": 0}, threading.Lock(), [0.0]
+
+        def one(row):
+            out = {"fila": row["n"], "linea": row["line"], "titulo": row["title"]}
+            try:
+                res = publish_ad(cid, row["line"], row["title"], row["desc"],
+                                 line_budget(state, row["line"]), row["activate"], media=row["media"])
+                out.update(resultado="publicada", ad_id=res["ad_id"], campaign_id=res["campaign_id"],
+                           adset_id=res["adset_id"])
+            except Exception as e:
+                out.update(resultado="error", error=str(e))
+            with lock:
+                results.append(out)
+                stats["ok" if out["resultado"] == "publicada" else "fail"] += 1
+                if time.monotonic() - last[0] >= IMPORT_EDIT_EVERY:
+                    last[0] = time.monotonic()
+                    edit(cid, mid, import_progress(stats, len(rows)), wait=False)
+
+        with ThreadPoolExecutor(max_workers=IMPORT_CONCURRENCY, thread_name_prefix="import") as ex:
+            list(ex.map(one, rows))
+        save_all(cid)
+        for line in pushed:
+            schedule_budget_push(cid, line)
+        edit(cid, mid, import_progress(stats, len(rows), final=True), wait=False, reply_markup=home_menu())
+        send_results(cid, results, f"📄 Resultado: {stats['ok']} publicadas, "
+                                   f"{stats['fail'] + len(imp['errors'])} sin publicar.")
+    except Exception as e:
+        print("run_import() error:", repr(e))
+        print(traceback.format_exc())
+        send(cid, f"❌ Error en la importación: {e}")
+    finally:
+        state["_busy"] -= 1
+
+@router.route("ig", answer=False)
+def cb_import_go(c, state, imp_id):
+    cid = c.message.chat.id
+    imp = IMPORTS.pop(imp_id, None)
+    if imp is None or imp["cid"] != cid:
+        # doble tap, botón viejo o reinicio del bot
+        answer_cb(c, "Esta importación ya no está vigente.")
+        return
+    answer_cb(c, "Importando…")
+    show(c, import_progress({"ok": 0, "fail": 0}, len(imp["rows"])))
+    threading.Thread(target=run_import, args=(cid, c.message.message_id, imp),
+                     name=f"import-{imp_id}", daemon=True).start()
+
+@router.route("ic", answer="Cancelada")
+def cb_import_cancel(c, state, imp_id):
+    IMPORTS.pop(imp_id, None)
+    show(c, "❌ Importación cancelada.", reply_markup=home_menu())
+
+# =====================
+# Exportación de insights (CSV)
+# =====================
+# La descarga es por cuenta y rango: exportaciones simultáneas de la misma
+# cuenta y rango (otro chat con la misma cuenta o un doble tap) comparten un
+# solo recorrido de Graph vía SingleFlight. Cada chat después filtra ese
+# archivo a sus propios anuncios, también fila a fila, a un .csv.gz propio.
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+EXPORTS = SingleFlight(cleanup=_remove)
+EXPORT_COLUMNS = ("linea", "titulo") + insights.EXPORT_COLUMNS
+
+def parse_range(args):
+    """'7d' | 'AAAA-MM-DD AAAA-MM-DD' -> rango de insights.range_params."""
+    if not args:
+        return "7d"
+    if len(args) == 1 and args[0] in insights.WINDOWS:
+        return args[0]
+    if len(args) == 2:
+        try:
+            since, until = (date.fromisoformat(a) for a in args)
+        except ValueError:
+            since = None
+        if since and since <= until <= date.today():
+            return (since.isoformat(), until.isoformat())
+    raise ValueError("Usa /export 24h | 7d | 28d o /export AAAA-MM-DD AAAA-MM-DD")
+
+def range_label(rng):
+    return rng if isinstance(rng, str) else f"{rng[0]}_{rng[1]}"
+
+def chat_export(raw_path, ads):
+    """Filtra el CSV de la cuenta a los anuncios del chat; (ruta, filas)."""
+    f = tempfile.NamedTemporaryFile(suffix=".csv.gz", prefix="export-", delete=False)
+    f.close()
+    n = 0
+    with gzip.open(raw_path, "rt", encoding="utf-8", newline="") as src, \
+         gzip.open(f.name, "wt", encoding="utf-8", newline="") as dst:
+        reader, w = csv.reader(src), csv.writer(dst)
+        next(reader, None)
+        w.writerow(EXPORT_COLUMNS)
+        for row in reader:
+            hit = ads.get(row[1])
+            if hit:
+                w.writerow((*hit, *row))
+                n += 1
+    return f.name, n
+
+def run_export(cid, rng, mid=None):
+    out = None
+    try:
+        acc = chat_account(cid)
+        client = fb_require(acc)
+        ads = {str(ad["meta"]["ad_id"]): (line, ad.get("title", ""))
+               for line, entry in list(st(cid)["store"].items())
+               for ad in list(entry.get("ads", {}).values()) if ad.get("meta", {}).get("ad_id")}
+        if not ads:
+            send(cid, "No hay anuncios publicados para exportar.", reply_markup=home_menu())
+            return
+        if mid is None:
+            mid = send(cid, "📤 Exportando insights…").result(timeout=EDIT_TIMEOUT).message_id
+        key = (acc["account_id"], rng)
+        with track(META_CALLS, META_ERRORS, "insights_export"), \
+             EXPORTS.share(key, lambda: insights.export_csv(client, acc["account_id"], rng)) as raw:
+            out, n = chat_export(raw, ads)
+        with open(out, "rb") as f, track(TG_CALLS, TG_ERRORS, "sendDocument"):
+            bot.send_document(cid, f, visible_file_name=f"insights_{range_label(rng)}.csv.gz",
+                              caption=f"📤 Insights {range_label(rng)}: {n} filas (anuncio × día) de {len(ads)} anuncios")
+        edit(cid, mid, "✅ Exportación lista.", wait=False, reply_markup=metrics_kb())
+    except Exception as e:
+        print("run_export() error:", repr(e))
+        print(traceback.format_exc())
+        send(cid, f"❌ Error exportando: {e}", reply_markup=metrics_kb())
+    finally:
+        if out:
+            _remove(out)
+
+def start_export(cid, rng, mid=None):
+    # puede tardar minutos: no ocupa el hilo del chat
+    threading.Thread(target=run_export, args=(cid, rng, mid), name=f"export-{cid}", daemon=True).start()
+
+@bot.message_handler(commands=['export', 'exportar'])
+def export_cmd(m):
+    try:
+        rng = parse_range(m.text.split()[1:])
+    except ValueError as e:
+        send(m.chat.id, str(e))
+        return
+    start_export(m.chat.id, rng)
+
+@router.route("ex")
+def cb_export(c, state):
+    kb = types.InlineKeyboardMarkup(row_width=3)
+    kb.add(*[types.InlineKeyboardButton(w, callback_data=cb("xw", w)) for w in insights.WINDOWS])
+    kb.add(types.InlineKeyboardButton("⬅️ Volver", callback_data=cb("m")))
+    show(c, "📤 Exportar insights por anuncio y día. Elige el rango\n"
+            "(otro rango: /export AAAA-MM-DD AAAA-MM-DD):", reply_markup=kb)
+
+@router.route("xw", answer="Exportando…")
+def cb_export_window(c, state, window):
+    if window not in insights.WINDOWS:
+        return
+    show(c, f"📤 Exportando insights {window}…")
+    start_export(c.message.chat.id, window, c.message.message_id)
+
+# =====================
+# Polling / Webhook + Flask (mantiene vivo en Render)
 # =====================
 def run_polling():
     print("▶️ Iniciando polling…")
@@ -599,6 +1894,85 @@ def run_polling():
             print("⚠️ Polling error:", repr(e))
             time.sleep(5)
 
+def update_chat_id(u):
+    if u.message:
+        return u.message.chat.id
+    if u.callback_query:
+        cq = u.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    return u.update_id
+
+pool = ChatPool(lambda u: bot.process_new_updates([u]), workers=WORKERS, max_pending=MAX_PENDING) \
+    if (BOT_MODE == "webhook" and ROLE == "single") or ROLE == "worker" else None
+SHARDS = None   # líder multi-proceso: Shards de workers (ver run_leader)
+
+def poll_raw(submit):
+    """Polling del líder: getUpdates crudo, sin parsear, directo a los shards."""
+    bot.remove_webhook()
+    offset = None
+    while True:
+        try:
+            if offset is None:
+                # igual que skip_pending: descarta lo acumulado mientras no había líder
+                ups = telebot.apihelper.get_updates(TG_TOKEN, offset=-1, timeout=10)
+                offset = ups[-1]["update_id"] + 1 if ups else 0
+                continue
+            ups = telebot.apihelper.get_updates(TG_TOKEN, offset=offset, timeout=40, long_polling_timeout=30,
+                                                allowed_updates=["message","callback_query"])
+        except Exception as e:
+            print("⚠️ Polling error:", repr(e))
+            time.sleep(5)
+            continue
+        for d in ups:
+            offset = d["update_id"] + 1
+            UPDATES.inc("callback_query" if "callback_query" in d else "message" if "message" in d else "other")
+            while not submit(chat_key(d), json.dumps(d, ensure_ascii=False)):
+                time.sleep(0.2)   # shard lleno: se frena el polling
+
+def run_leader():
+    lock = LeaderLock(LEADER_LOCK)
+    if lock.acquire(block=False):
+        lead()
+        return
+    # la espera va en otro hilo: Flask arranca igual y /healthz responde, así
+    # la plataforma no mata a la instancia de reserva (/webhook da 503 hasta el relevo)
+    print(f"⏸️ Otra instancia tiene {LEADER_LOCK}; en espera para tomar el relevo…")
+    def wait_and_lead():
+        lock.acquire()
+        lead()
+    threading.Thread(target=wait_and_lead, name="leader-wait", daemon=True).start()
+
+def lead():
+    global SHARDS
+    print(f"👑 Líder: {PROCS} workers, estado en {os.getenv('STATE_DB', 'state.db')}")
+    SHARDS = Shards(PROCS, [os.path.abspath(__file__)], max_pending=MAX_PENDING)
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        threading.Thread(target=poll_raw, args=(SHARDS.submit,), name="poll", daemon=True).start()
+
+def run_worker():
+    """Proceso worker: atiende los updates de su shard hasta que el líder cierre stdin."""
+    print(f"🧩 Worker {SHARD}/{PROCS} (pid {os.getpid()})")
+    resume_jobs()
+    load_schedules()
+    def submit(raw):
+        u = types.Update.de_json(raw)
+        while not pool.submit(update_chat_id(u), u):
+            time.sleep(0.05)
+    read_updates(submit)
+    while pool.pending():
+        time.sleep(0.1)
+    DB.flush()
+
+def run_webhook():
+    url = WEBHOOK_URL.rstrip("/") + "/webhook"
+    print(f"▶️ Registrando webhook en {url} ({WORKERS} workers)")
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET or None,
+                    allowed_updates=["message","callback_query"],
+                    drop_pending_updates=True, max_connections=40)
+
 app = Flask(__name__)
 
 @app.get("/")
@@ -609,7 +1983,44 @@ def root():
 def healthz():
     return jsonify(status="ok"), 200
 
+@app.get("/metrics")
+def metrics_endpoint():
+    return telemetry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.post("/webhook")
+def webhook():
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return "forbidden", 403
+    if ROLE == "leader" and SHARDS is None:
+        # instancia de reserva esperando el lock: Telegram reintenta más tarde
+        return "standby", 503
+    if SHARDS is not None and BOT_MODE == "webhook":
+        raw = request.get_data(as_text=True)
+        d = json.loads(raw)
+        UPDATES.inc("callback_query" if "callback_query" in d else "message" if "message" in d else "other")
+        if not SHARDS.submit(chat_key(d), raw):
+            return "busy", 503
+        return "", 200
+    if pool is None:
+        return "polling mode", 404
+    u = types.Update.de_json(request.get_data(as_text=True))
+    if not pool.submit(update_chat_id(u), u):
+        # cola llena: Telegram reintenta más tarde
+        return "busy", 503
+    return "", 200
+
 if __name__ == "__main__":
-    threading.Thread(target=run_polling, daemon=True).start()
+    if ROLE == "worker":
+        run_worker()
+        raise SystemExit(0)
+    if ROLE == "leader":
+        run_leader()
+    else:
+        resume_jobs()
+        load_schedules()
+        if BOT_MODE == "webhook":
+            run_webhook()
+        else:
+            threading.Thread(target=run_polling, daemon=True).start()
     print(f"🌐 Servidor Flask en 0.0.0.0:{PORT}")
-    app.run(host="0.0.0.0", port=PORT)
+    app.run(host="0.0.0.0", port=PORT, threaded=True)
@@ -0,0 +1,118 @@
+import json, time, random, threading, itertools
+from urllib.parse import urlparse, parse_qs
+
+# =====================
+# Dobles en proceso de la Bot API y de Graph API
+# =====================
+# Se enchufan en los puntos de salida reales (CUSTOM_REQUEST_SENDER de telebot
+# y la sesión HTTP de MetaClient), así que el código del bot corre completo:
+# serialización, parseo, reintentos y lectura de headers de uso. Cada llamada
+# duerme la latencia configurada y falla con la probabilidad indicada.
+
+class FakeResponse:
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+class _Latency:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}            # método -> llamadas
+        self.errors = 0
+
+    def _hit(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            delay = max(0.0, self._rnd.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            fail = self._rnd.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        return fail
+
+class FakeTelegram(_Latency):
+    """Reemplazo de apihelper.CUSTOM_REQUEST_SENDER. Los errores son 429 con retry_after."""
+    def __init__(self, retry_after=1, **kw):
+        super().__init__(**kw)
+        self.retry_after = retry_after
+        self._mid = itertools.count(1000)
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        name = url.rsplit("/", 1)[-1]
+        if self._hit(name):
+            return FakeResponse(429, {"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry later",
+                                      "parameters": {"retry_after": self.retry_after}})
+        params = params or {}
+        if name in ("sendMessage", "editMessageText", "sendDocument"):
+            result = {"message_id": int(params.get("message_id") or next(self._mid)),
+                      "date": int(time.time()), "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}}
+        elif name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return FakeResponse(200, {"ok": True, "result": result})
+
+class FakeGraph(_Latency):
+    """Reemplazo de MetaClient.session. Los errores son HTTP 500 transitorios (code 2)."""
+    USAGE = {"X-Ad-Account-Usage": json.dumps({"acc_id_util_pct": 5})}
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self._ids = itertools.count(10**14)
+        self.ads = []
+
+    def _new_id(self, kind):
+        oid = str(next(self._ids))
+        if kind == "ads":
+            self.ads.append(oid)
+        return oid
+
+    def request(self, method, url, params=None, data=None, files=None, headers=None, timeout=None):
+        parts = urlparse(url).path.split("/", 2)     # ["", "v20.0", "act_1/ads"]
+        path = parts[2] if len(parts) > 2 else ""
+        label = path.rsplit("/", 1)[-1] or ("batch" if method == "POST" else "ids")
+        if self._hit(f"{method} {label}"):
+            return FakeResponse(500, {"error": {"message": "An unexpected error has occurred.",
+                                                "code": 2, "is_transient": True}}, self.USAGE)
+        return FakeResponse(200, self._route(method, path, dict(params or {}), dict(data or {})), self.USAGE)
+
+    def _route(self, method, path, params, data):
+        if method == "POST" and not path and "batch" in data:
+            return [self._batch_op(op) for op in json.loads(data["batch"])]
+        if method == "GET" and not path and "ids" in params:
+            return {i: {"id": i, "effective_status": "ACTIVE", "configured_status": "ACTIVE"}
+                    for i in params["ids"].split(",")}
+        if path.endswith("/insights"):
+            if method == "POST":
+                return {"report_run_id": "run" + self._new_id("run")}
+            return {"data": [self._insight(ad) for ad in self.ads], "paging": {}}
+        if method == "GET" and path.startswith("run"):
+            return {"async_status": "Job Completed", "async_percent_completion": 100}
+        if method == "GET":
+            return {"id": path or "1", "name": "bench"}
+        if method == "DELETE":
+            return {"success": True}
+        kind = path.rsplit("/", 1)[-1]
+        return {"id": self._new_id(kind)} if kind in ("campaigns", "adsets", "adcreatives", "ads") \
+            else {"success": True}
+
+    def _batch_op(self, op):
+        method, rel = op["method"], op["relative_url"]
+        body = {k: v[0] for k, v in parse_qs(op.get("body", "")).items()}
+        return {"code": 200, "headers": [], "body": json.dumps(self._route(method, rel, {}, body))}
+
+    def _insight(self, ad_id):
+        n = int(ad_id) % 97
+        return {"ad_id": ad_id, "ad_name": f"Ad {ad_id}", "spend": str(1000 + 37 * n),
+                "impressions": str(500 + 11 * n),
+                "actions": [{"action_type": "onsite_conversion.messaging_conversation_started_7d",
+                             "value": str(1 + n % 9)}]}
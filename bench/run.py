@@ -0,0 +1,248 @@
+"""Benchmark del bot con Telegram y Graph simulados en proceso.
+
+    python bench/run.py [--chats 200] [--tg-latency 0.02] [--meta-latency 0.05]
+                        [--error-rate 0.01] [--backend json|sqlite] [--out res.json]
+
+Escenarios:
+  updates  flujo sintético (/start, menús, alta de línea, métricas) por el
+           webhook real (Flask -> ChatPool -> handlers): updates/s y latencia
+           p50/p99 por handler.
+  publish  publish_to_meta() por línea: primer anuncio (crea campaña y ad set)
+           y siguientes (reutilizan).
+  save     costo de save_all() + flush al crecer chats y anuncios por chat.
+
+Imprime un JSON con los resultados (y lo guarda en --out) para comparar corridas.
+"""
+import os, sys, json, time, argparse, tempfile, threading, platform, itertools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def pct(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def summary(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {"n": len(ms), "p50_ms": pct(ms, 50), "p99_ms": pct(ms, 99),
+            "max_ms": max(ms) if ms else None,
+            "mean_ms": sum(ms) / len(ms) if ms else None}
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--chats", type=int, default=200, help="chats en el flujo de updates")
+    ap.add_argument("--lines", type=int, default=3, help="líneas por chat en el flujo")
+    ap.add_argument("--replay", type=int, default=600,
+                    help="updates re-ejecutados en serie para la latencia por tipo")
+    ap.add_argument("--publishes", type=int, default=40, help="publicaciones a medir")
+    ap.add_argument("--save-grid", default="100x5,500x5,500x50,2000x20",
+                    help="tamaños CHATSxANUNCIOS para el escenario save")
+    ap.add_argument("--tg-latency", type=float, default=0.02, help="s por llamada a la Bot API")
+    ap.add_argument("--meta-latency", type=float, default=0.05, help="s por llamada a Graph")
+    ap.add_argument("--jitter", type=float, default=0.0, help="desviación de la latencia (s)")
+    ap.add_argument("--error-rate", type=float, default=0.0,
+                    help="probabilidad de 429 en Telegram y de 500 transitorio en Graph")
+    ap.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    ap.add_argument("--workers", type=int, default=16, help="WORKERS del ChatPool")
+    ap.add_argument("--real-limits", action="store_true",
+                    help="mantener los límites de envío de Telegram (30/s, 1/s por chat)")
+    ap.add_argument("--scenarios", default="updates,publish,save")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out")
+    return ap.parse_args()
+
+def setup_env(args, tmp):
+    # todo lo que lee app.py al importarse
+    os.environ.update({
+        "TG_TOKEN": "123456:bench", "BOT_MODE": "webhook", "WEBHOOK_URL": "https://bench.local",
+        "WEBHOOK_SECRET": "", "WORKERS": str(args.workers), "MAX_PENDING": "1000000",
+        "DATA_FILE": os.path.join(tmp, "data.json"), "STATE_DB": os.path.join(tmp, "state.db"),
+        "STATE_BACKEND": args.backend, "MEDIA_CACHE": os.path.join(tmp, "media_cache.json"),
+        "FB_ACCESS_TOKEN": "bench", "FB_AD_ACCOUNT_ID": "act_1", "FB_PAGE_ID": "1",
+        "FB_WABA_PHONE": "570000000000",
+    })
+    if not args.real_limits:
+        os.environ.update({"TG_GLOBAL_RATE": "1000000", "TG_CHAT_RATE": "1000000",
+                           "TG_CHAT_BURST": "1000000"})
+
+# ---------- flujo de updates ----------
+def _msg(uid, cid, text=None, photo=False):
+    m = {"message_id": next(_uids), "date": int(time.time()),
+         "chat": {"id": cid, "type": "private"}, "from": {"id": cid, "is_bot": False, "first_name": "u"}}
+    if photo:
+        m["photo"] = [{"file_id": f"ph{cid}", "file_unique_id": f"u{cid}", "width": 90, "height": 90}]
+    else:
+        m["text"] = text
+        if text.startswith("/"):
+            m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": uid, "message": m}
+
+def _cbq(uid, cid, data):
+    return {"update_id": uid, "callback_query": {
+        "id": str(uid), "chat_instance": str(cid), "data": data,
+        "from": {"id": cid, "is_bot": False, "first_name": "u"},
+        "message": {"message_id": 1, "date": int(time.time()), "text": "menu",
+                    "chat": {"id": cid, "type": "private"}}}}
+
+_uids = itertools.count(1)
+
+def chat_script(cid, lines):
+    """Updates de una sesión típica; los ids de línea internados empiezan en 1."""
+    yield "start", lambda uid: _msg(uid, cid, "/start")
+    for n in range(lines):
+        lid = format(n + 1, "x")
+        yield "cb:n", lambda uid: _cbq(uid, cid, "n")
+        yield "text:line", lambda uid, n=n: _msg(uid, cid, f"Línea {n}")
+        yield "photo", lambda uid: _msg(uid, cid, photo=True)
+        yield "text:title", lambda uid: _msg(uid, cid, "Título de prueba")
+        yield "text:desc", lambda uid: _msg(uid, cid, "Descripción de prueba")
+        yield "cb:ls", lambda uid: _cbq(uid, cid, "ls")
+        yield "cb:ol", lambda uid, lid=lid: _cbq(uid, cid, f"ol:{lid}")
+        yield "cb:va", lambda uid, lid=lid: _cbq(uid, cid, f"va:{lid}:0")
+    yield "cb:b", lambda uid: _cbq(uid, cid, "b")
+    yield "cb:m", lambda uid: _cbq(uid, cid, "m")
+    yield "cb:mw", lambda uid: _cbq(uid, cid, "mw:7d")
+    yield "cb:h", lambda uid: _cbq(uid, cid, "h")
+
+def bench_updates(app, args):
+    # intercala las sesiones de todos los chats, como llegarían en producción
+    scripts = [list(chat_script(10_000 + i, args.lines)) for i in range(args.chats)]
+    stream = []
+    for step in itertools.zip_longest(*scripts):
+        stream += [s for s in step if s]
+    bodies = [(kind, json.dumps(make(next(_uids)))) for kind, make in stream]
+
+    lat, done = [], threading.Semaphore(0)
+    inner = app.bot.process_new_updates
+    def timed(updates):
+        t0 = time.perf_counter()
+        try:
+            inner(updates)
+        finally:
+            dt = time.perf_counter() - t0
+            lat.append(dt)
+            done.release()
+    app.bot.process_new_updates = timed
+
+    client = app.app.test_client()
+    t0 = time.perf_counter()
+    for kind, body in bodies:
+        r = client.post("/webhook", data=body, content_type="application/json")
+        assert r.status_code == 200, r.status_code
+    for _ in bodies:
+        done.acquire()
+    elapsed = time.perf_counter() - t0
+    app.bot.process_new_updates = inner
+
+    # latencia por tipo: el orden de finalización no es el de envío, se mide aparte
+    by_kind = {}
+    for kind, make in stream[:args.replay]:
+        u = app.types.Update.de_json(json.dumps(make(next(_uids))))
+        t = time.perf_counter()
+        inner([u])
+        by_kind.setdefault(kind, []).append(time.perf_counter() - t)
+    return {"updates": len(bodies), "seconds": elapsed, "updates_per_sec": len(bodies) / elapsed,
+            "handler": summary(lat), "by_kind": {k: summary(v) for k, v in sorted(by_kind.items())}}
+
+# ---------- publicación ----------
+def bench_publish(app, args):
+    first, reuse, failed = [], [], 0
+    parents = {}
+    for n in range(args.publishes):
+        line = f"Bench {n % max(1, args.publishes // 4)}"
+        ids = parents.get(line, {})
+        t0 = time.perf_counter()
+        try:
+            res = app.publish_to_meta(app.ENV_ACCOUNT, line, "Título", "Descripción", 80_000, False,
+                                      campaign_id=ids.get("campaign_id"), adset_id=ids.get("adset_id"))
+        except Exception:
+            failed += 1
+            continue
+        (reuse if ids else first).append(time.perf_counter() - t0)
+        parents[line] = res
+    return {"first_ad": summary(first), "reused_line": summary(reuse), "failed": failed}
+
+# ---------- persistencia ----------
+def _fake_chat(n_ads, tag):
+    ads = [(format(i + 1, "x"), {"title": f"Anuncio {i}", "desc": "x" * 80,
+            "meta": {"campaign_id": f"c{tag}", "adset_id": f"s{tag}", "status": "ACTIVE",
+                     "ad_id": f"{tag}{i:05d}", "cpm_msg": "1,234 COP (7d)"}}) for i in range(n_ads)]
+    per_line = max(1, n_ads // 3)
+    store = {}
+    for i in range(0, n_ads, per_line):
+        store[f"Línea {i // per_line}"] = {"campaign_id": f"c{tag}", "adset_id": f"s{tag}",
+                                            "ads": dict(ads[i:i + per_line])}
+    return store, n_ads + 1
+
+def bench_save(app, args):
+    out, base = [], 10**9
+    for spec in args.save_grid.split(","):
+        chats, ads = map(int, spec.lower().split("x"))
+        cids = [base + i for i in range(chats)]
+        base += chats
+        for cid in cids:
+            state = app.st(cid)
+            state["store"], state["next_aid"] = _fake_chat(ads, cid)
+        t0 = time.perf_counter()
+        app.save_all()
+        mark_all = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        app.DB.flush()
+        full = time.perf_counter() - t0
+        one = []
+        for cid in cids[:50]:
+            app.st(cid)["store"]["Línea 0"]["ads"]["1"]["meta"]["status"] = "PAUSED"
+            t0 = time.perf_counter()
+            app.save_all(cid)
+            app.DB.flush()
+            one.append(time.perf_counter() - t0)
+        sizes = app.DB.sizes()
+        out.append({"chats": chats, "ads_per_chat": ads, "mark_all_ms": mark_all * 1000,
+                    "flush_all_ms": full * 1000, "save_one_chat": summary(one),
+                    "chat_bytes": max(sizes.get(c, sizes.get(str(c), 0)) for c in cids),
+                    "state_bytes": sum(sizes.values())})
+        for cid in cids:
+            app.S.pop(cid, None)
+            app.DB.forget(cid)
+    return out
+
+def main():
+    args = parse_args()
+    tmp = tempfile.mkdtemp(prefix="metabot-bench-")
+    setup_env(args, tmp)
+
+    from fakes import FakeTelegram, FakeGraph
+    from telebot import apihelper
+    tg = FakeTelegram(latency=args.tg_latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    graph = FakeGraph(latency=args.meta_latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    apihelper.CUSTOM_REQUEST_SENDER = tg
+
+    import app
+    # todos los clientes del pool hablan con el Graph simulado
+    new_client = app.CLIENTS.get
+    def get_client(account_id, token):
+        client = new_client(account_id, token)
+        client.session = graph
+        return client
+    app.CLIENTS.get = get_client
+
+    result = {"config": {**{k: v for k, v in vars(args).items() if k != "out"},
+                         "python": platform.python_version(), "ts": int(time.time())}}
+    for name in args.scenarios.split(","):
+        fn = {"updates": bench_updates, "publish": bench_publish, "save": bench_save}[name.strip()]
+        t0 = time.perf_counter()
+        result[name] = fn(app, args)
+        result[name + "_wall_s"] = time.perf_counter() - t0
+    app.DB.flush()
+    result["fake_calls"] = {"telegram": tg.calls, "graph": graph.calls,
+                            "telegram_errors": tg.errors, "graph_errors": graph.errors}
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+if __name__ == "__main__":
+    main()
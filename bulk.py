@@ -0,0 +1,154 @@
+import io, csv, codecs, tempfile, unicodedata
+
+# =====================
+# Importación masiva desde CSV / XLSX
+# =====================
+# Se lee la planilla fila a fila (CSV con csv.reader, XLSX con openpyxl en
+# modo read_only) y cada fila se valida al vuelo: nunca se arma la planilla
+# entera en memoria, solo las filas ya validadas. openpyxl es opcional: sin
+# él solo se aceptan CSV.
+
+COLUMNS = {
+    "line":   ("linea", "line", "linea de producto"),
+    "title":  ("titulo", "title"),
+    "desc":   ("descripcion", "description", "desc"),
+    "media":  ("media", "url", "imagen", "video", "archivo", "file"),
+    "budget": ("presupuesto", "budget"),
+    "status": ("estado", "status"),
+}
+REQUIRED = ("line", "title", "desc")
+STATUSES = {"activa": "ACTIVE", "activo": "ACTIVE", "active": "ACTIVE", "si": "ACTIVE",
+            "pausada": "PAUSED", "pausado": "PAUSED", "paused": "PAUSED", "no": "PAUSED", "": "PAUSED"}
+VIDEO_EXT = (".mp4", ".mov", ".m4v", ".avi", ".webm")
+MAX_TITLE, MAX_DESC = 255, 2000
+SNIFF_BYTES = 4096
+READ_BLOCK = 64 * 1024
+RESULT_FIELDS = ("fila", "linea", "titulo", "resultado", "ad_id", "campaign_id", "adset_id", "error")
+
+def _norm(text):
+    text = unicodedata.normalize("NFKD", str(text or "")).encode("ascii", "ignore").decode()
+    return " ".join(text.lower().replace("_", " ").split())
+
+def _header(cells):
+    """Posición de cada columna conocida; falla si falta una obligatoria."""
+    alias = {a: key for key, names in COLUMNS.items() for a in names}
+    pos = {}
+    for n, cell in enumerate(cells):
+        key = alias.get(_norm(cell))
+        if key and key not in pos:
+            pos[key] = n
+    missing = [COLUMNS[k][0] for k in REQUIRED if k not in pos]
+    if missing:
+        raise ValueError(f"Faltan columnas: {', '.join(missing)}. Encabezados: "
+                         + ", ".join(names[0] for names in COLUMNS.values()))
+    return pos
+
+def _encoding(fobj):
+    """utf-8-sig si todo el archivo es UTF-8 válido; si no, cp1252 (Excel en
+    Windows). Se valida el archivo entero por bloques: mirar solo el comienzo
+    confunde un carácter cortado en el borde con un archivo que no es UTF-8."""
+    dec = codecs.getincrementaldecoder("utf-8-sig")()
+    try:
+        for block in iter(lambda: fobj.read(READ_BLOCK), b""):
+            dec.decode(block)
+        dec.decode(b"", final=True)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1252"
+    finally:
+        fobj.seek(0)
+
+def _csv_rows(fobj):
+    encoding = _encoding(fobj)
+    head = fobj.read(SNIFF_BYTES)
+    fobj.seek(0)
+    # la muestra puede terminar a mitad de un carácter: solo sirve para el dialecto
+    sample = head.decode(encoding, errors="ignore")
+    try:
+        # Excel en español guarda con ';'
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    text = io.TextIOWrapper(fobj, encoding=encoding, newline="", errors="replace")
+    yield from csv.reader(text, dialect)
+
+def _xlsx_rows(fobj):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Para leer .xlsx falta el paquete openpyxl; envía la planilla como CSV.")
+    wb = load_workbook(fobj, read_only=True, data_only=True)
+    try:
+        for row in wb.worksheets[0].iter_rows(values_only=True):
+            yield ["" if v is None else v for v in row]
+    finally:
+        wb.close()
+
+def read_rows(fobj, filename):
+    """Genera (número de fila, {columna: texto}) saltando filas vacías."""
+    name = (filename or "").lower()
+    if name.endswith(".csv"):
+        rows = _csv_rows(fobj)
+    elif name.endswith((".xlsx", ".xlsm")):
+        rows = _xlsx_rows(fobj)
+    else:
+        raise ValueError("Formato no soportado: envía un .csv o .xlsx")
+    pos = None
+    for n, cells in enumerate(rows, 1):
+        if not any(str(c).strip() for c in cells):
+            continue
+        if pos is None:
+            pos = _header(cells)
+            continue
+        yield n, {k: _cell(cells[i]) if i < len(cells) else "" for k, i in pos.items()}
+    if pos is None:
+        raise ValueError("La planilla está vacía.")
+
+def _cell(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)          # 80000.0 en XLSX
+    return str(value).strip()
+
+def validate(raw, min_budget=1000):
+    """Fila lista para publicar o ValueError con el motivo."""
+    errors = [f"falta {COLUMNS[k][0]}" for k in REQUIRED if not raw.get(k)]
+    if len(raw.get("title", "")) > MAX_TITLE:
+        errors.append(f"título de más de {MAX_TITLE} caracteres")
+    if len(raw.get("desc", "")) > MAX_DESC:
+        errors.append(f"descripción de más de {MAX_DESC} caracteres")
+    budget = None
+    if raw.get("budget"):
+        try:
+            budget = int(raw["budget"].replace(".", "").replace(",", "").replace("$", "").strip())
+            if budget < min_budget:
+                errors.append(f"presupuesto menor a {min_budget:,}")
+        except ValueError:
+            errors.append(f"presupuesto inválido «{raw['budget']}»")
+    status = STATUSES.get(_norm(raw.get("status")))
+    if status is None:
+        errors.append(f"estado inválido «{raw['status']}» (activa | pausada)")
+    media = _media(raw.get("media", ""))
+    if errors:
+        raise ValueError("; ".join(errors))
+    return {"line": raw["line"], "title": raw["title"], "desc": raw["desc"],
+            "budget": budget, "activate": status == "ACTIVE", "media": media}
+
+def _media(value):
+    """URL http(s) o file_id de Telegram; el tipo se deduce de la extensión."""
+    if not value:
+        return None
+    kind = "video" if value.lower().split("?")[0].endswith(VIDEO_EXT) else "photo"
+    if value.startswith(("http://", "https://")):
+        return {"kind": kind, "url": value}
+    return {"kind": "photo", "file_id": value}
+
+def write_results(results):
+    """CSV con el resultado de cada fila en un temporal; devuelve la ruta."""
+    f = tempfile.NamedTemporaryFile("w", suffix=".csv", prefix="importacion-", delete=False,
+                                    encoding="utf-8-sig", newline="")
+    with f:
+        w = csv.DictWriter(f, RESULT_FIELDS, extrasaction="ignore")
+        w.writeheader()
+        for r in results:
+            w.writerow(r)
+    return f.name
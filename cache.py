@@ -0,0 +1,103 @@
+import time, threading, contextlib
+from collections import OrderedDict
+
+# =====================
+# Caché LRU + TTL en memoria
+# =====================
+# get_or_load() deduplica cargas concurrentes de la misma clave: si varios
+# chats piden lo mismo a la vez, solo uno llama a Meta y el resto espera.
+# SingleFlight hace lo mismo sin guardar el resultado, para cosas que no
+# caben en memoria (archivos temporales) y se limpian al terminar de usarse.
+
+class TTLCache:
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (expira, valor)
+        self._lock = threading.Lock()
+        self._loading = {}           # key -> Lock de la carga en curso
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get_or_load(self, key, loader):
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        with self._lock:
+            lock = self._loading.setdefault(key, threading.Lock())
+        with lock:
+            value = self.get(key, missing)
+            if value is missing:
+                value = loader()
+                self.set(key, value)
+        with self._lock:
+            if self._loading.get(key) is lock:
+                del self._loading[key]
+        return value
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.users = 0
+
+class SingleFlight:
+    """Pedidos concurrentes con la misma clave comparten una sola ejecución.
+    cleanup(resultado) corre cuando el último que lo estaba usando termina."""
+    def __init__(self, cleanup=None):
+        self._cleanup = cleanup
+        self._calls = {}             # key -> _Flight en curso
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def share(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Flight()
+            call.users += 1
+        try:
+            if leader:
+                try:
+                    call.result = fn()
+                except Exception as e:
+                    call.error = e
+                finally:
+                    # lo que llegue después arranca una ejecución nueva
+                    with self._lock:
+                        self._calls.pop(key, None)
+                    call.done.set()
+            else:
+                call.done.wait()
+            if call.error is not None:
+                raise call.error
+            yield call.result
+        finally:
+            with self._lock:
+                call.users -= 1
+                last = call.users == 0
+            if last and call.result is not None and self._cleanup:
+                self._cleanup(call.result)
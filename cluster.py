@@ -0,0 +1,96 @@
+import os, sys, time, fcntl, queue, threading, subprocess
+
+# =====================
+# Modo multi-proceso
+# =====================
+# Un líder (quien tenga el lock de LEADER_LOCK) recibe los updates, por polling
+# o webhook, y los reparte por chat a N procesos worker: chat_id % N, así que
+# un chat siempre lo atiende el mismo worker y su caché en memoria es
+# coherente. Los workers comparten el estado en SQLite (WAL). Cada worker lee
+# updates como JSON, uno por línea, desde su stdin. Si un worker muere, el
+# líder lo relanza y sigue con la cola de ese shard; los demás chats no se
+# enteran. Una segunda instancia queda en espera del lock y toma el relevo si
+# el líder cae.
+
+class LeaderLock:
+    """flock exclusivo sobre un archivo local (vale entre procesos del mismo host)."""
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, block=True):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd      # el lock vive mientras el proceso mantenga el fd
+        return True
+
+def chat_key(update):
+    """chat id de un update crudo (dict de la Bot API)."""
+    for kind in ("message", "edited_message", "channel_post"):
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    cq = update.get("callback_query")
+    if cq:
+        return cq["message"]["chat"]["id"] if cq.get("message") else cq["from"]["id"]
+    return update.get("update_id", 0)
+
+class Shards:
+    """Procesos worker con una cola acotada cada uno; submit() no bloquea."""
+    def __init__(self, n, argv, max_pending=1000, name="shard"):
+        self.n = n
+        self._argv = argv
+        self._queues = [queue.Queue(maxsize=max_pending) for _ in range(n)]
+        self._procs = [self._spawn(i) for i in range(n)]
+        for i in range(n):
+            threading.Thread(target=self._feed, args=(i,), name=f"{name}-{i}", daemon=True).start()
+
+    def _spawn(self, i):
+        env = {**os.environ, "CLUSTER_ROLE": "worker", "CLUSTER_SHARD": str(i), "PROCS": str(self.n)}
+        return subprocess.Popen([sys.executable, *self._argv], stdin=subprocess.PIPE, env=env,
+                                text=True, encoding="utf-8")
+
+    def submit(self, key, raw):
+        """raw: update en JSON. False si la cola del shard está llena."""
+        try:
+            self._queues[int(key) % self.n].put_nowait(raw)
+            return True
+        except queue.Full:
+            return False
+
+    def pending(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _feed(self, i):
+        raw = None
+        while True:
+            if raw is None:
+                try:
+                    raw = self._queues[i].get(timeout=2)
+                except queue.Empty:
+                    pass
+            proc = self._procs[i]
+            if proc.poll() is not None:
+                print(f"⚠️ Worker {i} terminó (código {proc.returncode}); relanzando")
+                proc = self._procs[i] = self._spawn(i)
+            if raw is None:
+                continue
+            try:
+                # el JSON de Telegram no trae saltos de línea fuera de strings
+                proc.stdin.write(raw.replace("\n", " ") + "\n")
+                proc.stdin.flush()
+                raw = None
+            except (BrokenPipeError, OSError, ValueError):
+                # el worker cayó a mitad de escritura: se relanza y se reenvía
+                time.sleep(1)
+
+def read_updates(submit):
+    """Bucle del worker: cada línea de stdin es un update; termina con EOF."""
+    for line in sys.stdin:
+        if line.strip():
+            submit(line)
@@ -0,0 +1,127 @@
+import os, csv, gzip, json, time, tempfile
+from cache import TTLCache
+from meta_client import MetaError
+
+# =====================
+# Insights de Meta (gasto, conversaciones, costo por mensaje)
+# =====================
+# Una sola consulta por cuenta y ventana a nivel de anuncio (level=ad), con
+# las acciones desglosadas por tipo. Cuentas grandes van por report run
+# asíncrono. El resultado queda en caché por (cuenta, ventana).
+#
+# La exportación (stream / export_csv) no junta nada en memoria: recorre los
+# cursores de paginación como generador, con una fila por anuncio y día, y
+# escribe cada fila a un CSV comprimido a medida que llega.
+
+WINDOWS = {"24h": "today", "7d": "last_7d", "28d": "last_28d"}
+MSG_ACTION = "onsite_conversion.messaging_conversation_started_7d"
+FIELDS = "ad_id,ad_name,spend,impressions,actions"
+ASYNC_MIN_ADS = 200     # desde cuántos anuncios se usa el report run asíncrono
+ASYNC_TIMEOUT = 120     # s máximos esperando el reporte
+
+CACHE = TTLCache(maxsize=256, ttl=300)
+
+def _parse(row):
+    msgs = sum(int(float(a.get("value", 0))) for a in row.get("actions", [])
+               if a.get("action_type") == MSG_ACTION)
+    spend = float(row.get("spend", 0) or 0)
+    return {
+        "ad_id": row.get("ad_id"),
+        "spend": spend,
+        "impressions": int(row.get("impressions", 0) or 0),
+        "messages": msgs,
+        "cost_per_msg": (spend / msgs) if msgs else None,
+    }
+
+def _pages(client, path, params):
+    params = dict(params)
+    while True:
+        data = client.get(path, **params)
+        yield from data.get("data", [])
+        after = data.get("paging", {}).get("cursors", {}).get("after")
+        if not after or "next" not in data.get("paging", {}):
+            return
+        params["after"] = after
+
+def _async_rows(client, account_id, params):
+    run = client.post(f"{account_id}/insights", **params)
+    run_id = run["report_run_id"]
+    deadline, delay = time.time() + ASYNC_TIMEOUT, 1.0
+    while True:
+        job = client.get(run_id, fields="async_status,async_percent_completion")
+        status = job.get("async_status")
+        if status == "Job Completed":
+            break
+        if status in ("Job Failed", "Job Skipped"):
+            raise MetaError(f"Reporte de insights {status}")
+        if time.time() > deadline:
+            raise MetaError("El reporte de insights tardó demasiado", transient=True)
+        time.sleep(delay)
+        delay = min(delay * 1.5, 10.0)
+    return _pages(client, f"{run_id}/insights", {"limit": 500})
+
+def fetch(client, account_id, window, n_ads=0):
+    params = {"level": "ad", "date_preset": WINDOWS[window], "fields": FIELDS,
+              "action_breakdowns": "action_type", "limit": 500}
+    if n_ads >= ASYNC_MIN_ADS:
+        rows = _async_rows(client, account_id, params)
+    else:
+        try:
+            rows = list(_pages(client, f"{account_id}/insights", params))
+        except MetaError as e:
+            if e.code != 1:   # "Please reduce the amount of data": pasa a asíncrono
+                raise
+            rows = _async_rows(client, account_id, params)
+    return {r["ad_id"]: r for r in map(_parse, rows) if r["ad_id"]}
+
+def get(client, account_id, window, n_ads=0):
+    """Insights {ad_id: {...}} de la cuenta para la ventana, con caché compartida."""
+    return CACHE.get_or_load((account_id, window),
+                             lambda: fetch(client, account_id, window, n_ads))
+
+def summarize(rows):
+    spend = sum(r["spend"] for r in rows)
+    msgs = sum(r["messages"] for r in rows)
+    return {"spend": spend, "messages": msgs, "cost_per_msg": (spend / msgs) if msgs else None}
+
+EXPORT_FIELDS = "ad_id,ad_name,spend,impressions,clicks,actions"
+EXPORT_COLUMNS = ("fecha", "ad_id", "ad_name", "spend", "impressions", "clicks", "messages", "cost_per_msg")
+
+def range_params(rng):
+    """rng: ventana de WINDOWS o (desde, hasta) en AAAA-MM-DD."""
+    if isinstance(rng, str):
+        return {"date_preset": WINDOWS[rng]}
+    since, until = rng
+    return {"time_range": json.dumps({"since": since, "until": until})}
+
+def stream(client, account_id, rng):
+    """Genera filas crudas de insights por anuncio y día de toda la cuenta."""
+    params = {"level": "ad", "fields": EXPORT_FIELDS, "action_breakdowns": "action_type",
+              "time_increment": 1, "limit": 500, **range_params(rng)}
+    n = 0
+    try:
+        for row in _pages(client, f"{account_id}/insights", params):
+            n += 1
+            yield row
+    except MetaError as e:
+        if e.code != 1 or n:
+            raise
+        yield from _async_rows(client, account_id, params)
+
+def export_csv(client, account_id, rng):
+    """Vuelca stream() a un CSV gzip temporal; devuelve la ruta."""
+    f = tempfile.NamedTemporaryFile(suffix=".csv.gz", prefix="insights-", delete=False)
+    f.close()
+    try:
+        with gzip.open(f.name, "wt", encoding="utf-8", newline="") as out:
+            w = csv.writer(out)
+            w.writerow(EXPORT_COLUMNS)
+            for row in stream(client, account_id, rng):
+                r = _parse(row)
+                w.writerow((row.get("date_start"), r["ad_id"], row.get("ad_name", ""), r["spend"],
+                            r["impressions"], row.get("clicks", ""), r["messages"],
+                            "" if r["cost_per_msg"] is None else round(r["cost_per_msg"], 2)))
+    except BaseException:
+        os.remove(f.name)
+        raise
+    return f.name
@@ -0,0 +1,38 @@
+import threading, queue, traceback
+
+# =====================
+# Cola de trabajos en segundo plano
+# =====================
+# Los trabajos son dicts que viven en el estado del chat (y por lo tanto se
+# persisten con él); la cola solo guarda referencias (cid, job_id). El estado
+# de cada trabajo es "queued" -> "running" -> "done" | "failed".
+
+class JobQueue:
+    def __init__(self, runner, workers=2, name="job-worker"):
+        self._runner = runner       # runner(cid, job_id)
+        self._q = queue.Queue()
+        self._active = set()
+        self._lock = threading.Lock()
+        for n in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-{n}", daemon=True).start()
+
+    def submit(self, cid, job_id):
+        """Encola una sola vez por (cid, job_id); False si ya estaba en curso."""
+        with self._lock:
+            if (cid, job_id) in self._active:
+                return False
+            self._active.add((cid, job_id))
+        self._q.put((cid, job_id))
+        return True
+
+    def _run(self):
+        while True:
+            cid, job_id = self._q.get()
+            try:
+                self._runner(cid, job_id)
+            except Exception as e:
+                print("JobQueue runner error:", repr(e))
+                print(traceback.format_exc())
+            finally:
+                with self._lock:
+                    self._active.discard((cid, job_id))
@@ -0,0 +1,190 @@
+import os, json, socket, hashlib, ipaddress, tempfile, threading
+from urllib.parse import urljoin, urlsplit
+import requests
+
+# =====================
+# Media: Telegram -> Meta
+# =====================
+# El archivo se baja de la API de archivos de Telegram en streaming a un
+# temporal (en memoria si es chico, en disco si no) calculando su sha256 al
+# vuelo. Con el hash se consulta la caché contenido -> image_hash / video_id
+# de la cuenta; solo si no está se sube: imágenes a /adimages y videos por
+# el upload por partes de /advideos (start / transfer / finish), leyendo del
+# temporal un chunk a la vez. Lo mismo vale para URLs http(s) (importación
+# masiva), que se bajan cada vez pero se deduplican por contenido. Esas URLs
+# vienen de la planilla: solo se aceptan hosts públicos (también en cada
+# redirección) y se corta la descarga al pasar el límite de Meta para el tipo.
+
+READ_CHUNK  = 64 * 1024
+SPOOL_MAX   = 1024 * 1024        # hasta 1 MB en memoria, luego a disco
+MAX_BYTES   = {"photo": 30 * 1024**2, "video": 4 * 1024**3}   # límites de Meta
+MAX_REDIRECTS = 5
+
+def check_public(url):
+    """Falla si la URL no es http(s) o su host resuelve a una dirección no
+    pública (loopback, red privada, link-local, metadata de la nube…)."""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise RuntimeError("La URL del archivo debe ser http(s)")
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                   proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError):
+        raise RuntimeError(f"No se encontró el host {parts.hostname}") from None
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not ip.is_global:
+            raise RuntimeError(f"El host {parts.hostname} no es público")
+
+class MediaPipeline:
+    def __init__(self, bot, token, cache_path="media_cache.json"):
+        self.bot = bot
+        self.token = token               # token del bot, para la URL de archivos
+        self.cache_path = cache_path
+        self.http = requests.Session()
+        self._lock = threading.Lock()
+        self._cache = {}                 # "<cuenta>:<sha256>" -> {"image_hash"| "video_id"}
+                                         # "uid:<file_unique_id>" -> sha256
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                self._cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    # ---------- caché ----------
+    def _get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def _put(self, **entries):
+        with self._lock:
+            try:
+                # otros procesos (PROCS>1) pueden haber agregado entradas
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    self._cache.update(json.load(f))
+            except (FileNotFoundError, ValueError):
+                pass
+            self._cache.update(entries)
+            tmp = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._cache, f)
+            os.replace(tmp, self.cache_path)
+
+    # ---------- Telegram ----------
+    # Las URLs de la API de Telegram llevan el token del bot: ningún error que
+    # salga de aquí (y termina en el chat o en el estado) puede incluirlas.
+    def download(self, file_id):
+        """Baja el archivo en streaming. Devuelve (temporal, tamaño, sha256)."""
+        try:
+            info = self.bot.get_file(file_id)
+        except Exception as e:
+            raise RuntimeError(f"No se pudo consultar el archivo en Telegram: {self._redact(e)}") from None
+        return self.fetch(f"https://api.telegram.org/file/bot{self.token}/{info.file_path}")
+
+    def fetch(self, url, max_bytes=None, public_only=False):
+        """public_only: URL de terceros (planilla); cada salto se valida con
+        check_public y las redirecciones se siguen a mano."""
+        sha, size = hashlib.sha256(), 0
+        tmp = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX)
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                if public_only:
+                    check_public(url)
+                r = self.http.get(url, stream=True, timeout=60, allow_redirects=not public_only)
+                if not r.is_redirect:
+                    break
+                r.close()
+                url = urljoin(url, r.headers["Location"])
+            else:
+                raise RuntimeError("Demasiadas redirecciones al descargar el archivo")
+            with r:
+                r.raise_for_status()
+                declared = int(r.headers.get("Content-Length") or 0)
+                if max_bytes and declared > max_bytes:
+                    raise RuntimeError(_too_big(max_bytes))
+                for block in r.iter_content(READ_CHUNK):
+                    size += len(block)
+                    if max_bytes and size > max_bytes:
+                        raise RuntimeError(_too_big(max_bytes))
+                    sha.update(block)
+                    tmp.write(block)
+        except RuntimeError:
+            tmp.close()
+            raise
+        except requests.HTTPError as e:
+            tmp.close()
+            raise RuntimeError(f"No se pudo descargar el archivo (HTTP {e.response.status_code})") from None
+        except requests.RequestException as e:
+            tmp.close()
+            raise RuntimeError(f"No se pudo descargar el archivo ({type(e).__name__})") from None
+        tmp.seek(0)
+        return tmp, size, sha.hexdigest()
+
+    def fetch_url(self, url, kind):
+        """Archivo de una URL de la planilla: host público y a lo sumo el límite de Meta."""
+        return self.fetch(url, max_bytes=MAX_BYTES[kind], public_only=True)
+
+    def _redact(self, e):
+        return str(e).replace(self.token, "<token>") if self.token else str(e)
+
+    # ---------- Meta ----------
+    def _upload_image(self, client, account_id, fobj, name):
+        res = client.upload(f"{account_id}/adimages", {"filename": (name, fobj)})
+        return next(iter(res["images"].values()))["hash"]
+
+    def _upload_video(self, client, account_id, fobj, size, name):
+        url = f"https://graph-video.facebook.com/v{client.version}/{account_id}/advideos"
+        start = client.post(url, upload_phase="start", file_size=str(size))
+        session_id, video_id = start["upload_session_id"], start["video_id"]
+        lo, hi = int(start["start_offset"]), int(start["end_offset"])
+        while lo < hi:
+            # cada parte se reintenta sola en el cliente; Meta indica el siguiente rango
+            fobj.seek(lo)
+            part = client.upload(url, {"video_file_chunk": (name, fobj.read(hi - lo))},
+                                 upload_phase="transfer", upload_session_id=session_id,
+                                 start_offset=str(lo))
+            lo, hi = int(part["start_offset"]), int(part["end_offset"])
+        client.post(url, upload_phase="finish", upload_session_id=session_id, title=name)
+        return video_id
+
+    def resolve(self, client, account_id, media):
+        """media = {"kind": "photo"|"video", "file_id", "unique_id", "thumb"?} o
+        {"kind", "url"}. Devuelve {"image_hash"} o {"video_id", "image_hash"?}
+        listos para el creativo."""
+        if media.get("url"):
+            return self._asset(client, account_id, None, None, media["kind"], url=media["url"])
+        if media["kind"] == "video":
+            out = {"video_id": self._asset(client, account_id, media["file_id"],
+                                           media.get("unique_id"), "video")["video_id"]}
+            if media.get("thumb"):
+                out["image_hash"] = self._asset(client, account_id, media["thumb"],
+                                                media.get("thumb_uid"), "photo")["image_hash"]
+            return out
+        return self._asset(client, account_id, media["file_id"], media.get("unique_id"), "photo")
+
+    def _asset(self, client, account_id, file_id, unique_id, kind, url=None):
+        # mismo archivo de Telegram ya visto: ni siquiera se descarga
+        sha = unique_id and self._get(f"uid:{unique_id}")
+        if sha:
+            hit = self._get(f"{account_id}:{sha}")
+            if hit:
+                return hit
+        fobj, size, sha = self.fetch_url(url, kind) if url else self.download(file_id)
+        try:
+            hit = self._get(f"{account_id}:{sha}")
+            if hit is None:
+                name = f"{sha[:16]}.{'mp4' if kind == 'video' else 'jpg'}"
+                if kind == "video":
+                    hit = {"video_id": self._upload_video(client, account_id, fobj, size, name)}
+                else:
+                    hit = {"image_hash": self._upload_image(client, account_id, fobj, name)}
+            entries = {f"{account_id}:{sha}": hit}
+            if unique_id:
+                entries[f"uid:{unique_id}"] = sha
+            self._put(**entries)
+            return hit
+        finally:
+            fobj.close()
+
+def _too_big(max_bytes):
+    return f"El archivo pasa el límite de Meta ({max_bytes // 1024**2} MB)"
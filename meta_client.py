@@ -0,0 +1,187 @@
+import re, json, time, random, threading
+from urllib.parse import urlencode, unquote
+import requests
+from requests.adapters import HTTPAdapter
+
+# =====================
+# Cliente Meta (Graph API) compartido
+# =====================
+# Una sola sesión keep-alive por cliente, lectura de los headers de uso de
+# Meta para frenar antes del throttling y reintentos con backoff+jitter para
+# errores transitorios.
+
+# Códigos de error de Graph que vale la pena reintentar
+TRANSIENT_CODES = {1, 2, 4, 17, 32, 341, 613} | set(range(80000, 80015))
+SLOW_PCT  = 75    # desde este % de uso se espacian las llamadas
+PAUSE_PCT = 95    # desde este % se pausa hasta que Meta libere cupo
+
+class MetaError(RuntimeError):
+    def __init__(self, message, code=None, subcode=None, http_status=None, transient=False):
+        super().__init__(message)
+        self.code = code
+        self.subcode = subcode
+        self.http_status = http_status
+        self.transient = transient
+
+    @classmethod
+    def from_response(cls, status, data):
+        err = data.get("error", {}) if isinstance(data, dict) else {}
+        code = err.get("code")
+        transient = bool(err.get("is_transient")) or code in TRANSIENT_CODES or status >= 500
+        msg = err.get("error_user_msg") or err.get("message") or f"HTTP {status}"
+        return cls(msg, code, err.get("error_subcode"), status, transient)
+
+# Las referencias JSONPath ({result=<op>:$.id}) deben viajar sin escapar en el body
+_REF_ENC = re.compile(r"%7Bresult%3D.*?%7D")
+
+def _batch_body(params):
+    enc = urlencode({k: v if isinstance(v, str) else json.dumps(v) for k, v in params.items()})
+    return _REF_ENC.sub(lambda m: unquote(m.group(0)), enc)
+
+def batch_op(name, method, path, params=None):
+    op = {"name": name, "method": method, "relative_url": path, "omit_response_on_success": False}
+    if params:
+        op["body"] = _batch_body(params)
+    return op
+
+def _usage_pct(headers):
+    """Mayor % de uso reportado y segundos hasta recuperar cupo (0 si no aplica)."""
+    pct, wait = 0.0, 0.0
+    raw = headers.get("X-Business-Use-Case-Usage")
+    if raw:
+        try:
+            for entries in json.loads(raw).values():
+                for u in entries:
+                    pct = max(pct, u.get("call_count", 0), u.get("total_cputime", 0), u.get("total_time", 0))
+                    wait = max(wait, 60.0 * u.get("estimated_time_to_regain_access", 0))
+        except (ValueError, AttributeError):
+            pass
+    raw = headers.get("X-Ad-Account-Usage")
+    if raw:
+        try:
+            u = json.loads(raw)
+            pct = max(pct, float(u.get("acc_id_util_pct", 0)))
+            if pct >= PAUSE_PCT:
+                wait = max(wait, float(u.get("reset_time_duration", 0)))
+        except (ValueError, AttributeError):
+            pass
+    return pct, wait
+
+class MetaClient:
+    def __init__(self, token, version="20.0", pool=10, retries=4, timeout=60):
+        self.token = token
+        self.version = version
+        self.base = f"https://graph.facebook.com/v{version}"
+        self.retries = retries
+        self.timeout = timeout
+        self.usage = 0.0               # último % de uso visto
+        self._pause_until = 0.0
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=pool, pool_maxsize=pool))
+
+    # ---------- throttling ----------
+    def _throttle(self):
+        with self._lock:
+            wait = self._pause_until - time.time()
+            usage = self.usage
+        if wait > 0:
+            time.sleep(wait)
+        elif usage >= SLOW_PCT:
+            # espaciado progresivo: 0s al 75% … ~5s al 100%
+            time.sleep(5.0 * (usage - SLOW_PCT) / (100 - SLOW_PCT))
+
+    def _read_usage(self, headers):
+        pct, wait = _usage_pct(headers)
+        with self._lock:
+            self.usage = pct
+            if wait or pct >= PAUSE_PCT:
+                self._pause_until = max(self._pause_until, time.time() + max(wait, 10.0))
+
+    @staticmethod
+    def _backoff(attempt):
+        return min(30.0, 1.0 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    # ---------- HTTP ----------
+    def request(self, method, path, params=None, data=None, files=None):
+        url = path if path.startswith("https://") else f"{self.base}/{path.lstrip('/')}"
+        params = dict(params or {})
+        # el token va en el header y no en la URL: las excepciones de requests
+        # citan la URL y esos mensajes terminan en el chat y en el estado
+        headers = {"Authorization": f"Bearer {self.token}"}
+        for attempt in range(self.retries + 1):
+            self._throttle()
+            for f in (files or {}).values():
+                # en un reintento el archivo se vuelve a leer desde el inicio
+                if hasattr(f[1], "seek"):
+                    f[1].seek(0)
+            try:
+                r = self.session.request(method, url, params=params if method == "GET" else None,
+                                         data=None if method == "GET" else {**params, **(data or {})},
+                                         files=files, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise MetaError(f"Sin conexión con Meta ({type(e).__name__})", transient=True) from None
+                time.sleep(self._backoff(attempt))
+                continue
+            self._read_usage(r.headers)
+            try:
+                body = r.json()
+            except ValueError:
+                body = None
+            if r.status_code < 400 and not (isinstance(body, dict) and "error" in body):
+                return body
+            err = MetaError.from_response(r.status_code, body)
+            if not err.transient or attempt == self.retries:
+                raise err
+            time.sleep(self._backoff(attempt))
+
+    def get(self, path, **params):
+        return self.request("GET", path, params=params)
+
+    def post(self, path, **params):
+        return self.request("POST", path, data={k: v if isinstance(v, str) else json.dumps(v)
+                                                for k, v in params.items()})
+
+    def get_many(self, ids, chunk=50, **params):
+        """GET multi-id (?ids=a,b,…) en tramos de chunk. Devuelve {id: objeto}.
+        Si un id ya no existe Graph falla el tramo entero: ese tramo se repite
+        como batch de GETs sueltos y se omiten los que fallen."""
+        out = {}
+        ids = [str(i) for i in ids]
+        for i in range(0, len(ids), chunk):
+            part = ids[i:i+chunk]
+            try:
+                out.update(self.get("", ids=",".join(part), **params) or {})
+            except MetaError as e:
+                if e.transient or e.code != 100:
+                    raise
+                qs = urlencode(params)
+                for oid, (code, body) in zip(part, self.batch(
+                        [batch_op(f"o{n}", "GET", f"{oid}?{qs}" if qs else oid) for n, oid in enumerate(part)])):
+                    if code == 200 and isinstance(body, dict):
+                        out[oid] = body
+        return out
+
+    def upload(self, path, files, **params):
+        """POST multipart; files = {campo: (nombre, bytes | archivo)}."""
+        return self.request("POST", path, data={k: v if isinstance(v, str) else json.dumps(v)
+                                                for k, v in params.items()}, files=files)
+
+    def delete(self, path):
+        return self.request("DELETE", path)
+
+    def batch(self, ops):
+        """Ejecuta ops en un solo POST /batch. Devuelve [(code, body)] en el mismo orden."""
+        data = self.request("POST", "", data={"batch": json.dumps(ops)})
+        out = []
+        for res in data:
+            if res is None:  # no se ejecutó (falló una op de la que dependía)
+                out.append((None, None))
+                continue
+            try:
+                body = json.loads(res.get("body") or "null")
+            except ValueError:
+                body = res.get("body")
+            out.append((res.get("code"), body))
+        return out
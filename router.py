@@ -0,0 +1,54 @@
+import time, threading
+
+# =====================
+# Router de callbacks
+# =====================
+# callback_data compacto: "<acción>:<arg>:<arg>…" con acciones de 1-3 letras
+# y argumentos cortos (ids internados, índices), siempre < 64 bytes.
+# El despacho es un lookup en dict y cada ruta acumula su latencia.
+
+SEP = ":"
+MAX_DATA = 64  # límite de Telegram para callback_data
+
+class Router:
+    def __init__(self, answer, observe=None):
+        self._answer = answer      # answer(c, texto | None)
+        self._observe = observe    # observe(segundos, acción), opcional
+        self._routes = {}          # acción -> (handler, texto del answer)
+        self._lock = threading.Lock()
+        self.stats = {}            # acción -> [llamadas, segundos acumulados, máximo]
+
+    def route(self, action, answer=None):
+        """Registra handler(c, state, *args). answer=False si el handler responde por su cuenta."""
+        def deco(fn):
+            self._routes[action] = (fn, answer)
+            return fn
+        return deco
+
+    @staticmethod
+    def cb(action, *args):
+        data = SEP.join([action, *map(str, args)])
+        if len(data.encode("utf-8")) > MAX_DATA:
+            raise ValueError(f"callback_data demasiado largo: {data!r}")
+        return data
+
+    def dispatch(self, c, state):
+        """False si la acción no está registrada."""
+        action, *args = (c.data or "").split(SEP)
+        entry = self._routes.get(action)
+        if entry is None:
+            return False
+        fn, answer = entry
+        if answer is not False:
+            self._answer(c, answer)
+        t0 = time.perf_counter()
+        try:
+            fn(c, state, *args)
+        finally:
+            dt = time.perf_counter() - t0
+            with self._lock:
+                s = self.stats.setdefault(action, [0, 0.0, 0.0])
+                s[0] += 1; s[1] += dt; s[2] = max(s[2], dt)
+            if self._observe:
+                self._observe(dt, action)
+        return True
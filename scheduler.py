@@ -0,0 +1,188 @@
+import re, time, heapq, itertools, threading, traceback
+from datetime import datetime, timedelta, timezone
+
+# =====================
+# Horarios semanales (dayparting)
+# =====================
+# Un horario es una lista de franjas [inicio, fin) en minutos desde el lunes
+# 00:00 hora de Bogotá; fuera de las franjas el anuncio va en pausa. El
+# Scheduler guarda en un min-heap solo el próximo cambio de cada horario, así
+# que el hilo duerme hasta el siguiente vencimiento sin recorrer nada; lo que
+# vence en el mismo instante se entrega junto.
+
+try:
+    from zoneinfo import ZoneInfo
+    TZ = ZoneInfo("America/Bogota")
+except Exception:
+    # sin base de zonas del sistema: Bogotá es UTC-5 todo el año
+    TZ = timezone(timedelta(hours=-5), "America/Bogota")
+
+DAYS = "LMXJVSD"
+DAY = 24 * 60
+WEEK = 7 * DAY
+
+_SEGMENT = re.compile(r"^(\*|TODOS|[LMXJVSD](?:-[LMXJVSD])?)\s+(\d{1,2})(?::(\d\d))?\s*-\s*(\d{1,2})(?::(\d\d))?$")
+
+def _minute(h, m):
+    v = int(h) * 60 + int(m or 0)
+    if v > DAY or int(m or 0) >= 60:
+        raise ValueError(f"Hora inválida: {h}:{m or '00'}")
+    return v
+
+def _days(spec):
+    if spec in ("*", "TODOS"):
+        return range(7)
+    a, _, b = spec.partition("-")
+    a = DAYS.index(a)
+    b = DAYS.index(b) if b else a
+    return [(a + i) % 7 for i in range((b - a) % 7 + 1)]
+
+def parse_windows(text):
+    """'L-V 8-18, S 9:30-13' -> [[inicio, fin], …] ordenadas y sin solapes.
+    Una franja con fin <= inicio cruza la medianoche (ej: 'V 22-2')."""
+    spans = []
+    for seg in re.split(r"[,;\n]", text.upper()):
+        seg = seg.strip()
+        if not seg:
+            continue
+        m = _SEGMENT.match(seg)
+        if not m:
+            raise ValueError(f"No entiendo «{seg}». Usa por ejemplo: L-V 8-18")
+        start, end = _minute(m[2], m[3]), _minute(m[4], m[5])
+        if end <= start:
+            end += DAY
+        for d in _days(m[1]):
+            s, e = d * DAY + start, d * DAY + end
+            if e > WEEK:
+                # el domingo en la noche sigue el lunes temprano
+                spans += [[s, WEEK], [0, e - WEEK]]
+            else:
+                spans.append([s, e])
+    if not spans:
+        raise ValueError("No hay franjas")
+    spans.sort()
+    out = [spans[0]]
+    for s, e in spans[1:]:
+        if s <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], e)
+        else:
+            out.append([s, e])
+    return out
+
+def format_windows(windows):
+    """Texto legible: franjas por día (las nocturnas como 22:00-02:00) y días
+    seguidos con el mismo horario agrupados (L-V 08:00-18:00)."""
+    chunks = {}
+    for s, e in windows:
+        while s < e:
+            cut = min(e, (s // DAY + 1) * DAY)
+            chunks[s] = (s // DAY, s % DAY, cut - s // DAY * DAY)
+            s = cut
+    for s in sorted(chunks):
+        if s not in chunks:
+            continue
+        d, a, b = chunks[s]
+        nxt_start = (d + 1) % 7 * DAY
+        nxt = chunks.get(nxt_start)
+        if b == DAY and nxt and nxt[1] == 0 and nxt[2] < a:
+            # franja que cruza la medianoche: se muestra junta
+            chunks[s] = (d, a, nxt[2])
+            del chunks[nxt_start]
+    by_hours = {}
+    for d, a, b in chunks.values():
+        by_hours.setdefault((a, b), []).append(d)
+    hhmm = lambda v: f"{v // 60:02d}:{v % 60:02d}"
+    out = []
+    for (a, b), days in by_hours.items():
+        days.sort()
+        runs = [[days[0], days[0]]]
+        for d in days[1:]:
+            if d == runs[-1][1] + 1:
+                runs[-1][1] = d
+            else:
+                runs.append([d, d])
+        out += [(d0, a, f"{DAYS[d0]}{'-' + DAYS[d1] if d1 != d0 else ''} {hhmm(a)}-{hhmm(b)}")
+                for d0, d1 in runs]
+    return ", ".join(text for _, _, text in sorted(out))
+
+def week_minute(ts):
+    t = datetime.fromtimestamp(ts, TZ)
+    return t.weekday() * DAY + t.hour * 60 + t.minute + t.second / 60
+
+def is_open(windows, ts):
+    m = week_minute(ts)
+    return any(s <= m < e for s, e in windows)
+
+def next_change(windows, ts):
+    """(ts del próximo cambio, abierto después) o None si el horario nunca cambia."""
+    m = week_minute(ts)
+    now_open = any(s <= m < e for s, e in windows)
+    bounds = sorted({((b - m) % WEEK) or WEEK for w in windows for b in w})
+    for delta in bounds:
+        b = (m + delta) % WEEK
+        if any(s <= b < e for s, e in windows) != now_open:
+            # se redondea al minuto exacto de la frontera
+            return round(ts + delta * 60), not now_open
+    return None
+
+def describe_next(windows, ts):
+    nxt = next_change(windows, ts)
+    if nxt is None:
+        return "sin cambios"
+    at, opens = nxt
+    t = datetime.fromtimestamp(at, TZ)
+    return f"{'se activa' if opens else 'se pausa'} {DAYS[t.weekday()]} {t:%H:%M}"
+
+class Scheduler:
+    """Temporizadores por clave sobre un min-heap. set() reprograma (la entrada
+    vieja queda en el heap y se descarta al salir). on_due([(clave, ts)]) recibe
+    juntas las claves que vencen dentro de slack segundos."""
+    def __init__(self, on_due, slack=1.0, name="scheduler"):
+        self._on_due = on_due
+        self._slack = slack
+        self._heap = []                  # (ts, seq, clave)
+        self._when = {}                  # clave -> ts vigente
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def set(self, key, ts):
+        with self._cv:
+            self._when[key] = ts
+            heapq.heappush(self._heap, (ts, next(self._seq), key))
+            if self._heap[0][2] == key:
+                self._cv.notify()
+
+    def remove(self, key):
+        with self._cv:
+            self._when.pop(key, None)
+
+    def __len__(self):
+        return len(self._when)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                heap = self._heap
+                while heap and self._when.get(heap[0][2]) != heap[0][0]:
+                    heapq.heappop(heap)      # reprogramada o quitada
+                if not heap:
+                    self._cv.wait()
+                    continue
+                delay = heap[0][0] - time.time()
+                if delay > 0:
+                    # tope de 5 min por si el reloj del sistema salta
+                    self._cv.wait(timeout=min(delay, 300))
+                    continue
+                limit, due = time.time() + self._slack, []
+                while heap and heap[0][0] <= limit:
+                    ts, _, key = heapq.heappop(heap)
+                    if self._when.get(key) == ts:
+                        del self._when[key]
+                        due.append((key, ts))
+            if due:
+                try:
+                    self._on_due(due)
+                except Exception as e:
+                    print("Scheduler on_due error:", repr(e))
+                    print(traceback.format_exc())
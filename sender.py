@@ -0,0 +1,218 @@
+import time, threading, traceback
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from telebot.apihelper import ApiTelegramException
+
+# =====================
+# Cola de salida hacia Telegram
+# =====================
+# Todo envío/edición pasa por aquí. Un hilo despachador reparte turnos entre
+# chats respetando dos token buckets (global ~30/s y por chat ~1/s con algo de
+# ráfaga). Cada chat tiene a lo sumo una llamada en vuelo, así que el orden
+# dentro del chat se mantiene. Un 429 pausa el chat lo que diga retry_after y
+# el mensaje vuelve a la cabeza de su cola.
+#
+# Coalescencia: mensajes de texto seguidos al mismo chat (mismas opciones,
+# sin teclado salvo el último) salen en uno solo si caben en 4096 caracteres;
+# y una edición pendiente del mismo mensaje se reemplaza por la más nueva.
+
+MAX_TEXT = 4096
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = float(rate), float(burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, now):
+        """Segundos hasta que haya un token (0 si ya hay)."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+def _opts(item):
+    return {k: v for k, v in item.kw.items() if k != "reply_markup"}
+
+class _Item:
+    __slots__ = ("kind", "mid", "text", "kw", "future", "attempts")
+
+    def __init__(self, kind, mid, text, kw):
+        self.kind, self.mid, self.text, self.kw = kind, mid, text, kw
+        self.future = Future()
+        self.attempts = 0
+
+    def mergeable(self):
+        return self.kind == "send" and "reply_markup" not in self.kw
+
+class SendQueue:
+    def __init__(self, bot, on_sent=None, timer=None, on_throttle=None,
+                 global_rate=30, chat_rate=1.0, chat_burst=3, workers=8, retries=5):
+        self.bot = bot
+        self._on_sent = on_sent          # on_sent(cid, message) tras cada envío
+        self._timer = timer              # timer(método) -> context manager, opcional
+        self._on_throttle = on_throttle  # on_throttle(método) en cada 429
+        self._chat_rate, self._chat_burst = chat_rate, chat_burst
+        self._retries = retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}               # cid -> TokenBucket
+        self._pending = {}               # cid -> deque de _Item
+        self._ready = OrderedDict()      # cids con pendientes y sin llamada en vuelo
+        self._count = 0
+        self._cv = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tg-send")
+        threading.Thread(target=self._dispatch, name="tg-dispatch", daemon=True).start()
+
+    # ---------- API ----------
+    def send(self, cid, text, **kw):
+        return self._submit(cid, _Item("send", None, text, kw))
+
+    def edit(self, cid, mid, text, **kw):
+        with self._cv:
+            for item in self._pending.get(cid, ()):
+                if item.kind == "edit" and item.mid == mid:
+                    # la edición vieja aún no salió: solo importa la última
+                    item.text, item.kw = text, kw
+                    return item.future
+        return self._submit(cid, _Item("edit", mid, text, kw))
+
+    def pending(self):
+        return self._count
+
+    # ---------- despacho ----------
+    def _submit(self, cid, item):
+        with self._cv:
+            dq = self._pending.get(cid)
+            if dq is None:
+                dq = self._pending[cid] = deque()
+                self._ready[cid] = None
+            dq.append(item)
+            self._count += 1
+            self._cv.notify()
+        return item.future
+
+    def _bucket(self, cid):
+        b = self._buckets.get(cid)
+        if b is None:
+            b = self._buckets[cid] = TokenBucket(self._chat_rate, self._chat_burst)
+        return b
+
+    def _dispatch(self):
+        swept = time.monotonic()
+        while True:
+            with self._cv:
+                pick, sleep = None, None
+                now = time.monotonic()
+                if now - swept > 60:
+                    # buckets de chats sin actividad: vuelven a crearse llenos
+                    for cid in [c for c, b in self._buckets.items()
+                                if c not in self._pending and b.idle(now)]:
+                        del self._buckets[cid]
+                    swept = now
+                gwait = self._global.wait(now)
+                if gwait == 0:
+                    for cid in self._ready:
+                        w = self._bucket(cid).wait(now)
+                        if w == 0:
+                            pick = cid
+                            break
+                        sleep = w if sleep is None else min(sleep, w)
+                else:
+                    sleep = gwait
+                if pick is None:
+                    self._cv.wait(timeout=sleep)
+                    continue
+                del self._ready[pick]
+                self._global.take(now)
+                self._bucket(pick).take(now)
+                items = self._take(self._pending[pick])
+            self._pool.submit(self._run, pick, items)
+
+    def _take(self, dq):
+        """Saca el siguiente item y, si es texto, los que se le puedan pegar."""
+        first = dq.popleft()
+        items = [first]
+        if first.mergeable():
+            size = len(first.text)
+            while dq and dq[0].kind == "send" and _opts(dq[0]) == _opts(first):
+                nxt = dq[0]
+                if size + 2 + len(nxt.text) > MAX_TEXT:
+                    break
+                items.append(dq.popleft())
+                size += 2 + len(nxt.text)
+                if not nxt.mergeable():
+                    break  # el teclado va en el último mensaje
+        self._count -= len(items)
+        return items
+
+    def _call(self, cid, items):
+        head, last = items[0], items[-1]
+        method = "sendMessage" if head.kind == "send" else "editMessageText"
+        if head.kind == "send":
+            text = "\n\n".join(i.text for i in items)
+            fn = lambda: self.bot.send_message(cid, text, **last.kw)
+        else:
+            fn = lambda: self.bot.edit_message_text(head.text, cid, head.mid, **head.kw)
+        if self._timer:
+            with self._timer(method):
+                return method, fn()
+        return method, fn()
+
+    def _run(self, cid, items):
+        head = items[0]
+        try:
+            method, res = self._call(cid, items)
+        except ApiTelegramException as e:
+            retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after")
+            if e.error_code == 429 and head.attempts < self._retries:
+                head.attempts += 1
+                if self._on_throttle:
+                    self._on_throttle("sendMessage" if head.kind == "send" else "editMessageText")
+                with self._cv:
+                    self._bucket(cid).block(time.monotonic() + float(retry_after or 1))
+                    # vuelven en el mismo orden a la cabeza de la cola del chat
+                    self._pending[cid].extendleft(reversed(items))
+                    self._count += len(items)
+            else:
+                self._fail(items, e)
+        except Exception as e:
+            self._fail(items, e)
+        else:
+            if method == "sendMessage" and self._on_sent:
+                try:
+                    self._on_sent(cid, res)
+                except Exception as e:
+                    print("SendQueue on_sent error:", repr(e))
+            for i in items:
+                i.future.set_result(res)
+        finally:
+            with self._cv:
+                if self._pending[cid]:
+                    self._ready[cid] = None
+                else:
+                    del self._pending[cid]
+                self._cv.notify()
+
+    @staticmethod
+    def _fail(items, e):
+        if not (items[0].kind == "edit" and "message is not modified" in str(e)):
+            print(f"SendQueue {items[0].kind} error:", repr(e))
+            print(traceback.format_exc())
+        for i in items:
+            i.future.set_exception(e)
@@ -0,0 +1,475 @@
+import os, json, sqlite3, threading, atexit, time
+
+# =====================
+# Persistencia del estado por chat
+# =====================
+# Dos backends con la misma interfaz:
+#   load()                 prepara el backend (lee/migra lo que haga falta)
+#   get(cid)               registro del chat {budget, store, ...} o None
+#   cids(contains)         chats persistidos (opcionalmente filtrados por texto)
+#   mark(cid) / flush()    marca sucio y escribe en diferido, coalesciendo
+#   find_ad(ad_id)         (cid, línea, clave) del anuncio, vía índice
+#                          (clave: id local estable del anuncio en su línea)
+#   patch_ads({ad_id: meta}) actualiza el meta de anuncios sin cargar sus chats,
+#                          en una sola escritura
+#   ad_metas()             (cid, ad_id, meta) de todos los anuncios persistidos
+#   sizes()                bytes serializados por chat (para /metrics)
+#
+# dump(cid) devuelve el registro vivo del chat, o None si el chat no está en
+# memoria (desalojado): en ese caso no hay nada que escribir.
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _iter_ads(rec):
+    for line, entry in rec.get("store", {}).items():
+        for key, ad in entry.get("ads", {}).items():
+            yield line, key, ad
+
+def migrate_ads(rec):
+    """Formato viejo (ads como lista, direccionados por posición) -> dict
+    {id local: anuncio} en orden de alta, con ids únicos en el chat y el
+    contador next_aid en el registro. True si hubo que migrar."""
+    if "next_aid" in rec:
+        return False
+    n = 1
+    for entry in rec.get("store", {}).values():
+        ads = entry.get("ads") or []
+        new = {}
+        for ad in (ads.values() if isinstance(ads, dict) else ads):
+            new[format(n, "x")] = ad
+            n += 1
+        entry["ads"] = new
+    rec["next_aid"] = n
+    return True
+
+class _Store:
+    def __init__(self, dump, delay=0.5, on_flush=None):
+        self._dump = dump
+        self._delay = delay            # ventana de coalescencia de flushes (s)
+        self._on_flush = on_flush      # on_flush(segundos, bytes), opcional
+        self._dirty = set()
+        self._timer = None
+        self._lock = threading.Lock()  # protege _dirty/_timer
+        self._io = threading.Lock()    # un solo flush a la vez
+        atexit.register(self.flush)
+
+    def mark(self, cid):
+        """Marca un chat como sucio y programa un flush diferido."""
+        with self._lock:
+            self._dirty.add(int(cid))
+            if self._timer is None:
+                self._timer = threading.Timer(self._delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not dirty:
+            return 0
+        t0 = time.perf_counter()
+        items, retry = [], []
+        for cid in dirty:
+            try:
+                rec = self._dump(cid)
+                if rec is not None:
+                    items.append((cid, _dumps(rec)))
+            except RuntimeError:
+                # el chat se está mutando en otro hilo; se reintenta luego
+                retry.append(cid)
+        try:
+            with self._io:
+                written = self._write(items) if items else 0
+        except Exception:
+            # no se escribió: quedan sucios para el próximo flush
+            for cid, _ in items:
+                self.mark(cid)
+            raise
+        finally:
+            for cid in retry:
+                self.mark(cid)
+        if self._on_flush:
+            self._on_flush(time.perf_counter() - t0, written)
+        return written
+
+    def _write(self, items):
+        """items: [(cid, registro serializado)]. Devuelve bytes escritos."""
+        raise NotImplementedError
+
+    def forget(self, cid):
+        """El chat salió de memoria; hook para soltar cachés del backend."""
+
+# =====================
+# JSON: snapshot + journal append-only
+# =====================
+# DATA_FILE conserva el formato de siempre ({cid: {budget, store}}) y es el
+# snapshot compactado. Cada flush solo agrega al journal (DATA_FILE.journal)
+# los chats que cambiaron, una línea por chat:
+#   {"cid": "123", "rec": {...}}   -> upsert del registro completo del chat
+#   {"cid": "123", "rec": null}    -> chat eliminado
+# Al cargar se lee el snapshot y se re-aplica el journal en orden; como cada
+# línea es el registro completo, re-aplicarla es idempotente.
+
+class JsonStore(_Store):
+    def __init__(self, path, dump, delay=0.5, compact_every=1000, on_flush=None):
+        super().__init__(dump, delay, on_flush)
+        self.path = path
+        self.journal_path = path + ".journal"
+        self._compact_every = compact_every
+        self._recs = {}                # cid(str) -> registro serializado ya persistido
+        self._index = {}               # ad_id -> (cid, línea, clave)
+        self._by_chat = {}             # cid(str) -> ad_ids indexados de ese chat
+        self._entries = 0              # líneas en el journal desde el último snapshot
+
+    # ---------- carga ----------
+    def read(self):
+        """Snapshot + journal como {cid(str): registro}."""
+        data = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            bad = f"{self.path}.corrupt-{int(time.time())}"
+            print(f"⚠️ Snapshot {self.path} ilegible ({e}); movido a {bad}")
+            os.replace(self.path, bad)
+
+        entries = 0
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for n, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        # escritura interrumpida: solo puede ser la cola del journal
+                        print(f"⚠️ Journal truncado en línea {n}; se ignora el resto")
+                        break
+                    if op.get("rec") is None:
+                        data.pop(op["cid"], None)
+                    else:
+                        data[op["cid"]] = op["rec"]
+                    entries += 1
+        except FileNotFoundError:
+            pass
+        self._entries = entries
+        return data
+
+    def load(self):
+        data = self.read()
+        migrated = sum(migrate_ads(v) for v in data.values())
+        self._recs = {k: _dumps(v) for k, v in data.items()}
+        for k, v in data.items():
+            self._reindex(k, v)
+        if self._entries or migrated:
+            self.compact()
+        if migrated:
+            print(f"📦 {migrated} chats migrados a ids de anuncio estables")
+
+    def get(self, cid):
+        raw = self._recs.get(str(cid))
+        return None if raw is None else json.loads(raw)
+
+    def cids(self, contains=None):
+        return [int(k) for k, raw in list(self._recs.items()) if contains is None or contains in raw]
+
+    def find_ad(self, ad_id):
+        return self._index.get(str(ad_id))
+
+    def patch_ads(self, changes):
+        """Un solo append al journal con todos los chats tocados. Devuelve cuántos aplicó."""
+        by_chat = {}
+        for ad_id, meta in changes.items():
+            hit = self.find_ad(ad_id)
+            if hit is not None:
+                by_chat.setdefault(str(hit[0]), []).append((hit[1], hit[2], meta))
+        if not by_chat:
+            return 0
+        with self._io:
+            items = []
+            for key, hits in by_chat.items():
+                rec = json.loads(self._recs[key])
+                for line, akey, meta in hits:
+                    rec["store"][line]["ads"][akey].setdefault("meta", {}).update(meta)
+                items.append((key, _dumps(rec)))
+            self._append(items)
+        return sum(map(len, by_chat.values()))
+
+    def ad_metas(self):
+        for key, raw in list(self._recs.items()):
+            if not self._by_chat.get(key):
+                continue  # chat sin anuncios con ad_id
+            for line, akey, ad in _iter_ads(json.loads(raw)):
+                meta = ad.get("meta", {})
+                if meta.get("ad_id"):
+                    yield int(key), str(meta["ad_id"]), meta
+
+    def sizes(self):
+        return {k: len(v) for k, v in list(self._recs.items())}
+
+    def _reindex(self, key, rec):
+        for ad_id in self._by_chat.pop(key, ()):
+            self._index.pop(ad_id, None)
+        ids = self._by_chat[key] = set()
+        for line, akey, ad in _iter_ads(rec):
+            ad_id = ad.get("meta", {}).get("ad_id")
+            if ad_id:
+                self._index[str(ad_id)] = (int(key), line, akey)
+                ids.add(str(ad_id))
+
+    # ---------- escritura ----------
+    def _write(self, items):
+        return self._append([(str(cid), raw) for cid, raw in items])
+
+    def _append(self, items):
+        lines, changed = [], []
+        for key, raw in items:
+            if raw == self._recs.get(key):
+                continue
+            lines.append(f'{{"cid":{_dumps(key)},"rec":{raw}}}\n')
+            changed.append((key, raw))
+        if not lines:
+            return 0
+        payload = "".join(lines).encode("utf-8")
+        with open(self.journal_path, "ab") as f:
+            end = f.tell()
+            try:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError:
+                # sin una cola a medias: al leer, todo lo que siga se ignoraría
+                try:
+                    f.truncate(end)
+                except OSError:
+                    pass
+                raise
+        # _recs es "lo ya persistido": solo se actualiza tras el fsync
+        for key, raw in changed:
+            self._recs[key] = raw
+            self._reindex(key, json.loads(raw))
+        self._entries += len(lines)
+        if self._entries >= self._compact_every:
+            self.compact()
+        return len(payload)
+
+    def compact(self):
+        """Vuelca el estado completo a un snapshot nuevo y vacía el journal."""
+        tmp = self.path + ".tmp"
+        body = ",\n".join(f"{_dumps(k)}:{v}" for k, v in self._recs.items())
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("{\n" + body + "\n}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        _fsync_dir(self.path)
+        # si caemos antes de truncar, re-aplicar el journal sobre el snapshot nuevo es inocuo
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        self._entries = 0
+
+# =====================
+# SQLite: una fila por chat, por línea y por anuncio
+# =====================
+# Cada flush compara fila a fila con lo último persistido y solo escribe lo
+# que cambió, en una transacción. ads tiene índices por ad_id y por línea
+# para ubicar y actualizar un anuncio sin tocar el resto del chat.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (cid INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS lines (cid INTEGER, line TEXT, data TEXT NOT NULL,
+                                  PRIMARY KEY (cid, line));
+CREATE TABLE IF NOT EXISTS ads (cid INTEGER, line TEXT, akey TEXT, ad_id TEXT,
+                                data TEXT NOT NULL, PRIMARY KEY (cid, line, akey));
+CREATE INDEX IF NOT EXISTS ads_ad_id ON ads(ad_id);
+CREATE INDEX IF NOT EXISTS ads_line ON ads(cid, line);
+"""
+
+def _rows(rec):
+    """Separa el registro de un chat en filas serializadas (chat, líneas, anuncios)."""
+    chat = {k: v for k, v in rec.items() if k != "store"}
+    lines, ads = {}, {}
+    for line, entry in rec.get("store", {}).items():
+        lines[line] = _dumps({k: v for k, v in entry.items() if k != "ads"})
+        for akey, ad in entry.get("ads", {}).items():
+            ads[(line, akey)] = (ad.get("meta", {}).get("ad_id"), _dumps(ad))
+    return _dumps(chat), lines, ads
+
+class SqliteStore(_Store):
+    def __init__(self, path, dump, delay=0.5, legacy_json=None, on_flush=None):
+        super().__init__(dump, delay, on_flush)
+        self.path = path
+        self._legacy = legacy_json     # data.json a migrar si la base está vacía
+        self._db = None
+        self._seen = {}                # cid -> filas tal como están en la base
+
+    def load(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # con varios procesos (PROCS>1) otro puede tener el lock de escritura un momento
+        self._db.execute("PRAGMA busy_timeout=10000")
+        self._db.executescript(SCHEMA)
+        empty = self._db.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is None
+        if empty and self._legacy and os.path.exists(self._legacy):
+            self.migrate(self._legacy)
+        self._migrate_ads()
+
+    def _migrate_ads(self):
+        """Chats guardados con anuncios por posición: se renumeran una sola vez."""
+        with self._io:
+            old = [r[0] for r in self._db.execute(
+                "SELECT cid FROM chats WHERE instr(data, '\"next_aid\":') = 0")]
+        if not old:
+            return
+        items = []
+        for cid in old:
+            rec = self.get(cid)        # deja en _seen las filas viejas para el diff
+            migrate_ads(rec)
+            items.append((cid, _dumps(rec)))
+        with self._io:
+            self._write(items)
+        for cid in old:
+            self.forget(cid)
+        print(f"📦 {len(old)} chats migrados a ids de anuncio estables")
+
+    def migrate(self, json_path):
+        """Migración única desde data.json (+ journal); el archivo queda como .migrated."""
+        data = JsonStore(json_path, dump=lambda cid: None).read()
+        for rec in data.values():
+            migrate_ads(rec)
+        with self._io:
+            self._write([(int(k), _dumps(v)) for k, v in data.items()])
+        os.replace(json_path, json_path + ".migrated")
+        if os.path.exists(json_path + ".journal"):
+            os.replace(json_path + ".journal", json_path + ".journal.migrated")
+        print(f"📦 Migrados {len(data)} chats de {json_path} a {self.path}")
+
+    def get(self, cid):
+        with self._io:
+            row = self._db.execute("SELECT data FROM chats WHERE cid=?", (cid,)).fetchone()
+            if row is None:
+                return None
+            rec = json.loads(row[0])
+            store = {}
+            for line, data in self._db.execute("SELECT line, data FROM lines WHERE cid=?", (cid,)):
+                store[line] = {**json.loads(data), "ads": {}}
+            # ids hex crecientes (o posiciones en bases viejas): largo y luego texto = orden de alta
+            for line, akey, data in self._db.execute(
+                    "SELECT line, akey, data FROM ads WHERE cid=? ORDER BY line, length(akey), akey", (cid,)):
+                store.setdefault(line, {"ads": {}})["ads"][akey] = json.loads(data)
+        rec["store"] = store
+        self._seen[cid] = _rows(rec)
+        return rec
+
+    def cids(self, contains=None):
+        """contains filtra por texto en la fila del chat (no en líneas/anuncios)."""
+        with self._io:
+            if contains is None:
+                return [r[0] for r in self._db.execute("SELECT cid FROM chats")]
+            return [r[0] for r in self._db.execute("SELECT cid FROM chats WHERE instr(data, ?) > 0",
+                                                   (contains,))]
+
+    def find_ad(self, ad_id):
+        with self._io:
+            row = self._db.execute("SELECT cid, line, akey FROM ads WHERE ad_id=? LIMIT 1",
+                                   (str(ad_id),)).fetchone()
+        return tuple(row) if row else None
+
+    def patch_ads(self, changes):
+        """Todos los cambios en una transacción. Devuelve cuántos aplicó."""
+        applied, seen_rows = 0, []
+        with self._io:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for ad_id, meta in changes.items():
+                    row = db.execute("SELECT cid, line, akey, data FROM ads WHERE ad_id=? LIMIT 1",
+                                     (str(ad_id),)).fetchone()
+                    if row is None:
+                        continue
+                    cid, line, akey, data = row
+                    ad = json.loads(data)
+                    ad.setdefault("meta", {}).update(meta)
+                    raw = _dumps(ad)
+                    db.execute("UPDATE ads SET data=? WHERE cid=? AND line=? AND akey=?",
+                               (raw, cid, line, akey))
+                    seen_rows.append((cid, line, akey, str(ad_id), raw))
+                    applied += 1
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            for cid, line, akey, ad_id, raw in seen_rows:
+                seen = self._seen.get(cid)
+                if seen and (line, akey) in seen[2]:
+                    seen[2][(line, akey)] = (ad_id, raw)
+        return applied
+
+    def ad_metas(self):
+        with self._io:
+            rows = self._db.execute("SELECT cid, ad_id, data FROM ads WHERE ad_id IS NOT NULL").fetchall()
+        for cid, ad_id, data in rows:
+            yield cid, ad_id, json.loads(data).get("meta", {})
+
+    def sizes(self):
+        return {cid: len(c) + sum(map(len, l.values())) + sum(len(a[1]) for a in ads.values())
+                for cid, (c, l, ads) in list(self._seen.items())}
+
+    def _write(self, items):
+        written, seen = 0, {}
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for cid, raw in items:
+                chat, lines, ads = _rows(json.loads(raw))
+                old_chat, old_lines, old_ads = self._seen.get(cid, (None, {}, {}))
+                if chat != old_chat:
+                    db.execute("INSERT OR REPLACE INTO chats (cid, data) VALUES (?, ?)", (cid, chat))
+                    written += len(chat)
+                for line in old_lines.keys() - lines.keys():
+                    db.execute("DELETE FROM lines WHERE cid=? AND line=?", (cid, line))
+                for line, data in lines.items():
+                    if old_lines.get(line) != data:
+                        db.execute("INSERT OR REPLACE INTO lines (cid, line, data) VALUES (?, ?, ?)",
+                                   (cid, line, data))
+                        written += len(data)
+                for line, akey in old_ads.keys() - ads.keys():
+                    db.execute("DELETE FROM ads WHERE cid=? AND line=? AND akey=?", (cid, line, akey))
+                for (line, akey), (ad_id, data) in ads.items():
+                    old = old_ads.get((line, akey))
+                    if old is None or old[1] != data:
+                        db.execute("INSERT OR REPLACE INTO ads (cid, line, akey, ad_id, data) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   (cid, line, akey, None if ad_id is None else str(ad_id), data))
+                        written += len(data)
+                seen[cid] = (chat, lines, ads)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        # _seen es "lo que hay en la base": tras un ROLLBACK no puede adelantarse
+        self._seen.update(seen)
+        return written
+
+    def forget(self, cid):
+        """El chat salió de memoria: ya no hace falta su copia de filas."""
+        self._seen.pop(cid, None)
@@ -0,0 +1,104 @@
+import time, threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# =====================
+# Métricas estilo Prometheus
+# =====================
+# Contadores e histogramas en memoria: registrar cuesta un lock y una suma;
+# el formateo de texto y los gauges calculados solo corren al hacer scrape.
+
+REGISTRY = []
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labelvalues, n=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + n
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        out += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in items]
+        return out
+
+class Histogram:
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values = {}   # labels -> [conteos por bucket (+Inf al final), suma]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, v, *labelvalues):
+        i = bisect_left(self.buckets, v)
+        with self._lock:
+            h = self._values.get(labelvalues)
+            if h is None:
+                h = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += v
+
+    @contextmanager
+    def time(self, *labelvalues):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labelvalues)
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(h[0]), h[1]) for k, h in self._values.items()]
+        for k, counts, total in items:
+            acc = 0
+            for le, n in zip([*map(str, self.buckets), "+Inf"], counts):
+                acc += n
+                out.append(f"{self.name}_bucket{_labels((*self.labels, 'le'), (*k, le))} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labels, k)} {total}")
+            out.append(f"{self.name}_count{_labels(self.labels, k)} {acc}")
+        return out
+
+class Gauge:
+    """Valor calculado en el scrape: fn() -> número o {labels: número}."""
+    def __init__(self, name, help, fn, labels=()):
+        self.name, self.help, self.fn, self.labels = name, help, fn, labels
+        REGISTRY.append(self)
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        val = self.fn()
+        items = val.items() if isinstance(val, dict) else [((), val)]
+        out += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in items]
+        return out
+
+@contextmanager
+def track(hist, errors, *labelvalues):
+    """Mide la duración en hist y cuenta en errors si el bloque lanza."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.inc(*labelvalues)
+        raise
+    finally:
+        hist.observe(time.perf_counter() - t0, *labelvalues)
+
+def render():
+    lines = []
+    for m in REGISTRY:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
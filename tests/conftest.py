@@ -0,0 +1,4 @@
+import os, sys
+
+# los módulos del bot viven en la raíz del repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
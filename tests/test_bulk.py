@@ -0,0 +1,41 @@
+import io
+import pytest
+import bulk
+
+HEADER = "Línea,Título,Descripción\n"
+
+def rows(data, name="ads.csv"):
+    return list(bulk.read_rows(io.BytesIO(data), name))
+
+def test_utf8_character_across_sniff_boundary():
+    # la "í" de "Línea" (2 bytes en UTF-8) queda partida en el borde de la muestra
+    head = "Camisetas,Algodón,L"
+    fixed = len((HEADER + "Zapatos,," + "\n" + head).encode())
+    pad = "x" * (bulk.SNIFF_BYTES - 1 - fixed)
+    data = (HEADER + f"Zapatos,{pad},\n" + head + "ínea nueva\n").encode()
+    assert data[bulk.SNIFF_BYTES - 1:bulk.SNIFF_BYTES + 1] == "í".encode()
+    out = rows(data)
+    assert out[0][1]["line"] == "Zapatos"
+    assert out[-1] == (3, {"line": "Camisetas", "title": "Algodón", "desc": "Línea nueva"})
+
+def test_utf8_bom_and_semicolons():
+    out = rows(("﻿" + HEADER.replace(",", ";") + "Zapatos;Tenis;Cómodos\n").encode())
+    assert out == [(2, {"line": "Zapatos", "title": "Tenis", "desc": "Cómodos"})]
+
+def test_cp1252_export_from_excel():
+    out = rows((HEADER + "Zapatos,Tenis,Cómodos\n").encode("cp1252"))
+    assert out == [(2, {"line": "Zapatos", "title": "Tenis", "desc": "Cómodos"})]
+
+def test_cp1252_after_utf8_looking_start():
+    # los 4 KB del comienzo no dicen nada: el resto del archivo decide
+    data = (HEADER + "Zapatos,Tenis,ok\n" * 400 + "Ropa,Niño,Pequeño\n").encode("cp1252")
+    assert rows(data)[-1][1] == {"line": "Ropa", "title": "Niño", "desc": "Pequeño"}
+
+def test_undecodable_bytes_do_not_crash():
+    # 0x81 no existe en cp1252 ni es UTF-8 válido
+    out = rows(HEADER.encode("cp1252") + b"Zapatos,Tenis\x81,ok\n")
+    assert out[0][1]["line"] == "Zapatos"
+
+def test_missing_required_column():
+    with pytest.raises(ValueError, match="descripcion"):
+        rows(b"linea,titulo\nZapatos,Tenis\n")
@@ -0,0 +1,68 @@
+import socket, threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+import media
+from media import MediaPipeline, check_public
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/big")
+            self.end_headers()
+            return
+        body = b"x" * 5000
+        self.send_response(200)
+        if self.path != "/chunked":
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def server():
+    srv = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_port}"
+    srv.shutdown()
+
+@pytest.fixture
+def pipeline(tmp_path):
+    return MediaPipeline(None, "123:TOKEN", str(tmp_path / "cache.json"))
+
+@pytest.mark.parametrize("url", ["http://127.0.0.1/a.jpg", "http://10.0.0.5/a.jpg",
+                                 "http://169.254.169.254/latest/meta-data", "http://[::1]/a.jpg",
+                                 "ftp://example.com/a.jpg", "file:///etc/passwd"])
+def test_rejects_non_public_urls(url):
+    with pytest.raises(RuntimeError):
+        check_public(url)
+
+def test_accepts_public_host(monkeypatch):
+    monkeypatch.setattr(media.socket, "getaddrinfo",
+                        lambda *a, **kw: [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("93.184.216.34", 80))])
+    check_public("https://example.com/a.jpg")
+
+def test_import_url_to_loopback_is_refused(pipeline, server):
+    with pytest.raises(RuntimeError, match="no es público"):
+        pipeline.fetch_url(server + "/big", "photo")
+
+def test_redirects_are_checked_on_every_hop(pipeline, server, monkeypatch):
+    seen = []
+    def check(url):
+        seen.append(url)
+        if url.endswith("/big"):
+            raise RuntimeError("El host no es público")
+    monkeypatch.setattr(media, "check_public", check)
+    with pytest.raises(RuntimeError):
+        pipeline.fetch(server + "/redirect", public_only=True)
+    assert seen == [server + "/redirect", server + "/big"]
+
+@pytest.mark.parametrize("path", ["/big", "/chunked"])
+def test_size_cap(pipeline, server, path):
+    with pytest.raises(RuntimeError, match="límite"):
+        pipeline.fetch(server + path, max_bytes=4096)
+    fobj, size, _ = pipeline.fetch(server + path, max_bytes=8192)
+    with fobj:
+        assert size == 5000
@@ -0,0 +1,13 @@
+import pytest
+import scheduler as sched
+
+@pytest.mark.parametrize("text", ["todos 8-18", "Todos 8-18", "* 8-18", "L-D 8-18"])
+def test_every_day(text):
+    assert sched.format_windows(sched.parse_windows(text)) == "L-D 08:00-18:00"
+
+def test_overnight_wraps_to_monday():
+    assert sched.parse_windows("D 22-2") == [[0, 120], [6 * sched.DAY + 22 * 60, sched.WEEK]]
+
+def test_rejects_unknown_segment():
+    with pytest.raises(ValueError):
+        sched.parse_windows("lunes 8-18")
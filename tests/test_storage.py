@@ -0,0 +1,66 @@
+import os
+import pytest
+import storage
+from storage import JsonStore, SqliteStore
+
+def chat(budget):
+    return {"budget": budget, "store": {"L": {"ads": {"1": {"title": "T", "meta": {"ad_id": "9"}}}}},
+            "next_aid": 2}
+
+@pytest.fixture
+def state():
+    return {}
+
+def test_json_failed_append_is_retried(tmp_path, monkeypatch, state):
+    path = str(tmp_path / "data.json")
+    db = JsonStore(path, state.get, delay=60)
+    db.load()
+    state[1] = chat(1000)
+    db.mark(1)
+    db.flush()
+
+    state[1] = chat(2000)
+    db.mark(1)
+    real = os.fsync
+    def broken(fd):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(storage.os, "fsync", broken)
+    with pytest.raises(OSError):
+        db.flush()
+    monkeypatch.setattr(storage.os, "fsync", real)
+    assert db.get(1)["budget"] == 1000     # lo persistido no se adelantó
+
+    assert db.flush() > 0                  # el chat quedó sucio y se reintenta
+    again = JsonStore(path, {}.get, delay=60)
+    again.load()
+    assert again.get(1)["budget"] == 2000
+
+class FailingDB:
+    """Conexión que falla en el primer INSERT de líneas."""
+    def __init__(self, db):
+        self.db, self.armed = db, True
+
+    def execute(self, sql, *args):
+        if self.armed and sql.startswith("INSERT OR REPLACE INTO lines"):
+            self.armed = False
+            raise storage.sqlite3.OperationalError("disk I/O error")
+        return self.db.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+def test_sqlite_rollback_keeps_rows_dirty(tmp_path, state):
+    db = SqliteStore(str(tmp_path / "state.db"), state.get, delay=60)
+    db.load()
+    state[1] = chat(1000)
+    db.mark(1)
+    db._db = FailingDB(db._db)
+    with pytest.raises(storage.sqlite3.OperationalError):
+        db.flush()
+    assert db.get(1) is None
+
+    assert db.flush() > 0
+    db._db = db._db.db
+    db.forget(1)
+    assert db.get(1)["store"]["L"]["ads"]["1"]["title"] == "T"
+    assert db.find_ad("9") == (1, "L", "1")
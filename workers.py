@@ -0,0 +1,56 @@
+import threading, queue, traceback
+from collections import deque
+
+# =====================
+# Pool de workers con orden por chat
+# =====================
+# Cada chat tiene su propia cola; un chat está "listo" a lo sumo una vez en
+# la cola compartida, así que nunca lo atienden dos hilos a la vez (orden
+# garantizado dentro del chat) mientras chats distintos corren en paralelo.
+# Tras cada item el chat vuelve al final de la fila si aún tiene pendientes,
+# para que un chat ruidoso no acapare un hilo.
+
+class ChatPool:
+    def __init__(self, handler, workers=8, max_pending=1000, name="chat-worker"):
+        self._handler = handler
+        self._max = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}          # key -> deque de items
+        self._ready = queue.Queue() # keys con trabajo y sin hilo asignado
+        self._count = 0
+        for n in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-{n}", daemon=True).start()
+
+    def submit(self, key, item):
+        """Encola sin bloquear; False si el pool está lleno."""
+        with self._lock:
+            if self._count >= self._max:
+                return False
+            self._count += 1
+            dq = self._pending.get(key)
+            if dq is None:
+                self._pending[key] = deque([item])
+                self._ready.put(key)
+            else:
+                dq.append(item)
+        return True
+
+    def pending(self):
+        return self._count
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                item = self._pending[key].popleft()
+                self._count -= 1
+            try:
+                self._handler(item)
+            except Exception as e:
+                print("ChatPool handler error:", repr(e))
+                print(traceback.format_exc())
+            with self._lock:
+                if self._pending[key]:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]